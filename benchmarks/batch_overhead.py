@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+"""
+Measures the per-workunit overhead of running a batch of workunits on a
+worker.  The subtask does no work, so the timings are the cost of running
+each workunit of the batch: parsing its args, resolving the subtask and
+returning its results.  The batch is run with each workunit started by its
+own `_run_task()` call and then with all workunits run in a single thread
+(`WorkerTaskControls.batch_in_thread`).
+
+usage: benchmarks/batch_overhead.py [workunits]
+"""
+import sys
+import time
+
+import simplejson
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred
+
+from pydra.cluster.tasks import Task, ParallelTask
+from pydra.cluster.tasks.datasource.slicer import IterSlicer
+from pydra.cluster.module import ModuleManager
+from pydra.cluster.worker import WorkerTaskControls
+
+WORKUNITS = 2000
+SUBTASK_KEY = 'NoopParallelTask.NoopTask'
+
+
+class NoopTask(Task):
+    def work(self, data):
+        return data
+
+
+class NoopParallelTask(ParallelTask):
+    datasource = IterSlicer, xrange(WORKUNITS)
+
+    def __init__(self):
+        ParallelTask.__init__(self)
+        self.set_subtask(NoopTask)
+
+
+def run_batch(name, batch_in_thread):
+    """
+    Runs a batch of WORKUNITS workunits on a worker with no master.  Returns
+    a deferred that fires once the results of the batch are complete.
+    """
+    wtc = WorkerTaskControls()
+    ModuleManager().register(wtc)
+    wtc.worker_key = 'benchmark'
+    wtc.master = None
+    wtc.batch_in_thread = batch_in_thread
+
+    deferred = Deferred()
+    wtc.batch_complete = lambda: deferred.callback(wtc._results)
+    deferred.addCallback(report, name, time.time())
+
+    workunit_args = {SUBTASK_KEY:[simplejson.dumps({'data':i}) \
+                                    for i in xrange(WORKUNITS)]}
+    task_tuple = ('benchmark', 'v1', NoopParallelTask, None)
+    wtc.run_batch(task_tuple, {}, {SUBTASK_KEY:range(WORKUNITS)}, None, 1,
+                  workunit_args)
+    return deferred
+
+
+def report(results, name, started):
+    elapsed = time.time() - started
+    units = len(results)
+    print '%-10s %6d workunits  %8.3fs  %8.1f us/workunit' % \
+        (name, units, elapsed, elapsed / units * 1000000)
+
+
+def main():
+    global WORKUNITS
+    if len(sys.argv) > 1:
+        WORKUNITS = int(sys.argv[1])
+
+    def start():
+        deferred = run_batch('workunit', False)
+        deferred.addCallback(lambda x: run_batch('batch', True))
+        deferred.addBoth(lambda x: reactor.stop())
+
+    reactor.callWhenRunning(start)
+    reactor.run()
+
+
+if __name__ == '__main__':
+    main()
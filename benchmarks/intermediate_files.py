@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+"""
+Measures write and read throughput of the file backends for MapReduce
+intermediate results.  A map output of word counts is dumped and read back
+with the binary run format, uncompressed and with each codec, and with
+pickle.  The size per record is the volume of intermediate data each format
+writes for the CPU time it costs.
+
+usage: benchmarks/intermediate_files.py [keys] [runs]
+"""
+import os
+import shutil
+import sys
+import tempfile
+import time
+from functools import partial
+
+from pydra.cluster.tasks.datasource.intermediate import FileRunOutput, \
+    FileRunInput, FilePickleOutput, FileUnpicleSubslicer
+
+KEYS = 100000
+RUNS = 4
+
+FORMATS = (
+    ('run', FileRunOutput, FileRunInput),
+    ('run-fast', partial(FileRunOutput, compression='fast'), FileRunInput),
+    ('run-zlib', partial(FileRunOutput, compression='zlib'), FileRunInput),
+    ('run-bz2', partial(FileRunOutput, compression='bz2'), FileRunInput),
+    ('pickle', FilePickleOutput, FileUnpicleSubslicer),
+)
+
+
+def map_output(keys):
+    return [('word%08d' % i, [1] * (1 + i % 3)) for i in xrange(keys)]
+
+
+def report(name, operation, records, size, elapsed):
+    print '%-8s %-6s %8d records  %8.3fs  %8.1f MB/s  %10.0f records/s' % \
+        (name, operation, records, elapsed, size / elapsed / 1048576,
+         records / elapsed)
+
+
+def main():
+    keys = int(sys.argv[1]) if len(sys.argv) > 1 else KEYS
+    runs = int(sys.argv[2]) if len(sys.argv) > 2 else RUNS
+    tuples = map_output(keys)
+
+    for name, output_class, input_class in FORMATS:
+        directory = tempfile.mkdtemp()
+        try:
+            output = output_class(directory)
+            names = ['run%d' % i for i in xrange(runs)]
+
+            start = time.time()
+            for run in names:
+                output.dump(run, tuples)
+            elapsed = time.time() - start
+            size = sum(os.path.getsize(os.path.join(directory, run)) \
+                       for run in names)
+            report(name, 'write', keys * runs, size, elapsed)
+
+            input = input_class(directory)
+            input.input = names
+            start = time.time()
+            count = 0
+            for k, vs in input:
+                count += 1
+            elapsed = time.time() - start
+            report(name, 'read', count, size, elapsed)
+            print '%-8s %-6s %8.1f bytes/record' % \
+                (name, 'size', float(size) / (keys * runs))
+        finally:
+            shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+"""
+Measures rows per second written and read by the SQL backend for MapReduce
+intermediate results, on a SQLite database file.  Map outputs of word counts
+are bulk inserted by `SQLTableOutput` and the partition is read back in key
+order by `SQLTableKeyInput`.  For comparison, a smaller output is inserted
+one row per statement with a commit after each row.
+
+usage: benchmarks/intermediate_sql.py [keys] [runs]
+"""
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from pydra.cluster.tasks.datasource.backend import SQLBackend
+from pydra.cluster.tasks.datasource.intermediate import SQLTableOutput, \
+    SQLTableKeyInput, SERIALIZERS
+
+KEYS = 100000
+RUNS = 4
+NAIVE_KEYS = 2000
+
+
+def map_output(keys):
+    return [('word%08d' % i, [1] * (1 + i % 3)) for i in xrange(keys)]
+
+
+def report(name, operation, rows, elapsed):
+    print '%-8s %-6s %8d rows  %8.3fs  %10.0f rows/s' % \
+        (name, operation, rows, elapsed, rows / elapsed)
+
+
+def naive_insert(db, tuples):
+    """
+    Inserts each row with its own statement and transaction.
+    """
+    dumps = SERIALIZERS['p'][0]
+    cursor = db.handle.cursor()
+    cursor.execute('CREATE TABLE naive (task_id VARCHAR(255), part INTEGER, '
+                   'run VARCHAR(255), k BLOB, v BLOB)')
+    for k, vs in tuples:
+        cursor.execute('INSERT INTO naive VALUES (?, ?, ?, ?, ?)',
+                       ('1', 0, 'run0', buffer(dumps(k)), buffer(dumps(vs))))
+        db.handle.commit()
+
+
+def main():
+    keys = int(sys.argv[1]) if len(sys.argv) > 1 else KEYS
+    runs = int(sys.argv[2]) if len(sys.argv) > 2 else RUNS
+    tuples = map_output(keys)
+
+    directory = tempfile.mkdtemp()
+    try:
+        db = SQLBackend('sqlite', os.path.join(directory, 'i9e.db'))
+
+        naive = tuples[:NAIVE_KEYS]
+        start = time.time()
+        naive_insert(db, naive)
+        report('naive', 'write', len(naive), time.time() - start)
+
+        output = SQLTableOutput(db, 'i9e')
+        names = ['run%d' % i for i in xrange(runs)]
+        start = time.time()
+        for run in names:
+            output.dump(run, tuples, '1', 0)
+        report('bulk', 'write', keys * runs, time.time() - start)
+
+        input = SQLTableKeyInput(db, 'i9e')
+        input.input = names
+        input.task_id = '1'
+        input.partition = 0
+        start = time.time()
+        count = 0
+        for k, vs in input:
+            for v in vs:
+                pass
+            count += 1
+        elapsed = time.time() - start
+        report('bulk', 'read', keys * runs, elapsed)
+        print '%-8s %-6s %8d keys   %8.0f keys/s' % \
+            ('bulk', 'groups', count, count / elapsed)
+        db.disconnect()
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+"""
+Measures the throughput of splitting a text file into workunits.  A file of
+log-like lines is written, split into line-aligned byte ranges by
+`LineRangeSlicer`, and every range is read back with `range_lines`.  For
+comparison, the first megabytes of the file are scanned one line at a time
+by `LineSlicer`.
+
+usage: benchmarks/line_slicer.py [megabytes] [ranges]
+"""
+import os
+import sys
+import tempfile
+import time
+
+from pydra.cluster.tasks.datasource.slicer import LineSlicer, \
+    LineRangeSlicer, range_lines
+
+MEGABYTES = 1024
+RANGES = 64
+LINE_SLICER_MEGABYTES = 16
+MB = 1048576.0
+
+
+def write_file(path, megabytes):
+    """
+    Writes lines of varying length until the file holds `megabytes`.
+    """
+    block = ''.join('%08d GET /index.html?id=%s 200\n' % (i, 'x' * (i % 61))
+                    for i in xrange(20000))
+    f = open(path, 'wb')
+    try:
+        written = 0
+        while written < megabytes * MB:
+            f.write(block)
+            written += len(block)
+    finally:
+        f.close()
+
+
+def report(name, operation, size, elapsed):
+    print '%-16s %-6s %10.1f MB  %8.3fs  %10.1f MB/s' % \
+        (name, operation, size / MB, elapsed, size / MB / elapsed)
+
+
+def main():
+    megabytes = int(sys.argv[1]) if len(sys.argv) > 1 else MEGABYTES
+    ranges = int(sys.argv[2]) if len(sys.argv) > 2 else RANGES
+
+    fd, path = tempfile.mkstemp()
+    os.close(fd)
+    try:
+        write_file(path, megabytes)
+        size = os.path.getsize(path)
+
+        start = time.time()
+        slicer = LineRangeSlicer(path, ranges)
+        elapsed = time.time() - start
+        report('LineRangeSlicer', 'split', size, elapsed)
+        print '%-16s %-6s %10d ranges' % ('LineRangeSlicer', 'split',
+                                          len(slicer))
+
+        start = time.time()
+        lines = 0
+        for begin, end in slicer:
+            for line in range_lines(path, begin, end):
+                lines += 1
+        elapsed = time.time() - start
+        report('LineRangeSlicer', 'read', size, elapsed)
+        print '%-16s %-6s %10d lines  %8.0f lines/s' % \
+            ('LineRangeSlicer', 'read', lines, lines / elapsed)
+
+        limit = min(size, int(LINE_SLICER_MEGABYTES * MB))
+        handle = open(path, 'rb')
+        try:
+            start = time.time()
+            for position in LineSlicer(handle):
+                if position >= limit:
+                    break
+            elapsed = time.time() - start
+        finally:
+            handle.close()
+        report('LineSlicer', 'scan', limit, elapsed)
+    finally:
+        os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
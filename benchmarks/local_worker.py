@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+"""
+Measures the per-workunit overhead of running a ParallelTask on this host with
+LocalWorker.  The subtask does no work, so the timings are the cost of
+dispatching workunits and returning their results.  Compare these numbers
+against the same task run on a cluster to measure cluster overhead.
+
+usage: benchmarks/local_worker.py [workunits] [processes]
+"""
+import sys
+
+from twisted.internet import reactor
+
+from pydra.cluster.tasks import Task, ParallelTask
+from pydra.cluster.tasks.datasource.slicer import IterSlicer
+from pydra.cluster.worker_proxy import LocalWorker
+
+WORKUNITS = 2000
+
+
+class NoopTask(Task):
+    def work(self, data):
+        return data
+
+
+class NoopParallelTask(ParallelTask):
+    datasource = IterSlicer, xrange(WORKUNITS)
+
+    def __init__(self):
+        ParallelTask.__init__(self)
+        self.set_subtask(NoopTask)
+
+
+def report(results, name, worker):
+    elapsed = worker.stats['elapsed']
+    units = worker.stats['completed']
+    print '%-8s %6d workunits  %8.3fs  %8.1f us/workunit' % \
+        (name, units, elapsed, elapsed / units * 1000000)
+
+
+def main():
+    global WORKUNITS
+    if len(sys.argv) > 1:
+        WORKUNITS = int(sys.argv[1])
+        NoopParallelTask.datasource = IterSlicer, xrange(WORKUNITS)
+    processes = int(sys.argv[2]) if len(sys.argv) > 2 else None
+
+    def run_threads():
+        worker = LocalWorker(0)
+        deferred = worker.run(NoopParallelTask())
+        deferred.addCallback(report, 'threads', worker)
+        return deferred
+
+    def run_processes(result):
+        worker = LocalWorker(processes)
+        deferred = worker.run(NoopParallelTask())
+        deferred.addCallback(report, 'pool', worker)
+        return deferred
+
+    def start():
+        deferred = run_threads()
+        deferred.addCallback(run_processes)
+        deferred.addBoth(lambda x: reactor.stop())
+
+    reactor.callWhenRunning(start)
+    reactor.run()
+
+
+if __name__ == '__main__':
+    main()
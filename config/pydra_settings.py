@@ -81,6 +81,17 @@ PORT = 11890
 CONTROLLER_PORT = 18801
 WORKER_PORT = 18800
 
+# MapReduce intermediate results written with IntermediateResultsShuffle are
+# kept on the local disk of the node that produced them, in SHUFFLE_DIR.  The
+# node serves them to reducers on other nodes on SHUFFLE_PORT, on the address
+# the master connects to the node with.
+#
+# Reducers authenticate with SHUFFLE_KEY, an RSA key shared by the nodes.  It
+# is created by the first node started, copy it to the other nodes.
+SHUFFLE_PORT = 18802
+SHUFFLE_DIR = '%s/shuffle' % RUNTIME_FILES_DIR
+SHUFFLE_KEY = '%s/shuffle.key' % RUNTIME_FILES_DIR
+
 # Directory in which to place tasks to deploy to Pydra.  Tasks will be parsed
 # and versioned.  Processed Tasks are stored in TASKS_DIR_INTERNAL.  Modifying
 # files within TASKS_DIR_INTERNAL _WILL_ break things.
@@ -91,5 +102,10 @@ TASKS_DIR = '%s/tasks' % RUNTIME_FILES_DIR
 TASKS_DIR_INTERNAL = '%s/tasks_internal' % RUNTIME_FILES_DIR
 TASKS_SYNC_CACHE  = '%s/task_sync_cache' % RUNTIME_FILES_DIR
 
+# Directory in which main workers store checkpoints of ParallelTasks.  When
+# a main worker fails its task is restarted on the same node, so this may be
+# on local disk.
+CHECKPOINT_DIR = '%s/checkpoints' % RUNTIME_FILES_DIR
+
 # Automatically add nodes found with autodiscovery 
 MULTICAST_ALL = False 
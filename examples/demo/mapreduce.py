@@ -1,10 +1,10 @@
+import os
+
 from pydra.cluster.tasks.tasks import Task
 
 from pydra.cluster.tasks.mapreduce import MapReduceTask, \
-        IntermediateResultsFiles, IntermediateResultsSQL
-
-from pydra.cluster.tasks.datasource import DatasourceDict, \
-        DatasourceDir, DatasourceSQL, SQLTableSlicer
+        IntermediateResultsFiles, IntermediateResultsShuffle, \
+        IntermediateResultsSQL
 
 import logging
 logger = logging.getLogger('root')
@@ -28,52 +28,42 @@ class ReduceWords(Task):
     def work(self, input, output, **kwargs):
         """sum occurances of each word"""
 
-        d = {}
+        for word, values in input:
+            # emmit output (word, num)
+            output[word] = sum(values)
 
-        # WARNING the same key can appear more than once
-        for word, v in input:
-            try:
-                v = sum(v)
-            except:
-                pass
 
-            d[word] = int(v) + d.get(word, 0)
+class WordFiles(object):
+    """input of CountWords: the words in each file of a directory"""
 
-        for word, num in d.iteritems():
-            # emmit output (word, num)
-            output[word] = num
+    def __init__(self, path):
+        self.path = path
 
+    def __iter__(self):
+        return iter(sorted(os.listdir(self.path)))
 
-class CountWords(MapReduceTask):
-
-    datasources = \
-            {
-            #'dict': DatasourceDict(
-            #    { 
-            #        "k1": ['one', 'two', 'four', 'two', 'four', 'seven'],
-            #        "k2": ['seven', 'four', 'seven', 'seven'],
-            #        "k3": ['seven', 'four', 'seven', 'seven'],
-            #    }),
-            #'sql': DatasourceSQL(user='pydra', passwd='pydra',
-            #    host='192.168.56.1', db='mapreduce'),
-            'dir': DatasourceDir(dir='/var/lib/pydra/mapreduce/in'),
-            'dir_i9e': DatasourceDir(dir='/var/lib/pydra/mapreduce/i9e'),
-            }
+    def load(self, filename):
+        f = open(os.path.join(self.path, filename))
+        try:
+            return f.read().split()
+        finally:
+            f.close()
 
-    #input = datasources['dict']
 
-    input = datasources['dir']
+class CountWords(MapReduceTask):
 
-    #input = SQLTableSlicer(table='count_words_in')
-    #input.input = datasources['sql']
+    input = WordFiles('/var/lib/pydra/mapreduce/in')
 
     output = {}
 
     map = MapWords
     reduce = ReduceWords
+    combiner = ReduceWords
 
-    intermediate = IntermediateResultsFiles(dir=datasources['dir_i9e'])
-    #intermediate = IntermediateResultsSQL(table='count_words_i9e', db=datasources['sql'])
+    intermediate = IntermediateResultsShuffle()
+    #intermediate = IntermediateResultsFiles(dir='/var/lib/pydra/mapreduce/i9e')
+    #intermediate = IntermediateResultsSQL(table='count_words_i9e',
+    #        db=SQLBackend('mysql', '192.168.56.1', 'pydra', 'pydra', 'mapreduce'))
 
     reducers = 2
     #sequential = True
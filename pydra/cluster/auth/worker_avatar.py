@@ -35,6 +35,7 @@ class WorkerAvatar(ModuleAvatar, RSAAvatar):
     version = None       # version of task package containing task
     args = None          # Task arguments
     workunits = None     # structure containing workunits
+    workunit_args = None # args for each workunit in workunits
     main_worker = None   # worker_key of mainworker for this task
     task_id = None       # unique identifier of Task this worker is assigned to
     run_task_deferred = None # defered set if run_task must be delayed
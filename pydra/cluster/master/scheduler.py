@@ -29,6 +29,7 @@ from twisted.internet.defer import DeferredList
 
 from pydra.cluster.module import Module
 from pydra.cluster.tasks import *
+from pydra.cluster.tasks.counters import merge_counters
 from pydra.cluster.tasks.task_manager import TaskManager
 from pydra.cluster.constants import *
 from pydra.models import TaskInstance, WorkUnit
@@ -38,6 +39,14 @@ import logging
 logger = logging.getLogger('root')
 
 
+def node_key(worker_key):
+    """
+    Returns the key of the node a worker runs on.  Worker keys are the host
+    and port of their node followed by the index of the worker.
+    """
+    return worker_key.rsplit(':', 1)[0]
+
+
 class TaskScheduler(Module):
     """
     This class handles manages available workers and task queue. It's
@@ -102,7 +111,8 @@ class TaskScheduler(Module):
             ('NODE', self.request_worker),
             ('NODE', self.send_results),
             ('NODE', self.worker_stopped),
-            ('NODE', self.request_worker_release)
+            ('NODE', self.request_worker_release),
+            ('NODE', self.results_resumed)
         ]
 
         self._friends = {
@@ -160,6 +170,11 @@ class TaskScheduler(Module):
         # a set containing all main workers
         self._main_workers = set()
 
+        # results being forwarded to main workers, by (task id, node,
+        # subtask key).  Each holds the results that arrived from the node
+        # while a call was in flight, see _forward_results()
+        self._forwarding = {}
+
         self.update_interval = 5 # seconds
 
 
@@ -336,10 +351,41 @@ class TaskScheduler(Module):
 
                 task_instance = job.task_instance
 
-                if task_instance.worker in self.workers:
+                if task_instance.worker in self.workers and \
+                        worker_key in task_instance.running_workers:
                     # requeue failed work.
                     task_instance.queue_worker_request(job)
 
+            elif isinstance(job, TaskInstance):
+                # the main worker failed.  Restart the root task, on the same
+                # node if possible: ParallelTasks that checkpoint their
+                # progress resume from the checkpoints kept on that node.
+                logger.warning('Main worker:%s failed, requeuing task:%s' %
+                    (worker_key, job.id))
+                del self._active_workers[worker_key]
+                self._main_workers.discard(worker_key)
+                with job._request_lock:
+                    # workunits will be requested again by the new main worker
+                    job._worker_requests = []
+
+                # workers still running workunits of the failed main worker
+                # are returned to the idle pool once they send their results.
+                # Held workers are released now.
+                job.running_workers = []
+                for key in job.waiting_workers:
+                    self.workers[key].remote.callRemote('release_worker')
+                    self._waiting_workers.remove(key)
+                    self._idle_workers.append(key)
+                job.waiting_workers = []
+
+                job.checkpoint_node = node_key(worker_key)
+                job.worker = None
+                job.local_workunit = None
+                job.status = STATUS_STOPPED
+                job.save()
+                job.queue_worker_request(job)
+                threads.deferToThread(self._schedule)
+
 
     def hold_worker(self, worker_key):
         """
@@ -361,7 +407,8 @@ class TaskScheduler(Module):
                     self._waiting_workers.append(worker_key)
 
 
-    def request_worker(self, requester_key, subtask, args, workunit):
+    def request_worker(self, requester_key, subtask, args, workunit,
+                       data_size=None):
         """
         Requests a worker for a workunit on behalf of a (main) worker.
         
@@ -372,6 +419,8 @@ class TaskScheduler(Module):
         @param args - arguments to pass to the task
         @param workunit - key that will retrieve additional data for this
                             workunit.
+        @param data_size - estimated bytes of data in the workunit, or None
+                            if the task did not estimate it
         """
         task_instance = self.get_worker_job(requester_key)
         if task_instance:
@@ -385,11 +434,12 @@ class TaskScheduler(Module):
             job.subtask_key = subtask
             job.args = simplejson.dumps(args)
             job.workunit = workunit
+            job.data_size = data_size
             job.save()
 
             task_instance.queue_worker_request(job)
-            logger.debug('Work Request %s:  sub=%s  args=%s  w=%s ' % \
-                         (requester_key, subtask, '--', workunit))
+            logger.debug('Work Request %s:  sub=%s  args=%s  w=%s  bytes=%s' % \
+                         (requester_key, subtask, '--', workunit, data_size))
 
             self._schedule()
             return job
@@ -477,38 +527,28 @@ class TaskScheduler(Module):
             
             if self._queue:
                 # find taskinstance or a worker_request
-                task_instance, job = None, None
+                task_instance, job, worker_key = None, None, None
                 for item in self._queue:
+                    if item[1].results_throttled:
+                        # main worker can't process results quickly enough
+                        job = None
+                        continue
                     job = item[1].poll_worker_request()
                     if job:
                         task_instance = item[1]
-                        break
-                
-                if job:
-                    with self._worker_lock:
-                        worker_key = None
                         task = task_instance.task_key
                         subtask = job.subtask_key
-                        if subtask and task_instance.waiting_workers:
-                            # consume waiting worker first
-                            worker_key = task_instance.waiting_workers.pop()
-                            logger.info('Re-dispatching waiting worker:%s to task:%s' % 
-                                    (worker_key, task_instance.id))
-                            task_instance.running_workers.append(worker_key)
-
-                        elif subtask and not task_instance.local_workunit:
-                            # the main worker can do a local execution
-                            worker_key = task_instance.worker
-                            logger.info('Main worker:%s assigned to task:%s' %
-                                    (worker_key, task_instance.id))
-
-                        elif self._idle_workers:
-                            # dispatching to idle worker last
-                            worker_key = self._idle_workers.pop()
-                            task_instance.running_workers.append(worker_key)
-                            logger.info('Worker:%s assigned to task:%s  key=%s' %
-                                    (worker_key, task_instance.id, task))
-
+                        with self._worker_lock:
+                            worker_key = self._select_worker(task_instance,
+                                                             subtask)
+                        # a restarted task waiting for a worker of the node
+                        # holding its checkpoints doesn't hold up the rest
+                        # of the queue
+                        if worker_key or subtask or \
+                                not task_instance.checkpoint_node:
+                            break
+                
+                if job:
                     # was a worker found for the job
                     if worker_key:
                         job = task_instance.get_batch()
@@ -525,7 +565,7 @@ class TaskScheduler(Module):
                         main_worker = task_instance.worker if task_instance.worker else worker_key
                         d = worker.remote.callRemote('run_task', task, pkg.version,
                                 job.args, job.transmitable(), main_worker,
-                                task_instance.id)
+                                task_instance.id, job.transmitable_args())
                         d.addCallback(self.run_task_successful, worker_key, subtask)
                         d.addErrback(self.run_task_failed, worker_key)            
                         return worker_key, job.task_id
@@ -538,6 +578,71 @@ class TaskScheduler(Module):
         return None
 
 
+    def _select_worker(self, task_instance, subtask):
+        """
+        Selects the worker to run the next job of a task.  Must be called
+        with the worker lock held.
+
+        @param task_instance - task the job belongs to
+        @param subtask - subtask key of the job, None for the root task
+        @returns key of the worker, or None if no worker may be used yet
+        """
+        worker_key = None
+        if subtask and task_instance.waiting_workers:
+            # consume waiting worker first
+            worker_key = task_instance.waiting_workers.pop()
+            logger.info('Re-dispatching waiting worker:%s to task:%s' % 
+                    (worker_key, task_instance.id))
+            task_instance.running_workers.append(worker_key)
+
+        elif subtask and not task_instance.local_workunit:
+            # the main worker can do a local execution
+            worker_key = task_instance.worker
+            logger.info('Main worker:%s assigned to task:%s' %
+                    (worker_key, task_instance.id))
+
+        elif not subtask and task_instance.checkpoint_node:
+            # restarting a root task on the node holding its checkpoints
+            worker_key = self._pop_idle_worker(task_instance.checkpoint_node)
+            if worker_key:
+                task_instance.running_workers.append(worker_key)
+                task_instance.checkpoint_node = None
+                logger.info('Worker:%s assigned to restart task:%s' %
+                        (worker_key, task_instance.id))
+
+        elif self._idle_workers:
+            # dispatching to idle worker last
+            worker_key = self._idle_workers.pop()
+            task_instance.running_workers.append(worker_key)
+            logger.info('Worker:%s assigned to task:%s  key=%s' %
+                    (worker_key, task_instance.id, task_instance.task_key))
+
+        return worker_key
+
+
+    def _pop_idle_worker(self, node):
+        """
+        Takes an idle worker of a node.  While any worker of the node is
+        connected the task waits for one of them to become idle.  If the node
+        is gone any idle worker is taken.  Must be called with the worker lock
+        held.
+
+        @param node - key of the node, as returned by node_key()
+        @returns key of the worker, or None if no worker may be used yet
+        """
+        for i in xrange(len(self._idle_workers) - 1, -1, -1):
+            if node_key(self._idle_workers[i]) == node:
+                return self._idle_workers.pop(i)
+
+        for key in self.workers:
+            if node_key(key) == node:
+                return None
+
+        if self._idle_workers:
+            return self._idle_workers.pop()
+        return None
+
+
     def _init_queue(self):
         """
         Initialize the queue by reading the persistent store.  This method is
@@ -658,7 +763,7 @@ class TaskScheduler(Module):
             job.save()
 
 
-    def send_results(self, worker_key, results):
+    def send_results(self, worker_key, results, counters=None):
         """
         Called by workers when they have completed their task.  This may be
         called for successes or failures (exceptions in user code).
@@ -667,6 +772,10 @@ class TaskScheduler(Module):
             * Subtask_key or None
             * result data that will be returned to the main_worker
             * boolean indicating success or failure
+        
+        counters is a dict of the counters incremented by the worker since it
+        last sent results.  They are added to the counters of the task and
+        passed on to the main worker with the results.
         """
         logger.debug('Worker:%s - sent results' % worker_key)
         # TODO: this lock does not appear to be sufficient because all of the
@@ -680,7 +789,21 @@ class TaskScheduler(Module):
             # if the task is still running
             if job:
                 task_instance = job.task_instance
-                if results[0][0] != None:
+                if counters:
+                    merge_counters(task_instance.counters, counters)
+                
+                if not isinstance(job, TaskInstance) and \
+                        worker_key not in task_instance.running_workers:
+                    # main worker failed and the task was requeued.  The new
+                    # main worker will request this workunit again.
+                    logger.warning('Worker:%s - discarding results, main '
+                                   'worker is gone' % worker_key)
+                    with self._worker_lock:
+                        del self._active_workers[worker_key]
+                        self._idle_workers.append(worker_key)
+                    threads.deferToThread(self._schedule)
+                    
+                elif results[0][0] != None:
                     if isinstance(job, (TaskInstance)):
                         job = job.local_workunit
                         task_instance.local_workunit = None
@@ -697,27 +820,31 @@ class TaskScheduler(Module):
     
                     # if this was a subtask the main task needs the results and to 
                     # be informed
-                    main_worker = self.workers[task_instance.worker]
-                    logger.debug('Worker:%s - informed that subtask completed' %
-                            main_worker.name)
-                    
-                    main_worker.remote.callRemote('receive_results', worker_key,
-                            results, job.subtask_key)
+                    self._forward_results(task_instance, worker_key, results,
+                            job.subtask_key, counters)
     
-                    # save information about the workunits to the database
+                    # save information about the workunits to the database.
+                    # results of a batch may have been combined, in which
+                    # case the workunit key is a list of workunit keys
                     now = datetime.now()
-                    if len(results) > 1:
-                        for workunit_key, results, failed in results:
+                    if len(results) > 1 or \
+                            isinstance(results[0][0], (list, tuple)):
+                        size = 0
+                        for workunit_keys, results, failed in results:
+                            if not isinstance(workunit_keys, (list, tuple)):
+                                workunit_keys = (workunit_keys,)
                             status_msg = 'failed' if failed else 'completed'
-                            workunit = job[workunit_key]
                             status = STATUS_FAILED if failed else STATUS_COMPLETE
-                            logger.info('Worker:%s - %s: %s:%s (%s)' %  \
-                                (status_msg, worker_key, job.task_key, \
-                                workunit.subtask_key, workunit_key))
-                            workunit.completed = now
-                            workunit.status = status
-                            workunit.save()
-                        job.size = len(results)
+                            for workunit_key in workunit_keys:
+                                workunit = job[workunit_key]
+                                logger.info('Worker:%s - %s: %s:%s (%s)' %  \
+                                    (status_msg, worker_key, job.task_key, \
+                                    workunit.subtask_key, workunit_key))
+                                workunit.completed = now
+                                workunit.status = status
+                                workunit.save()
+                            size += len(workunit_keys)
+                        job.size = size
                         job.status = STATUS_COMPLETE
                         job.completed = now
                         job.save()
@@ -742,6 +869,92 @@ class TaskScheduler(Module):
                     job.save()
 
 
+    def _forward_results(self, task_instance, worker_key, results,
+                         subtask_key, counters=None):
+        """
+        Sends results to the main worker of a task.  One call at a time is
+        in flight for the results of each node.  Results arriving from the
+        node in the meantime are held and sent together once the main worker
+        acknowledges the call, where they are merged with the combine() of
+        the task if it defines one.  The main worker receives about one call
+        per node rather than one per batch.
+        
+        @param task_instance - task the results belong to
+        @param worker_key - worker that sent the results
+        @param results - list of (workunit, results, failed) tuples
+        @param subtask_key - subtask the results belong to
+        @param counters - counters sent with the results
+        """
+        key = (task_instance.id, node_key(worker_key), subtask_key)
+        pending = self._forwarding.get(key, None)
+        if pending is not None:
+            pending.append((worker_key, results, counters))
+            return
+        
+        self._forwarding[key] = []
+        main_worker = self.workers[task_instance.worker]
+        logger.debug('Worker:%s - informed that subtask completed' %
+                main_worker.name)
+        deferred = main_worker.remote.callRemote('receive_results',
+                worker_key, results, subtask_key, counters)
+        deferred.addBoth(self.receive_results_returned, task_instance, key)
+
+
+    def receive_results_returned(self, stats, task_instance, key=None):
+        """
+        Callback for when a main worker has acknowledged results.  The
+        response is the ingestion stats of the main worker.  Results held
+        while the call was in flight are sent.
+        """
+        if isinstance(stats, dict):
+            self._update_ingestion_stats(task_instance, stats)
+        
+        pending = self._forwarding.pop(key, None)
+        if not pending:
+            return
+        if task_instance.worker not in self.workers:
+            # main worker failed, the new main worker requests the workunits
+            # again
+            return
+        
+        worker_key = pending[0][0]
+        results = []
+        counters = {}
+        for worker_key_, results_, counters_ in pending:
+            results.extend(results_)
+            if counters_:
+                merge_counters(counters, counters_)
+        self._forward_results(task_instance, worker_key, results, key[2],
+                              counters)
+
+
+    def results_resumed(self, worker_key, stats):
+        """
+        Called by a main worker that was throttling results once it has
+        caught up.  The scheduler is advanced.
+        
+        @param worker_key - main worker of the task
+        @param stats - ingestion stats of the main worker
+        """
+        job = self._active_workers.get(worker_key, None)
+        if job:
+            self._update_ingestion_stats(job.task_instance, stats)
+
+
+    def _update_ingestion_stats(self, task_instance, stats):
+        """
+        Records the ingestion stats of the main worker of a task.  Workunits
+        are not dispatched for the task while the main worker is throttling
+        results.  If it stopped throttling the scheduler is advanced.
+        """
+        throttled = task_instance.results_throttled
+        task_instance.ingestion_stats = stats
+        task_instance.results_throttled = bool(stats.get('throttling'))
+        if throttled and not task_instance.results_throttled and \
+                len(task_instance._worker_requests) != 0:
+            threads.deferToThread(self._schedule)
+
+
     def worker_stopped(self, worker_key):
         """
         Called by workers when they have stopped due to a cancel task request.
@@ -861,7 +1074,10 @@ class TaskScheduler(Module):
                 statuses[task.id] = {'s':STATUS_STOPPED}
             else:
                 start = time.mktime(task.started.timetuple())
-                status = {'s':task.status, 't':start, 'p':-1}
+                status = {'s':task.status, 't':start, 'p':-1,
+                          'c':dict(task.counters)}
+                if task.ingestion_stats:
+                    status['i'] = task.ingestion_stats
                 statuses[task.id] = status
                 worker = self.workers[task.worker]
                 deferred = worker.remote.callRemote('task_status')
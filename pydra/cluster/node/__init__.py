@@ -4,3 +4,4 @@ from pydra.cluster.node.master_connection_manager import MasterConnectionManager
 from pydra.cluster.node.node_zero_conf_service import NodeZeroConfService
 from pydra.cluster.node.node_information import NodeInformation
 from pydra.cluster.node.task_sync import TaskSyncClient
+from pydra.cluster.node.shuffle_server import ShuffleServer
@@ -20,7 +20,7 @@ from pydra.logs.log_aggregator import NodeLogAggregator
 from pydra.cluster.module import ModuleManager
 from pydra.cluster.node import NodeInformation, WorkerManager, \
     WorkerConnectionManager, MasterConnectionManager, TaskSyncClient, \
-    NodeZeroConfService
+    NodeZeroConfService, ShuffleServer
 from pydra.cluster.tasks.task_manager import TaskManager
 
 from pydra.config import load_settings
@@ -52,6 +52,7 @@ class NodeServer(ModuleManager):
             TaskSyncClient,
             NodeZeroConfService,
             NodeLogAggregator,
+            ShuffleServer,
         ]
 
         ModuleManager.__init__(self)
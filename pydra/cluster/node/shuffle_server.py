@@ -0,0 +1,77 @@
+"""
+    Copyright 2009 Oregon State University
+
+    This file is part of Pydra.
+
+    Pydra is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    Pydra is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with Pydra.  If not, see <http://www.gnu.org/licenses/>.
+"""
+from twisted.internet import defer, reactor
+
+from pydra.cluster.module import Module
+from pydra.cluster.tasks.datasource.shuffle import ShuffleFactory, \
+    shuffle_dir, shuffle_key, shuffle_port
+from pydra.util import makedirs
+
+import logging
+logger = logging.getLogger('root')
+
+
+class ShuffleServer(Module):
+    """
+    Serves the MapReduce intermediate results written to the local disk of
+    this node to the reducers running on other nodes.
+
+    The server listens once the master has initialized the node, on the
+    address of the node known by the master, which is also the address
+    workers of this node put in the locators of their dumps.  Clients must
+    hold the RSA key shared by the nodes of the cluster, see `shuffle_key`.
+    """
+
+    def __init__(self):
+        self._listeners = {'NODE_INITIALIZED':self.listen}
+        self.host = None
+        self.port = None
+
+    def _register(self, manager):
+        Module._register(self, manager)
+        # the key is created on the first node, and must be copied to the
+        # other nodes of the cluster
+        self.key = shuffle_key(True)
+
+    def listen(self, node_key):
+        """
+        Starts serving the shuffle directory on the host of the node key.
+        The master initializes the node again when it reconnects, the
+        server is only moved if the host changed.
+        """
+        host = node_key.rsplit(':', 1)[0]
+        if host == self.host:
+            return
+        self.host = host
+
+        if self.port:
+            deferred = defer.maybeDeferred(self.port.stopListening)
+            deferred.addCallback(lambda result: self._listen(host))
+        else:
+            self._listen(host)
+
+    def _listen(self, host):
+        directory = shuffle_dir()
+        makedirs(directory)
+
+        logger.info('ShuffleServer - serving %s on %s:%s' % \
+                    (directory, host, shuffle_port()))
+        self.port = reactor.listenTCP(shuffle_port(),
+                                      ShuffleFactory(directory, self.key),
+                                      interface=host)
@@ -61,7 +61,8 @@ class WorkerManager(Module):
             ('WORKER', self.send_results),
             ('WORKER', self.request_worker),
             ('WORKER', self.worker_stopped),
-            ('WORKER', self.request_worker_release)
+            ('WORKER', self.request_worker_release),
+            ('WORKER', self.results_resumed)
             
         ]
         
@@ -205,8 +206,12 @@ class WorkerManager(Module):
     def request_worker_release(self, *args, **kwargs):
         return self.proxy_to_master('request_worker_release', *args, **kwargs)
 
+    def results_resumed(self, *args, **kwargs):
+        return self.proxy_to_master('results_resumed', *args, **kwargs)
+
     def run_task(self, avatar, worker_key, key, version, args={}, \
-            workunits=None, main_worker=None, task_id=None):
+            workunits=None, main_worker=None, task_id=None, \
+            workunit_args=None):
         """
         Run a task on this node.
 
@@ -216,10 +221,10 @@ class WorkerManager(Module):
 
         deferred = self.task_manager.retrieve_task(key, version)
         deferred.addCallback(self._run_task, worker_key, args, workunits,
-            main_worker, task_id)
+            main_worker, task_id, workunit_args)
 
     def _run_task(self, task_tuple, worker_key, args={}, workunits=None,
-            main_worker=None, task_id=None):
+            main_worker=None, task_id=None, workunit_args=None):
         """
         Runs a task on this node.  The worker scheduler on master makes all
         decisions about which worker to run on.  This method only checks
@@ -242,6 +247,7 @@ class WorkerManager(Module):
         @param workunit_key - key of workunit to run
         @param main_worker - main worker for this task
         @param task_id - id of task being run
+        @param workunit_args - args for each workunit in a batch
         """
         key, version, chaff, chaff = task_tuple
 
@@ -255,7 +261,8 @@ class WorkerManager(Module):
                 logger.debug('RunTask - Using existing worker %s' % worker_key)
                 worker = self.workers[worker_key]
                 worker.run_task_deferred = worker.remote.callRemote('run_task',\
-                        key, version, args, workunits, main_worker, task_id)
+                        key, version, args, workunits, main_worker, task_id,
+                        workunit_args)
             else:
                 # worker not running. start it saving the information required
                 # to start the subtask.  This function will return a deferred
@@ -291,6 +298,7 @@ class WorkerManager(Module):
             worker.args = args
             worker.main_worker = main_worker
             worker.task_id=task_id
+            worker.workunit_args = workunit_args
             if worker_key == main_worker:
                 worker.local_workunits = workunits
             else:
@@ -311,7 +319,7 @@ class WorkerManager(Module):
             deferred = self._run_task(
                 (worker.key, worker.version, None, None),
                 worker.worker_key, worker.args, worker.workunits,
-                worker.main_worker, worker.task_id)
+                worker.main_worker, worker.task_id, worker.workunit_args)
             deferred.chainDeferred(sent_deferred)
 
     def send_results(self, worker_key, results, *args, **kwargs):
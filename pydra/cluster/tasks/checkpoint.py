@@ -0,0 +1,108 @@
+"""
+    Copyright 2009 Oregon State University
+
+    This file is part of Pydra.
+
+    Pydra is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    Pydra is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with Pydra.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import cPickle
+import os
+
+from pydra.config import load_settings
+load_settings()
+import pydra_settings
+from pydra.util import makedirs
+
+import logging
+logger = logging.getLogger('root')
+
+
+class CheckpointStore(object):
+    """
+    Persists the progress of a `ParallelTask` to the local disk of the node
+    running its main worker.  A checkpoint contains the indexes of the
+    completed workunits and the partial results returned by
+    `ParallelTask.checkpoint_state()`.
+
+    Checkpoints are stored per task instance and task key, so a main worker
+    restarted for the same task instance on the same node finds the
+    checkpoints of all of its ParallelTasks.
+    """
+
+    def __init__(self, task_id, task_key, directory=None):
+        """
+        @param task_id - id of the task instance
+        @param task_key - key of the task within the task instance
+        @param directory - directory to store checkpoints in, defaults to
+                           CHECKPOINT_DIR
+        """
+        if directory is None:
+            directory = getattr(pydra_settings, 'CHECKPOINT_DIR',
+                        '%s/checkpoints' % pydra_settings.RUNTIME_FILES_DIR)
+        self.directory = os.path.join(directory, str(task_id))
+        self.path = os.path.join(self.directory, '%s.checkpoint' % task_key)
+
+    def save(self, completed, state=None):
+        """
+        Writes a checkpoint.  The checkpoint is written to a temporary file
+        and then renamed so a failure while saving leaves the last checkpoint
+        intact.
+
+        @param completed - collection of completed workunit indexes
+        @param state - partial results, must be picklable
+        """
+        makedirs(self.directory)
+        tmp = '%s.tmp' % self.path
+        f = open(tmp, 'wb')
+        try:
+            cPickle.dump((list(completed), state), f, cPickle.HIGHEST_PROTOCOL)
+        finally:
+            f.close()
+        os.rename(tmp, self.path)
+
+    def load(self):
+        """
+        Reads the checkpoint.
+
+        @returns tuple(set of completed indexes, state) or None if there is
+                 no readable checkpoint
+        """
+        if not os.path.exists(self.path):
+            return None
+
+        try:
+            f = open(self.path, 'rb')
+            try:
+                completed, state = cPickle.load(f)
+            finally:
+                f.close()
+        except Exception, e:
+            logger.warning('Ignoring unreadable checkpoint %s: %s' %
+                           (self.path, e))
+            return None
+
+        return set(completed), state
+
+    def remove(self):
+        """
+        Deletes the checkpoint, called once the task has completed.
+        """
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        try:
+            os.rmdir(self.directory)
+        except OSError:
+            # other checkpoints for the task instance remain
+            pass
@@ -0,0 +1,99 @@
+"""
+    Copyright 2009 Oregon State University
+
+    This file is part of Pydra.
+
+    Pydra is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    Pydra is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with Pydra.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from __future__ import with_statement
+
+from threading import Lock
+
+
+def merge_counters(counters, other):
+    """
+    Adds the values of the counters in other to the dict counters.
+
+    :Parameters:
+        counters : dict
+            counters that are updated
+        other : dict
+            counters that are added
+    """
+    for name, value in other.iteritems():
+        counters[name] = counters.get(name, 0) + value
+
+
+class Counters(object):
+    """
+    Named counters incremented by tasks while they run, such as records read
+    or bytes written.
+
+    A worker keeps the counters incremented by the workunits it runs.  They
+    are collected when a workunit completes and sent with its results, so
+    the main worker and the master can add up the counters of the whole
+    task.  Counters may be incremented from several threads.
+    """
+
+    def __init__(self, counters=None):
+        self._lock = Lock()
+        self._counters = {}
+        if counters:
+            self.merge(counters)
+
+    def increment(self, name, amount=1):
+        """
+        Adds amount to the counter name.  Counting many items with one call
+        is cheaper than one call per item.
+        """
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + amount
+
+    def merge(self, counters):
+        """
+        Adds the values of a dict of counters, such as the counters sent with
+        the results of a workunit.
+        """
+        with self._lock:
+            merge_counters(self._counters, counters)
+
+    def collect(self):
+        """
+        Returns the counters incremented since they were last collected and
+        resets them.
+
+        :returns: dict of counter values
+        """
+        with self._lock:
+            counters = self._counters
+            self._counters = {}
+        return counters
+
+    def values(self):
+        """
+        :returns: a copy of the counters as a dict
+        """
+        with self._lock:
+            return dict(self._counters)
+
+    def __getitem__(self, name):
+        with self._lock:
+            return self._counters.get(name, 0)
+
+    def __len__(self):
+        return len(self._counters)
+
+    def __repr__(self):
+        return 'Counters(%r)' % self.values()
@@ -1,3 +1,7 @@
+import thread
+
+from pydra.cluster.tasks.datasource.pool import pool
+
 database_names = {
     "sqlite": ("sqlite3", "pysqlite2.dbapi2",),
     "sqlite2": ("pysqlite2.dbapi2",),
@@ -30,14 +34,43 @@ for name, modules in database_names.items():
         print "Warning: Disabling support for %s databases." % name
 
 
+def check_sql(handle):
+    """
+    Checks that a SQL connection still works.
+    """
+
+    cursor = handle.cursor()
+    cursor.execute("SELECT 1")
+    cursor.fetchall()
+    cursor.close()
+
+def reset_sql(handle):
+    """
+    Rolls back anything left uncommitted on a SQL connection, as closing it
+    would.
+    """
+
+    handle.rollback()
+
+
 class SQLBackend(object):
     """
     Backend for interfacing with DBAPI-compliant SQL databases.
+
+    Connections are taken from the connection pool of the process and given
+    back to it on disconnect, so backends unpacked by later workunits reuse
+    them. In-memory SQLite databases are never pooled, since each of their
+    connections is a separate database.  SQLite connections can only be used
+    by the thread that made them, so they are pooled for each thread.
     """
 
     backends = databases.copy()
     handle = None
 
+    pool = pool
+    """`ConnectionPool` connections are shared through, or None to close
+    each connection on disconnect"""
+
     def __init__(self, db_name, *args):
         """
         Initialize a backend object for the given SQL database.
@@ -53,12 +86,30 @@ class SQLBackend(object):
         else:
             raise ValueError, "Database %s not supported" % db_name
 
+        self.db_name = db_name
         self.kwargs = dict((k,v) for (k,v) in argzip if v is not None)
+        self._key = None
         self.connect()
 
     def __del__(self):
         self.disconnect()
 
+    def pool_key(self, args, kwargs):
+        """
+        Key of the pooled connections made with the given arguments, or None
+        if they should not be pooled.
+        """
+
+        if self.pool is None or args:
+            return None
+        if kwargs.get("database", "") in ("", ":memory:"):
+            return None
+        key = ("sql", self.db_name, self.dbapi.__name__,
+               tuple(sorted(kwargs.items())))
+        if self.db_name.startswith("sqlite"):
+            key += (thread.get_ident(),)
+        return key
+
     def connect(self, *args, **kwargs):
         """
         Open a database connection.
@@ -70,15 +121,25 @@ class SQLBackend(object):
         if not self.handle:
             argnew = self.kwargs.copy()
             argnew.update(kwargs)
-            self.handle = self.dbapi.connect(*args, **argnew)
+            self._key = self.pool_key(args, argnew)
+            if self._key:
+                self.handle = self.pool.acquire(self._key,
+                    lambda: self.dbapi.connect(*args, **argnew), check_sql)
+            else:
+                self.handle = self.dbapi.connect(*args, **argnew)
 
     def disconnect(self):
         """
         Disconnect from the current database, if connected.
+
+        A pooled connection is rolled back and returned to the pool.
         """
 
         if self.handle:
-            self.handle.close()
+            if self._key:
+                self.pool.release(self._key, self.handle, reset_sql)
+            else:
+                self.handle.close()
         self.handle = None
 
     @property
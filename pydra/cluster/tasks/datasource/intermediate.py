@@ -0,0 +1,641 @@
+"""
+Storage for the intermediate results of a MapReduceTask.
+
+Each map workunit dumps one run per partition.  A run is a list of
+(key, values) tuples sorted by key.  Outputs write runs and inputs merge every
+run of a partition into a stream of (key, values) groups for a reducer, one
+group per key in key order.
+"""
+
+import bz2
+import cPickle
+import heapq
+import itertools
+import marshal
+import mmap
+import os
+import struct
+import tempfile
+import zlib
+
+RUN_MAGIC = "PDRN"
+RUN_VERSION = 2
+
+# run header: magic, version, key serializer, values serializer, codec
+RUN_HEADER = struct.Struct(">4sBccc")
+
+# record header: key length, values length
+RECORD_HEADER = struct.Struct(">II")
+
+# block header: compressed length, uncompressed length
+BLOCK_HEADER = struct.Struct(">II")
+
+# uncompressed size of the blocks of a compressed run
+BLOCK_SIZE = 65536
+
+# serializers for the keys and values of a run.  str keys are stored as they
+# are.  marshal is used whenever it can encode every record of the run, it is
+# faster and more compact than pickle but only handles builtin types.
+SERIALIZERS = {
+    "s": (str, str),
+    "m": (marshal.dumps, marshal.loads),
+    "p": (lambda o: cPickle.dumps(o, cPickle.HIGHEST_PROTOCOL),
+          cPickle.loads),
+}
+
+# compression codecs by name: codec id stored in the run, compress function.
+# "fast" trades compression ratio for speed.
+CODECS = {
+    None: ("n", None),
+    "zlib": ("z", lambda data: zlib.compress(data, 6)),
+    "fast": ("f", lambda data: zlib.compress(data, 1)),
+    "bz2": ("b", bz2.compress),
+}
+
+# decompress functions by codec id
+DECOMPRESSORS = {
+    "n": None,
+    "z": zlib.decompress,
+    "f": zlib.decompress,
+    "b": bz2.decompress,
+}
+
+
+def directory_path(directory):
+    """
+    Returns the path of a directory given as either a path or a selector with
+    a path, such as `DirSelector`.
+    """
+
+    return getattr(directory, "path", directory)
+
+
+def frame_records(records, codec=None):
+    """
+    Frames encoded records for a run.  Without compression each record is the
+    length of the key and values followed by the serialized key and values.
+    With compression the records are packed into blocks of about BLOCK_SIZE
+    bytes, each compressed separately and preceded by its compressed and
+    uncompressed lengths, so a run can be decompressed one block at a time.
+
+    :Parameters:
+        records : iterable
+            (serialized key, serialized values) tuples
+        codec
+            name of the compression codec, see CODECS
+
+    :returns: Generator yielding the chunks of the run after its header
+    """
+
+    compress = CODECS[codec][1]
+    if not compress:
+        for k, vs in records:
+            yield RECORD_HEADER.pack(len(k), len(vs))
+            yield k
+            yield vs
+        return
+
+    block = []
+    size = 0
+    for k, vs in records:
+        block.append(RECORD_HEADER.pack(len(k), len(vs)))
+        block.append(k)
+        block.append(vs)
+        size += RECORD_HEADER.size + len(k) + len(vs)
+        if size >= BLOCK_SIZE:
+            data = compress("".join(block))
+            yield BLOCK_HEADER.pack(len(data), size)
+            yield data
+            block = []
+            size = 0
+    if block:
+        data = compress("".join(block))
+        yield BLOCK_HEADER.pack(len(data), size)
+        yield data
+
+
+def encode_run(tuples, codec=None):
+    """
+    Encodes (key, values) tuples as a run.  Tuples are sorted by key.
+
+    A run is a header followed by the records of the tuples, framed by
+    `frame_records()`.
+
+    :Parameters:
+        tuples : iterable
+            (key, values) tuples
+        codec
+            name of the compression codec, see CODECS
+
+    :returns: The run as a str
+    """
+
+    tuples = sorted(tuples)
+    if all(type(k) is str for k, vs in tuples):
+        key_serializer = "s"
+    else:
+        key_serializer = None
+
+    for serializer in ("m", "p"):
+        dumps = SERIALIZERS[serializer][0]
+        kdumps = SERIALIZERS[key_serializer or serializer][0]
+        try:
+            records = [(kdumps(k), dumps(vs)) for k, vs in tuples]
+        except ValueError:
+            # unmarshallable object, fall back to pickle
+            continue
+        break
+    key_serializer = key_serializer or serializer
+
+    chunks = [RUN_HEADER.pack(RUN_MAGIC, RUN_VERSION, key_serializer,
+                              serializer, CODECS[codec][0])]
+    chunks.extend(frame_records(records, codec))
+    return "".join(chunks)
+
+
+def _iter_records(buf, offset, end, kloads, loads):
+    header_size = RECORD_HEADER.size
+    while offset < end:
+        klen, vlen = RECORD_HEADER.unpack_from(buf, offset)
+        offset += header_size
+        k = kloads(buf[offset:offset + klen])
+        offset += klen
+        vs = loads(buf[offset:offset + vlen])
+        offset += vlen
+        yield k, vs
+
+
+def iter_run(buf):
+    """
+    Iterates through the records of a run.  Compressed runs are decompressed
+    one block at a time.
+
+    :Parameters:
+        buf
+            the run as a str, mmap or other buffer
+
+    :returns: Generator yielding (key, values) tuples in key order
+    """
+
+    if len(buf) < RUN_HEADER.size:
+        raise ValueError("Truncated run")
+    magic, version, key_serializer, serializer, codec = \
+        RUN_HEADER.unpack_from(buf, 0)
+    if magic != RUN_MAGIC or version != RUN_VERSION:
+        raise ValueError("Not a run: %r %r" % (magic, version))
+    kloads = SERIALIZERS[key_serializer][1]
+    loads = SERIALIZERS[serializer][1]
+    decompress = DECOMPRESSORS[codec]
+
+    end = len(buf)
+    offset = RUN_HEADER.size
+    if not decompress:
+        for record in _iter_records(buf, offset, end, kloads, loads):
+            yield record
+        return
+
+    while offset < end:
+        clen, size = BLOCK_HEADER.unpack_from(buf, offset)
+        offset += BLOCK_HEADER.size
+        block = decompress(buf[offset:offset + clen])
+        offset += clen
+        if len(block) != size:
+            raise ValueError("Corrupt block at %d" % offset)
+        for record in _iter_records(block, 0, size, kloads, loads):
+            yield record
+
+
+def write_run(f, tuples, key_serializer="p", serializer="p", codec=None):
+    """
+    Writes (key, values) tuples to a file as a run, one record at a time.
+    The tuples must already be sorted by key.  Unlike `encode_run()` the
+    serializers are chosen up front, so pickle is the default.
+    """
+
+    kdumps = SERIALIZERS[key_serializer][0]
+    dumps = SERIALIZERS[serializer][0]
+    f.write(RUN_HEADER.pack(RUN_MAGIC, RUN_VERSION, key_serializer,
+                            serializer, CODECS[codec][0]))
+    records = ((kdumps(k), dumps(vs)) for k, vs in tuples)
+    for chunk in frame_records(records, codec):
+        f.write(chunk)
+
+
+def read_run(path):
+    """
+    Iterates through the records of a run file.  The file is mapped into
+    memory when iteration starts and closed when it ends.
+    """
+
+    f = open(path, "rb")
+    try:
+        m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    finally:
+        f.close()
+    try:
+        for record in iter_run(m):
+            yield record
+    finally:
+        m.close()
+
+
+def _decorate(run, index):
+    for k, vs in run:
+        yield k, index, vs
+
+
+def merge_runs(runs):
+    """
+    Merges sorted runs into a single stream sorted by key.  Records with the
+    same key are returned in the order of their runs.
+
+    :Parameters:
+        runs : list
+            iterables of (key, values) tuples sorted by key
+
+    :returns: Generator yielding (key, values) tuples
+    """
+
+    decorated = [_decorate(run, i) for i, run in enumerate(runs)]
+    for k, index, vs in heapq.merge(*decorated):
+        yield k, vs
+
+
+def group_values(records):
+    """
+    Groups the values of consecutive records with the same key.
+
+    :returns: Generator yielding (key, iterator of values) tuples.  As with
+              itertools.groupby(), the values of a group must be read before
+              moving to the next group.
+    """
+
+    for k, group in itertools.groupby(records, lambda record: record[0]):
+        yield k, (v for key, vs in group for v in vs)
+
+
+def combine_groups(records):
+    """
+    Combines consecutive records with the same key into one record.
+
+    :returns: Generator yielding (key, list of values) tuples
+    """
+
+    for k, vs in group_values(records):
+        yield k, list(vs)
+
+
+class MergeInput(object):
+    """
+    Base for inputs that merge the runs of a partition.  Subclasses implement
+    read() which iterates through a single run.
+
+    At most merge_factor runs are read at a time.  If a partition has more
+    runs they are merged in passes, each group of runs being merged into a
+    spill run on disk, until few enough runs remain.  Memory used by a merge
+    depends on the number of runs read at once, not the size of the
+    partition.
+
+    `input` is set to the keys of the runs to read.
+    """
+
+    merge_factor = 64
+    """Maximum number of runs merged at once"""
+    spill_dir = None
+    """Directory for spill runs, defaults to the system temporary directory"""
+
+    def __iter__(self):
+        spills = []
+        try:
+            runs = [self.read(key) for key in self.input]
+            while len(runs) > self.merge_factor:
+                merged = []
+                for i in xrange(0, len(runs), self.merge_factor):
+                    group = runs[i:i + self.merge_factor]
+                    if len(group) == 1:
+                        merged.append(group[0])
+                        continue
+                    path = self.spill(merge_runs(group))
+                    spills.append(path)
+                    merged.append(read_run(path))
+                runs = merged
+
+            for group in group_values(merge_runs(runs)):
+                yield group
+        finally:
+            for path in spills:
+                os.remove(path)
+
+    def spill(self, records):
+        """
+        Writes merged records to a spill run.
+
+        :returns: path of the spill run
+        """
+
+        fd, path = tempfile.mkstemp(prefix="pydra-spill-", dir=self.spill_dir)
+        f = os.fdopen(fd, "wb")
+        try:
+            write_run(f, records)
+        finally:
+            f.close()
+        return path
+
+
+class FileRunOutput(object):
+    """
+    Writes each dump to its own file as a run, compressed with the codec
+    named by compression.
+    """
+
+    def __init__(self, dir, compression=None):
+        if compression not in CODECS:
+            raise ValueError("Unknown compression: %s" % compression)
+        self.dir = dir
+        self.compression = compression
+
+    def path(self, key):
+        return os.path.join(directory_path(self.dir), key)
+
+    def dump(self, key, tuples):
+        """
+        Writes (key, values) tuples to the run file for key.  The file is
+        renamed into place once it is complete, so a partially written run is
+        never read.
+        """
+
+        path = self.path(key)
+        tmp = "%s.tmp" % path
+        f = open(tmp, "wb")
+        try:
+            f.write(encode_run(tuples, self.compression))
+        finally:
+            f.close()
+        os.rename(tmp, path)
+
+    def dump_sorted(self, key, tuples):
+        """
+        Writes (key, values) tuples that are already sorted by key to the run
+        file for key.  Tuples are written as they are read, so the run does
+        not have to fit in memory.
+        """
+
+        path = self.path(key)
+        tmp = "%s.tmp" % path
+        f = open(tmp, "wb")
+        try:
+            write_run(f, tuples, codec=self.compression)
+        finally:
+            f.close()
+        os.rename(tmp, path)
+
+    def remove(self, key):
+        """
+        Removes the run for key, and the partially written file of a dump
+        that failed.
+        """
+
+        run = self.path(key)
+        for path in (run, "%s.tmp" % run):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+class FileRunInput(MergeInput):
+    """
+    Reads the runs of a partition.  Runs are mapped into memory and decoded
+    one record at a time, so a reducer holds one record of each run being
+    merged in memory, or one block of each compressed run.
+    """
+
+    def __init__(self, dir):
+        self.dir = dir
+        self.input = []
+
+    def read(self, key):
+        """
+        Iterates through the run for a key.
+        """
+
+        return read_run(os.path.join(directory_path(self.dir), key))
+
+
+class FilePickleOutput(FileRunOutput):
+    """
+    Writes each dump to its own file as a pickled list of tuples.
+    """
+
+    def dump(self, key, tuples):
+        f = open(self.path(key), "wb")
+        try:
+            cPickle.dump(sorted(tuples), f, cPickle.HIGHEST_PROTOCOL)
+        finally:
+            f.close()
+
+    def dump_sorted(self, key, tuples):
+        self.dump(key, tuples)
+
+
+class FileUnpicleSubslicer(FileRunInput):
+    """
+    Reads the files written by `FilePickleOutput`.  Each file is loaded
+    entirely into memory.
+    """
+
+    def read(self, key):
+        f = open(os.path.join(directory_path(self.dir), key), "rb")
+        try:
+            tuples = cPickle.load(f)
+        finally:
+            f.close()
+        return iter(tuples)
+
+
+def placeholder(dbapi):
+    """
+    Returns the parameter placeholder for a DBAPI module.
+    """
+
+    style = getattr(dbapi, "paramstyle", "qmark")
+    if style == "qmark":
+        return "?"
+    elif style in ("format", "pyformat"):
+        return "%s"
+    raise ValueError("Unsupported paramstyle: %s" % style)
+
+
+class SQLTable(object):
+    """
+    Base for intermediate results stored in a SQL table.  Each (key, values)
+    tuple of a dump is stored as a row along with the task, the partition
+    and the dump it belongs to.  Keys and values are pickled.
+
+    The database can only order keys by their pickled form, which is not the
+    order of the keys, so each row also stores seq, the position of its key
+    in the dump sorted by key.  The table is indexed on
+    (task_id, part, run, seq) so the rows of a dump are read in key order
+    straight from the index without sorting.
+
+    db is a `SQLBackend` or a DBAPI connection.  The DBAPI module is needed
+    for placeholders and binary columns, it is taken from the backend or
+    defaults to sqlite3 for a bare connection.
+    """
+
+    batch_size = 10000
+    """Number of rows inserted or fetched at a time"""
+
+    def __init__(self, db, table):
+        self.db = db
+        self.table = table
+
+        dbapi = getattr(db, "dbapi", None)
+        if dbapi is None:
+            import sqlite3 as dbapi
+        self.dbapi = dbapi
+        self.marker = placeholder(dbapi)
+
+    @property
+    def handle(self):
+        return getattr(self.db, "handle", self.db)
+
+    @property
+    def module(self):
+        return getattr(self.dbapi, "__name__", "")
+
+    def create_table(self):
+        """
+        Creates the table and its index if they do not exist.
+        """
+
+        if self.module == "psycopg2":
+            binary = "BYTEA"
+        else:
+            binary = "BLOB"
+
+        cursor = self.handle.cursor()
+        cursor.execute("CREATE TABLE IF NOT EXISTS %s (task_id VARCHAR(255), "
+            "part INTEGER, run VARCHAR(255), seq INTEGER, k %s, v %s)" % \
+            (self.table, binary, binary))
+        try:
+            cursor.execute("CREATE INDEX %s_key ON %s "
+                           "(task_id, part, run, seq)" % \
+                           (self.table, self.table))
+        except self.dbapi.DatabaseError:
+            # the index already exists
+            self.handle.rollback()
+        self.handle.commit()
+
+    def server_cursor(self):
+        """
+        Returns a cursor that fetches rows from the server as they are read
+        instead of fetching the whole result of a query at once.
+        """
+
+        if self.module == "psycopg2":
+            return self.handle.cursor("%s_%x" % (self.table, id(self)))
+        elif self.module == "MySQLdb":
+            from MySQLdb.cursors import SSCursor
+            return self.handle.cursor(SSCursor)
+        # sqlite3 and oursql cursors already fetch rows as they are read
+        return self.handle.cursor()
+
+
+class SQLTableOutput(SQLTable):
+    """
+    Writes each dump as rows in a SQL table.  Rows are inserted with
+    executemany() in batches of batch_size, a dump is committed as a single
+    transaction.  The tuples of a dump are sorted by key before they are
+    numbered, dump_sorted() numbers tuples that are already sorted as they
+    are read.
+    """
+
+    _created = False
+
+    def _create(self):
+        if not self._created:
+            self.create_table()
+            self._created = True
+
+    def dump(self, key, tuples, task_id="", partition=0):
+        self.dump_sorted(key, sorted(tuples, key=lambda t: t[0]), task_id,
+                         partition)
+
+    def dump_sorted(self, key, tuples, task_id="", partition=0):
+        self._create()
+
+        dumps = SERIALIZERS["p"][0]
+        binary = self.dbapi.Binary
+        rows = ((task_id, partition, key, seq, binary(dumps(k)),
+                 binary(dumps(vs))) for seq, (k, vs) in enumerate(tuples))
+
+        insert = "INSERT INTO %s (task_id, part, run, seq, k, v) " \
+            "VALUES (%s, %s, %s, %s, %s, %s)" % \
+            ((self.table,) + (self.marker,) * 6)
+        cursor = self.handle.cursor()
+        try:
+            while True:
+                batch = list(itertools.islice(rows, self.batch_size))
+                if not batch:
+                    break
+                cursor.executemany(insert, batch)
+        except:
+            self.handle.rollback()
+            raise
+        self.handle.commit()
+
+    def remove(self, key, task_id="", partition=0):
+        cursor = self.handle.cursor()
+        cursor.execute("DELETE FROM %s WHERE task_id = %s AND part = %s "
+                       "AND run = %s" % ((self.table,) + (self.marker,) * 3),
+                       (task_id, partition, key))
+        self.handle.commit()
+
+    def remove_task(self, task_id):
+        """
+        Removes the rows of every dump of a task.
+        """
+
+        self._create()
+        cursor = self.handle.cursor()
+        cursor.execute("DELETE FROM %s WHERE task_id = %s" % \
+                       (self.table, self.marker), (task_id,))
+        self.handle.commit()
+
+
+class SQLTableKeyInput(SQLTable, MergeInput):
+    """
+    Reads the rows of the dumps of a partition.
+
+    Each dump listed in `input` is read in key order by its seq column, and
+    the dumps are merged by `MergeInput` so keys reach the reducer grouped
+    and in order, including equal keys such as 'a' and u'a'.  Rows of dumps
+    not listed in `input`, such as those of a failed map, are never read.
+    """
+
+    def __init__(self, db, table):
+        SQLTable.__init__(self, db, table)
+        self.input = []
+        self.task_id = ""
+        self.partition = 0
+
+    def read(self, key):
+        """
+        Iterates through the rows of a single dump in key order.  Rows are
+        fetched batch_size at a time once iteration starts, so a merge holds
+        no more than one batch of each of merge_factor dumps in memory.
+        """
+
+        loads = SERIALIZERS["p"][1]
+        select = "SELECT k, v FROM %s WHERE task_id = %s AND part = %s " \
+            "AND run = %s ORDER BY seq" % ((self.table,) + (self.marker,) * 3)
+        cursor = self.server_cursor()
+        try:
+            cursor.execute(select, (self.task_id, self.partition, key))
+            while True:
+                rows = cursor.fetchmany(self.batch_size)
+                if not rows:
+                    break
+                for k, vs in rows:
+                    yield loads(str(k)), loads(str(vs))
+        finally:
+            cursor.close()
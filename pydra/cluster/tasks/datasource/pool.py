@@ -0,0 +1,205 @@
+"""
+Connection pooling for datasource backends.
+
+Backends such as `SQLBackend` are created every time a datasource
+description is unpacked, so each workunit would open and authenticate a new
+connection.  Instead, a backend takes a connection from the pool of its
+process when it connects and gives it back when it disconnects, so the next
+backend with the same connection arguments reuses it, across workunits and
+tasks.
+"""
+
+from __future__ import with_statement
+
+import logging
+import os
+import time
+from threading import Lock
+
+logger = logging.getLogger('root')
+
+
+def close_handle(handle):
+    """
+    Closes a connection, if it can be closed.
+    """
+
+    close = getattr(handle, "close", None)
+    if close:
+        try:
+            close()
+        except Exception, e:
+            logger.debug("ConnectionPool - error closing connection: %s", e)
+
+
+class ConnectionPool(object):
+    """
+    Idle connections of a process, kept by a key made of the backend and its
+    connection arguments.
+
+    A connection idle for longer than `check_after` seconds is checked before
+    it is reused, and one idle for longer than `max_idle` seconds is closed.
+    Connections inherited by a forked process are shared with the parent, so
+    they are dropped without being closed.
+
+    Counts of connections made, reused, checked and closed are kept in
+    `stats`.
+    """
+
+    max_idle = 300
+    """Seconds an idle connection is kept before it is closed"""
+
+    check_after = 30
+    """Seconds a connection may be idle before it is checked on reuse"""
+
+    max_connections = 4
+    """Number of idle connections kept for each key"""
+
+    def __init__(self):
+        self._lock = Lock()
+        self._idle = {}
+        self._pid = os.getpid()
+        self.clock = time.time
+        self.stats = {
+            'connects':0,
+            'reuses':0,
+            'checks':0,
+            'failed_checks':0,
+            'expired':0,
+            'releases':0,
+            'closed':0
+        }
+
+    def acquire(self, key, connect, check=None):
+        """
+        Takes an idle connection for key, or makes a new one.
+
+        :Parameters:
+            key
+                hashable key of the backend and connection arguments
+            connect : callable
+                makes a new connection
+            check : callable
+                called with an idle connection that must be checked, raises
+                an exception if the connection is broken
+
+        :return: connection
+        """
+
+        while True:
+            with self._lock:
+                self._expire()
+                idle = self._idle.get(key)
+                if not idle:
+                    self.stats['connects'] += 1
+                    break
+                handle, released = idle.pop()
+                if not check or self.clock() - released <= self.check_after:
+                    self.stats['reuses'] += 1
+                    return handle
+                self.stats['checks'] += 1
+
+            # checking may take a round trip, so other backends are not kept
+            # waiting for the lock meanwhile
+            try:
+                check(handle)
+            except Exception, e:
+                logger.debug("ConnectionPool - %s failed check: %s",
+                             key[0], e)
+                with self._lock:
+                    self.stats['failed_checks'] += 1
+                    self.stats['closed'] += 1
+                close_handle(handle)
+                continue
+
+            with self._lock:
+                self.stats['reuses'] += 1
+            return handle
+
+        return connect()
+
+    def release(self, key, handle, reset=None):
+        """
+        Returns a connection to the pool so it can be reused.
+
+        :Parameters:
+            key
+                key the connection was acquired with
+            handle
+                connection
+            reset : callable
+                called with the connection to reset its state, such as
+                rolling back a transaction.  A connection that fails to reset
+                is closed.
+        """
+
+        if reset:
+            try:
+                reset(handle)
+            except Exception, e:
+                logger.debug("ConnectionPool - %s failed reset: %s", key[0], e)
+                self.discard(handle)
+                return
+
+        with self._lock:
+            self._expire()
+            self.stats['releases'] += 1
+            idle = self._idle.setdefault(key, [])
+            idle.append((handle, self.clock()))
+            if len(idle) > self.max_connections:
+                self.stats['closed'] += 1
+                close_handle(idle.pop(0)[0])
+
+    def discard(self, handle):
+        """
+        Closes a connection instead of returning it to the pool.
+        """
+
+        with self._lock:
+            self.stats['closed'] += 1
+        close_handle(handle)
+
+    def clear(self):
+        """
+        Closes every idle connection.
+        """
+
+        with self._lock:
+            for idle in self._idle.values():
+                for handle, released in idle:
+                    self.stats['closed'] += 1
+                    close_handle(handle)
+            self._idle = {}
+
+    def idle(self):
+        """
+        :return: number of idle connections
+        """
+
+        with self._lock:
+            return sum(len(idle) for idle in self._idle.values())
+
+    def _expire(self):
+        """
+        Closes connections idle for longer than max_idle, and drops the
+        connections inherited from a parent process.  Must be called with the
+        lock held.
+        """
+
+        if os.getpid() != self._pid:
+            self._pid = os.getpid()
+            self._idle = {}
+            return
+
+        oldest = self.clock() - self.max_idle
+        for key, idle in self._idle.items():
+            while idle and idle[0][1] < oldest:
+                self.stats['expired'] += 1
+                self.stats['closed'] += 1
+                close_handle(idle.pop(0)[0])
+            if not idle:
+                del self._idle[key]
+
+
+pool = ConnectionPool()
+"""Connection pool of this process, used by the backends by default"""
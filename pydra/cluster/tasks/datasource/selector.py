@@ -1,7 +1,10 @@
 import mmap
+import os
 import os.path
 
-from pydra.cluster.tasks.datasource.slicer import LineSlicer, CursorSlicer
+from pydra.cluster.tasks.datasource.intermediate import placeholder
+from pydra.cluster.tasks.datasource.slicer import LineSlicer, CursorSlicer, \
+    open_map, find_boundaries, range_lines
 
 class DirSelector(object):
     """
@@ -10,6 +13,7 @@ class DirSelector(object):
 
     def __init__(self, path, recursive=True):
         self.path = path
+        self.recursive = recursive
         if recursive:
             self.files = set()
             for directory, chaff, files in os.walk(self.path):
@@ -33,6 +37,15 @@ class DirSelector(object):
     def __len__(self):
         return len(self.files)
 
+    def plan(self, unit_size=None, sep="\n"):
+        """
+        Plans size-balanced workunits for the files in this directory.
+
+        :return: `FilePlanner` yielding `FileUnit` workunits
+        """
+
+        return FilePlanner(self.path, unit_size, self.recursive, sep)
+
 class FileSelector(object):
     """
     Selects files. Can yield file-based slicers.
@@ -55,6 +68,137 @@ class FileSelector(object):
         self._handle = m
         return m
 
+    def plan(self, unit_size=None, sep="\n"):
+        """
+        Plans workunits of at most `unit_size` bytes for this file.
+
+        :return: `FilePlanner` yielding `FileUnit` workunits
+        """
+
+        return FilePlanner(self.path, unit_size, sep=sep)
+
+def walk_files(path, recursive=True):
+    """
+    Yields the path and size of every file under a directory, as they are
+    found. A path naming a file yields only that file.
+    """
+
+    if not os.path.isdir(path):
+        yield path, os.path.getsize(path)
+        return
+
+    for directory, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(files):
+            filename = os.path.join(directory, name)
+            try:
+                size = os.path.getsize(filename)
+            except OSError:
+                # removed since it was listed
+                continue
+            yield filename, size
+        if not recursive:
+            break
+
+class FileUnit(object):
+    """
+    A workunit made of byte ranges of one or more files.
+
+    The estimated number of bytes in the unit is kept in `data_size`, which
+    `ParallelTask` passes to the scheduler with the request for a worker.
+    Workers receive the ranges as a list of [path, start, stop] lists, from
+    `transmitable()`, and read their lines with `unit_lines`.
+    """
+
+    def __init__(self, ranges=()):
+        self.ranges = []
+        self.data_size = 0
+        for path, start, stop in ranges:
+            self.add(path, start, stop)
+
+    def add(self, path, start, stop):
+        self.ranges.append([path, start, stop])
+        self.data_size += stop - start
+
+    def transmitable(self):
+        return self.ranges
+
+    def __iter__(self):
+        return iter(self.ranges)
+
+    def __len__(self):
+        return len(self.ranges)
+
+    def __repr__(self):
+        return 'FileUnit(%r)' % self.ranges
+
+def unit_lines(unit, sep="\n"):
+    """
+    Yields the lines of every range of a workunit made by `FilePlanner`,
+    either a `FileUnit` or the list of ranges a worker receives.
+    """
+
+    for path, start, stop in unit:
+        for line in range_lines(path, start, stop, sep):
+            yield line
+
+class FilePlanner(object):
+    """
+    Plans workunits of roughly equal size for a file or a directory tree.
+
+    Files are listed and stat'ed as the workunits are planned, so planning
+    starts without walking the whole tree first. Files larger than
+    `unit_size` are split into byte ranges, aligned to the start of a line
+    unless `sep` is None. Smaller files are packed together into units of up
+    to `unit_size` bytes, so many tiny files do not make many tiny workunits.
+    """
+
+    unit_size = 64 * 1024 * 1024
+    """Target number of bytes in a workunit"""
+
+    def __init__(self, path, unit_size=None, recursive=True, sep="\n"):
+        self.path = path
+        if unit_size is not None:
+            self.unit_size = unit_size
+        if self.unit_size < 1:
+            raise ValueError, "unit_size must be at least 1"
+        self.recursive = recursive
+        self.sep = sep
+
+    def __iter__(self):
+        unit = FileUnit()
+        for path, size in walk_files(self.path, self.recursive):
+            if size > self.unit_size:
+                for start, stop in self.split(path, size):
+                    yield FileUnit([(path, start, stop)])
+                continue
+
+            if unit and unit.data_size + size > self.unit_size:
+                yield unit
+                unit = FileUnit()
+            unit.add(path, 0, size)
+        if unit:
+            yield unit
+
+    def split(self, path, size):
+        """
+        Splits a large file into ranges of about `unit_size` bytes.
+
+        :return: list of (start, stop) tuples
+        """
+
+        ranges = -(-size // self.unit_size)
+        if self.sep is None:
+            boundaries = [size * i // ranges for i in xrange(ranges + 1)]
+        else:
+            m, size = open_map(path)
+            try:
+                boundaries = find_boundaries(m, size, ranges, self.sep)
+            finally:
+                if m is not None:
+                    m.close()
+        return zip(boundaries, boundaries[1:])
+
 class SQLSelector(object):
     """
     Selects rows from a SQL database, based on the given query.
@@ -85,9 +229,158 @@ class SQLSelector(object):
             cursor.execute(self.query)
         return CursorSlicer(cursor)
 
+def range_rows(handle, workunit, batch_size=None):
+    """
+    Yields the rows of a workunit made by `SQLRangeSelector`.
+
+    The worker running the workunit executes its query on its own
+    connection, and rows are fetched in batches with `fetchmany()`.
+
+    :Parameters:
+        handle
+            DBAPI connection, or a backend with a connection in `handle`
+        workunit : list
+            [query, params] of the key range
+        batch_size : int
+            rows fetched at a time
+    """
+
+    if hasattr(handle, "handle"):
+        handle = handle.handle
+    query, params = workunit
+    cursor = handle.cursor()
+    try:
+        cursor.execute(query, params)
+        for row in CursorSlicer(cursor, batch_size):
+            yield row
+    finally:
+        cursor.close()
+
+class SQLRangeSelector(object):
+    """
+    Selects rows from a SQL table in key ranges, one workunit per range.
+
+    The range boundaries are planned on the main worker: integer keys are
+    split evenly between their minimum and maximum, and other keys at
+    quantiles found by streaming the ordered keys. Each workunit is a
+    [query, params] list selecting one range with `key >= ? AND key < ?`
+    predicates, so it is run independently, and without LIMIT or OFFSET, by
+    the worker that gets it; read its rows with `range_rows`. Rows with a
+    NULL key are not selected.
+    """
+
+    ranges = 16
+    """Number of key ranges the table is split into when none is given"""
+
+    def __init__(self, db, table, key, ranges=None, columns="*", where=None,
+                 params=()):
+        """
+        :Parameters:
+            db
+                DBAPI connection, or a backend such as `SQLBackend`
+            table : str
+                table, or tables and joins, to select from
+            key : str
+                indexed column that the ranges are split on
+            ranges : int
+                number of ranges
+            columns : str
+                columns selected by each workunit
+            where : str
+                optional condition, with positional parameters
+            params : sequence
+                parameters of the condition
+        """
+
+        if hasattr(db, "handle"):
+            self.handle = db.handle
+        else:
+            self.handle = db
+        self.marker = placeholder(getattr(db, "dbapi", None))
+
+        if ranges is not None:
+            self.ranges = ranges
+        if self.ranges < 1:
+            raise ValueError, "ranges must be at least 1"
+        self.table = table
+        self.key = key
+        self.columns = columns
+        self.where = where
+        self.params = list(params)
+
+    def condition(self, *predicates):
+        """
+        Joins the user condition and range predicates into a WHERE clause.
+        """
+
+        conditions = ["%s IS NOT NULL" % self.key]
+        if self.where:
+            conditions.append("(%s)" % self.where)
+        conditions.extend(predicates)
+        return " WHERE " + " AND ".join(conditions)
+
+    def execute(self, query, params):
+        cursor = self.handle.cursor()
+        cursor.execute(query, params)
+        return cursor
+
+    def boundaries(self):
+        """
+        Finds the lower bound of each key range.
+
+        :return: sorted list of distinct keys
+        """
+
+        cursor = self.execute("SELECT MIN(%s), MAX(%s), COUNT(*) FROM %s%s" %
+            (self.key, self.key, self.table, self.condition()), self.params)
+        low, high, count = cursor.fetchone()
+        cursor.close()
+        if not count:
+            return []
+
+        if isinstance(low, (int, long)) and isinstance(high, (int, long)):
+            span = high - low + 1
+            bounds = [low + span * i // self.ranges
+                      for i in xrange(self.ranges)]
+        else:
+            # every step'th key starts a range
+            step = max(-(-count // self.ranges), 1)
+            cursor = self.execute("SELECT %s FROM %s%s ORDER BY %s" %
+                (self.key, self.table, self.condition(), self.key),
+                self.params)
+            bounds = [row[0] for i, row in enumerate(CursorSlicer(cursor))
+                      if not i % step]
+            cursor.close()
+
+        unique = []
+        for bound in bounds:
+            if not unique or bound != unique[-1]:
+                unique.append(bound)
+        return unique
+
+    def __iter__(self):
+        select = "SELECT %s FROM %s" % (self.columns, self.table)
+        lower = "%s >= %s" % (self.key, self.marker)
+        upper = "%s < %s" % (self.key, self.marker)
+
+        bounds = self.boundaries()
+        for i, low in enumerate(bounds):
+            if i + 1 < len(bounds):
+                yield [select + self.condition(lower, upper),
+                       self.params + [low, bounds[i + 1]]]
+            else:
+                yield [select + self.condition(lower), self.params + [low]]
+
+    def rows(self, workunit, batch_size=None):
+        """
+        Yields the rows of a workunit yielded by this selector.
+        """
+
+        return range_rows(self.handle, workunit, batch_size)
+
 
 try:
     from pydra.cluster.tasks.datasource.tokyo.selector import TokyoSelector, \
-    TokyoCondition
+    TokyoCondition, TokyoPrefixRanges, prefix_items
 except ImportError:
     pass
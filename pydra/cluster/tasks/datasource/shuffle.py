@@ -0,0 +1,475 @@
+"""
+Transport for MapReduce intermediate results kept on the local disk of the
+node that produced them.
+
+Every node runs a shuffle server that serves the segments in its shuffle
+directory.  Reducers pull the segments of their partition directly from the
+producing nodes with a `ShuffleFetcher`.
+
+The protocol is line based.  On connection the server sends a challenge,
+encrypted with the RSA key shared by the nodes of the cluster, which the
+client must answer before sending any request.  As in the handshake of
+`RSAAvatar`, only a client holding the private key can decrypt it:
+
+    CHALLENGE <encrypted challenge, hex encoded>
+    AUTH <sha512 of the challenge>  OK, or ERROR and the connection is closed
+
+A client then sends one request per line and waits for its response:
+
+    GET <name>          OK <size>, followed by size bytes of the segment
+    DELETE <name>       OK <count>, 1 if the segment was removed, 0 if it
+                        didn't exist
+
+Errors are returned as a line starting with ERROR.  A connection may be used
+for any number of requests.
+"""
+
+from __future__ import with_statement
+
+import binascii
+import hashlib
+import os
+import Queue
+import socket
+import time
+from threading import Lock, Thread
+
+from twisted.internet import protocol
+from twisted.protocols.basic import FileSender, LineReceiver
+from twisted.python.randbytes import secureRandom
+
+from pydra.config import load_settings
+load_settings()
+import pydra_settings
+from pydra.cluster.auth.rsa_auth import load_crypto
+
+import logging
+logger = logging.getLogger('root')
+
+
+COPY_SIZE = 65536
+"""Size of the reads used to copy a segment"""
+
+CHALLENGE_SIZE = 32
+"""Random bytes in the challenge of a connection"""
+
+
+def shuffle_dir():
+    """
+    Returns the directory of the segments served by this node
+    """
+    return getattr(pydra_settings, "SHUFFLE_DIR",
+                   "%s/shuffle" % pydra_settings.RUNTIME_FILES_DIR)
+
+
+def shuffle_port():
+    """
+    Returns the port the shuffle server of every node listens on
+    """
+    return getattr(pydra_settings, "SHUFFLE_PORT", 18802)
+
+
+def shuffle_key_path():
+    """
+    Returns the path of the RSA key shared by the nodes of the cluster
+    """
+    return getattr(pydra_settings, "SHUFFLE_KEY",
+                   "%s/shuffle.key" % pydra_settings.RUNTIME_FILES_DIR)
+
+
+def shuffle_key(create=False):
+    """
+    Loads the RSA key shared by the nodes of the cluster.
+
+    :Parameters:
+        create : bool
+            create the key if it doesn't exist
+
+    :returns: The private key, or None if it doesn't exist
+    """
+
+    pub, key = load_crypto(shuffle_key_path(), create)
+    return key
+
+
+def node_host(worker_key):
+    """
+    Returns the host of the node running a worker, as known by the master.
+    Workers not run by a node, such as a `WorkerProxy`, run on this host.
+    """
+
+    if ":" not in worker_key:
+        return "localhost"
+    return worker_key.rsplit(":", 2)[0]
+
+
+class ShuffleError(Exception):
+    """
+    Raised by a client when a request fails.
+    """
+
+
+class ShuffleFetchError(ShuffleError):
+    """
+    Raised by `ShuffleFetcher` when segments could not be fetched.  segments
+    is the list of (host, port, name) tuples that failed.
+    """
+
+    def __init__(self, segments):
+        ShuffleError.__init__(self, "Failed to fetch %d segments: %s" % \
+                              (len(segments), segments))
+        self.segments = segments
+
+
+def valid_name(name):
+    """
+    Segment names are plain file names within the shuffle directory.
+    """
+
+    return bool(name) and name == os.path.basename(name) \
+        and not name.startswith(".") and "\0" not in name
+
+
+def locate(host, port, name):
+    """
+    Returns the locator of a segment: the address of the node serving it and
+    its name.
+    """
+
+    return "%s:%d/%s" % (host, port, name)
+
+
+def parse_locator(locator):
+    """
+    :returns: (host, port, name) tuple of a locator
+    """
+
+    address, name = locator.split("/", 1)
+    host, port = address.rsplit(":", 1)
+    return host, int(port), name
+
+
+class ShuffleProtocol(LineReceiver):
+    """
+    Serves the segments of the shuffle directory of a node to clients that
+    answered its challenge.
+    """
+
+    authenticated = False
+    challenge = None
+
+    def connectionMade(self):
+        # the challenge is hex encoded so that the decrypted value has no
+        # leading zero bytes to lose
+        challenge = binascii.hexlify(secureRandom(CHALLENGE_SIZE))
+        self.challenge = hashlib.sha512(challenge).hexdigest()
+        encrypted = self.factory.key.encrypt(challenge, None)[0]
+        self.sendLine("CHALLENGE %s" % binascii.hexlify(encrypted))
+
+    def lineReceived(self, line):
+        command, _, argument = line.partition(" ")
+        if not self.authenticated:
+            self.authenticate(command, argument)
+            return
+
+        handler = getattr(self, "do_%s" % command, None)
+        if handler is None:
+            self.sendLine("ERROR Unknown command: %s" % command)
+        elif not valid_name(argument):
+            self.sendLine("ERROR Invalid name: %s" % argument)
+        else:
+            handler(argument)
+
+    def authenticate(self, command, response):
+        """
+        Checks the answer to the challenge.  The challenge is only answered
+        once, the connection is closed on failure.
+        """
+
+        challenge, self.challenge = self.challenge, None
+        if command != "AUTH" or challenge is None or response != challenge:
+            logger.warn("Shuffle - %s failed authentication" % \
+                        self.transport.getPeer().host)
+            self.sendLine("ERROR Authentication failed")
+            self.transport.loseConnection()
+            return
+
+        self.authenticated = True
+        self.sendLine("OK")
+
+    def do_GET(self, name):
+        path = os.path.join(self.factory.dir, name)
+        try:
+            f = open(path, "rb")
+        except IOError, e:
+            self.sendLine("ERROR %s" % e.strerror)
+            return
+
+        self.sendLine("OK %d" % os.fstat(f.fileno()).st_size)
+
+        # the client waits for the segment before sending another request
+        deferred = FileSender().beginFileTransfer(f, self.transport)
+        deferred.addErrback(lambda failure: logger.warn( \
+            "Shuffle - failed to send %s: %s" % (name, failure.value)))
+        deferred.addBoth(lambda result: f.close())
+
+    def do_DELETE(self, name):
+        path = os.path.join(self.factory.dir, name)
+        try:
+            os.remove(path)
+        except OSError, e:
+            if not os.path.exists(path):
+                self.sendLine("OK 0")
+            else:
+                self.sendLine("ERROR %s" % e.strerror)
+            return
+        logger.debug("Shuffle - deleted %s" % name)
+        self.sendLine("OK 1")
+
+
+class ShuffleFactory(protocol.ServerFactory):
+
+    protocol = ShuffleProtocol
+
+    def __init__(self, dir, key):
+        self.dir = dir
+        self.key = key
+
+
+class ShuffleConnection(object):
+    """
+    Blocking client connection to a shuffle server.  Used from the thread
+    running a reducer.  The connection is authenticated with key, the RSA
+    key shared by the nodes, once it is made.
+    """
+
+    def __init__(self, host, port, key, timeout=None):
+        self.sock = socket.create_connection((host, port), timeout)
+        self.file = self.sock.makefile("rb")
+        try:
+            self.authenticate(key)
+        except:
+            self.close()
+            raise
+
+    def authenticate(self, key):
+        """
+        Answers the challenge sent by the server.
+        """
+
+        command, _, challenge = self.readline().partition(" ")
+        if command != "CHALLENGE":
+            raise ShuffleError("Expected a challenge: %s" % command)
+        try:
+            challenge = key.decrypt(binascii.unhexlify(challenge))
+        except TypeError, e:
+            raise ShuffleError("Invalid challenge: %s" % e)
+        self.request("AUTH", hashlib.sha512(challenge).hexdigest())
+
+    def readline(self):
+        line = self.file.readline()
+        if not line.endswith("\r\n"):
+            raise ShuffleError("Connection closed")
+        return line[:-2]
+
+    def request(self, command, argument):
+        """
+        Sends a request.
+
+        :returns: The argument of the response
+        """
+
+        self.sock.sendall("%s %s\r\n" % (command, argument))
+        status, _, message = self.readline().partition(" ")
+        if status != "OK":
+            raise ShuffleError(message)
+        return message
+
+    def get(self, name, path):
+        """
+        Copies a segment to path.  The copy is written to a temporary file
+        and renamed once it is complete.
+
+        :returns: The size of the segment
+        """
+
+        size = int(self.request("GET", name))
+        remaining = size
+        tmp = "%s.tmp" % path
+        f = open(tmp, "wb")
+        try:
+            while remaining:
+                data = self.file.read(min(remaining, COPY_SIZE))
+                if not data:
+                    raise ShuffleError("Connection closed reading %s" % name)
+                f.write(data)
+                remaining -= len(data)
+        finally:
+            f.close()
+            if remaining:
+                os.remove(tmp)
+        os.rename(tmp, path)
+        return size
+
+    def delete(self, name):
+        """
+        :returns: 1 if the segment was deleted, 0 if it didn't exist
+        """
+
+        return int(self.request("DELETE", name))
+
+    def close(self):
+        self.file.close()
+        self.sock.close()
+
+
+class ShuffleFetcher(object):
+    """
+    Fetches segments from the shuffle servers of other nodes.
+
+    Segments are fetched by up to max_fetches threads at once, with at most
+    max_host_fetches connections to any one node so that a node serving many
+    segments is not overloaded.  A connection fetches its segments one after
+    the other.  A failed fetch is retried with a new connection after
+    waiting retry_delay seconds, longer after each attempt.
+
+    Connections are authenticated with key, which defaults to the key loaded
+    by `shuffle_key`.
+    """
+
+    max_fetches = 4
+    """Maximum number of segments fetched at once"""
+    max_host_fetches = 2
+    """Maximum number of connections to a single node"""
+    retries = 3
+    """Number of times a failed fetch is retried"""
+    retry_delay = 1.0
+    """Seconds waited before the first retry"""
+    timeout = 60
+    """Socket timeout in seconds"""
+
+    def __init__(self, key=None):
+        self.key = key
+        self._lock = Lock()
+        self.stats = {'segments':0, 'bytes':0, 'retries':0}
+
+    def get_key(self):
+        """
+        :returns: The key connections are authenticated with
+
+        :raises ShuffleError: if the shared key doesn't exist
+        """
+
+        if self.key is None:
+            self.key = shuffle_key()
+            if self.key is None:
+                raise ShuffleError("Missing shuffle key %s" % \
+                                   shuffle_key_path())
+        return self.key
+
+    def fetch(self, segments, dest):
+        """
+        Fetches segments into a directory.
+
+        :Parameters:
+            segments
+                list of (host, port, name) tuples
+            dest : str
+                directory the segments are copied to
+
+        :raises ShuffleFetchError: if some segments could not be fetched
+        """
+
+        if not segments:
+            return
+        key = self.get_key()
+
+        hosts = {}
+        for host, port, name in segments:
+            hosts.setdefault((host, port), []).append(name)
+
+        queue = Queue.Queue()
+        for address, names in hosts.iteritems():
+            connections = min(self.max_host_fetches, len(names))
+            for i in xrange(connections):
+                queue.put((address, names[i::connections]))
+
+        failed = []
+        threads = [Thread(target=self._fetch_queue,
+                          args=(queue, dest, key, failed)) \
+                   for i in xrange(min(self.max_fetches, queue.qsize()))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        if failed:
+            raise ShuffleFetchError(failed)
+
+    def _fetch_queue(self, queue, dest, key, failed):
+        while True:
+            try:
+                address, names = queue.get_nowait()
+            except Queue.Empty:
+                return
+            self._fetch_from(address, names, dest, key, failed)
+
+    def _fetch_from(self, address, names, dest, key, failed):
+        """
+        Fetches segments from one node over a single connection, retrying
+        failures on a new connection.
+        """
+
+        host, port = address
+        pending = list(names)
+        connection = None
+        attempt = 0
+        while pending:
+            name = pending[0]
+            try:
+                if connection is None:
+                    connection = ShuffleConnection(host, port, key,
+                                                   self.timeout)
+                size = connection.get(name, os.path.join(dest, name))
+            except (socket.error, ShuffleError), e:
+                if connection is not None:
+                    connection.close()
+                    connection = None
+
+                attempt += 1
+                if attempt > self.retries:
+                    logger.error("Shuffle - failed to fetch %s from %s:%s: %s" \
+                                 % (name, host, port, e))
+                    with self._lock:
+                        failed.extend((host, port, n) for n in pending)
+                    return
+
+                logger.warn("Shuffle - retrying %s from %s:%s (%d/%d): %s" % \
+                            (name, host, port, attempt, self.retries, e))
+                with self._lock:
+                    self.stats['retries'] += 1
+                time.sleep(self.retry_delay * attempt)
+                continue
+
+            pending.pop(0)
+            attempt = 0
+            with self._lock:
+                self.stats['segments'] += 1
+                self.stats['bytes'] += size
+
+        if connection is not None:
+            connection.close()
+
+
+def delete_segments(host, port, names, key, timeout=None):
+    """
+    Removes segments from a node.  Segments that don't exist are skipped.
+
+    :returns: The number of segments deleted
+    """
+
+    connection = ShuffleConnection(host, port, key, timeout)
+    try:
+        return sum(connection.delete(name) for name in names)
+    finally:
+        connection.close()
@@ -0,0 +1,219 @@
+"""
+Sinks for the output of a MapReduceTask.
+
+A sink is set as the output of a MapReduceTask.  Each reducer opens a writer
+for its partition and writes its results directly to the sink, only a small
+manifest entry describing the written partition is returned to the main
+worker.  A writer is closed once the reducer is done, or aborted if the
+reducer fails so a retried reduce doesn't find partial output.
+"""
+
+import os
+
+from pydra.cluster.tasks.datasource.intermediate import directory_path, \
+    placeholder
+
+
+def format_line(key, value):
+    """
+    Default format of the lines written by `FileSink`: key and value
+    separated by a tab.
+    """
+
+    return "%s\t%s\n" % (key, value)
+
+
+class FileSink(object):
+    """
+    Writes the output of each reducer to its own file in a directory.  The
+    directory must be reachable from every worker.
+    """
+
+    pattern = "part-%05d"
+
+    def __init__(self, dir, formatter=format_line):
+        """
+        :Parameters:
+            dir
+                path, or selector with a path, of the output directory
+            formatter : callable
+                returns the line written for a key and value
+        """
+
+        self.dir = dir
+        self.formatter = formatter
+
+    def open(self, partition):
+        """
+        :returns: A writer for the output of a partition
+        """
+
+        path = os.path.join(directory_path(self.dir), self.pattern % partition)
+        return FileSinkWriter(self, partition, path)
+
+    def finish(self, manifest):
+        """
+        Called on the main worker once every partition is written.
+
+        :returns: The manifest of the written partitions
+        """
+
+        return sorted(manifest, key=lambda entry: entry["partition"])
+
+
+class FileSinkWriter(object):
+    """
+    Writes the output of one partition.  Output is written to a temporary
+    file that is renamed into place when the writer is closed, and removed
+    if the writer is aborted.
+    """
+
+    def __init__(self, sink, partition, path):
+        self.sink = sink
+        self.partition = partition
+        self.path = path
+        self.records = 0
+
+        self._tmp = "%s.tmp" % path
+        self._file = open(self._tmp, "wb")
+
+    def __setitem__(self, key, value):
+        self._file.write(self.sink.formatter(key, value))
+        self.records += 1
+
+    def close(self):
+        """
+        :returns: The manifest entry for the partition
+        """
+
+        self._file.close()
+        os.rename(self._tmp, self.path)
+        return {
+            "partition": self.partition,
+            "path": self.path,
+            "records": self.records,
+            "bytes": os.path.getsize(self.path),
+        }
+
+    def abort(self):
+        """
+        Discards the output written so far.
+        """
+
+        self._file.close()
+        if os.path.exists(self._tmp):
+            os.remove(self._tmp)
+
+
+class SQLSink(object):
+    """
+    Inserts the output of every reducer into a SQL table.  Rows are inserted
+    in batches with executemany().  The table must already exist.
+
+    The output of a partition is written in a single transaction, which is
+    rolled back if the reducer fails.  If the table has columns for the job
+    and the partition, the rows of the partition written by the same job are
+    also deleted before it is written, so a reduce retried after its output
+    was committed doesn't insert them twice.  Rows of other jobs sharing the
+    table are left alone.
+
+    db is a `SQLBackend`, each reducer uses the connection of the backend in
+    its worker.
+    """
+
+    def __init__(self, db, table, columns=("k", "v"), batch_size=1000,
+                 partition_column=None, job_column=None, job=None):
+        """
+        :Parameters:
+            db
+                `SQLBackend` of the database
+            table : str
+                name of the output table
+            columns : tuple
+                names of the key and value columns
+            batch_size : int
+                number of rows inserted at a time
+            partition_column : str
+                name of the column the partition of each row is written to,
+                or None if the table has none
+            job_column : str
+                name of the column the job of each row is written to,
+                required with partition_column
+            job
+                value identifying the job in job_column, unique to each run
+                of the task writing to the table
+        """
+
+        if partition_column and not job_column:
+            raise ValueError("partition_column requires a job_column")
+
+        self.db = db
+        self.table = table
+        self.columns = columns
+        self.batch_size = batch_size
+        self.partition_column = partition_column
+        self.job_column = job_column
+        self.job = job
+
+    def open(self, partition):
+        return SQLSinkWriter(self, partition)
+
+    def finish(self, manifest):
+        return sorted(manifest, key=lambda entry: entry["partition"])
+
+
+class SQLSinkWriter(object):
+    """
+    Writes the output of one partition to the table of a `SQLSink`.
+    """
+
+    def __init__(self, sink, partition):
+        self.sink = sink
+        self.partition = partition
+        self.records = 0
+
+        self.handle = getattr(sink.db, "handle", sink.db)
+        marker = placeholder(getattr(sink.db, "dbapi", None))
+        columns = tuple(sink.columns)
+        if sink.partition_column:
+            columns += (sink.job_column, sink.partition_column)
+            cursor = self.handle.cursor()
+            cursor.execute("DELETE FROM %s WHERE %s = %s AND %s = %s" % \
+                           (sink.table, sink.job_column, marker,
+                            sink.partition_column, marker),
+                           (sink.job, partition))
+        self.insert = "INSERT INTO %s (%s) VALUES (%s)" % \
+            (sink.table, ", ".join(columns), ", ".join([marker] * len(columns)))
+        self._rows = []
+
+    def __setitem__(self, key, value):
+        if self.sink.partition_column:
+            self._rows.append((key, value, self.sink.job, self.partition))
+        else:
+            self._rows.append((key, value))
+        if len(self._rows) >= self.sink.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self._rows:
+            cursor = self.handle.cursor()
+            cursor.executemany(self.insert, self._rows)
+            self.records += len(self._rows)
+            self._rows = []
+
+    def close(self):
+        self.flush()
+        self.handle.commit()
+        return {
+            "partition": self.partition,
+            "table": self.sink.table,
+            "records": self.records,
+        }
+
+    def abort(self):
+        """
+        Rolls back the rows written so far.
+        """
+
+        self._rows = []
+        self.handle.rollback()
@@ -1,4 +1,6 @@
 import cStringIO
+import mmap
+import os
 
 class IterSlicer(object):
     """
@@ -18,14 +20,17 @@ class IterSlicer(object):
 class CursorSlicer(IterSlicer):
     """
     Slicer that operates on DBAPI cursors.
+
+    Rows are fetched with `fetchmany()` when the cursor has it, so they are
+    read from the database in batches rather than one at a time.
     """
 
-    def __init__(self, cursor):
+    def __init__(self, cursor, batch_size=None):
         self.cursor = cursor
-        if hasattr(cursor, "__iter__"):
-            self.state = iter(cursor)
+        if hasattr(cursor, "fetchmany") or not hasattr(cursor, "__iter__"):
+            self.state = CursorDumbSlicer(cursor, batch_size)
         else:
-            self.state = CursorDumbSlicer(cursor)
+            self.state = iter(cursor)
 
 class CursorDumbSlicer(object):
 
@@ -35,13 +40,29 @@ class CursorDumbSlicer(object):
     Strictly speaking, this is optional in the DBAPI spec.
     """
 
-    def __init__ (self, cursor):
+    batch_size = 1000
+    """Rows fetched from the cursor at a time, if it supports fetchmany()"""
+
+    def __init__ (self, cursor, batch_size=None):
         self.cursor = cursor
+        if batch_size is not None:
+            self.batch_size = batch_size
+        self._rows = iter(())
 
     def __iter__(self):
         return self
 
     def next(self):
+        try:
+            return next(self._rows)
+        except StopIteration:
+            pass
+        if hasattr(self.cursor, "fetchmany"):
+            rows = self.cursor.fetchmany(self.batch_size)
+            if not rows:
+                raise StopIteration
+            self._rows = iter(rows)
+            return next(self._rows)
         item = self.cursor.fetchone()
         if item is None:
             raise StopIteration
@@ -56,25 +77,18 @@ class MapSlicer(IterSlicer):
 
     pass
 
-def mma(old, new, weight):
-    """
-    Performs a Moving Modified Average, using the old value, new value,
-    and a weight.
-
-    Weight must be greater than zero.
-
-    Borrowed from public-domain code by Corbin Simpson
-    http://github.com/MostAwesomeDude/madsnippets
-    """
-
-    return ((weight - 1) * old + new) / weight
-
 
 class LineSlicer(IterSlicer):
     """
     Slicer specialized for handling text blobs.
+
+    Yields the position of each separator, so a workunit is a single line.
+    `LineRangeSlicer` splits large files into ranges of many lines instead.
     """
 
+    max_read = 1048576
+    """Largest read, in bytes, made while looking for a separator"""
+
     def __init__(self, handle, sep="\n"):
         if not hasattr(handle, "read"):
             handle = cStringIO.StringIO(handle)
@@ -112,18 +126,22 @@ class LineSlicer(IterSlicer):
     def find_sep(self):
         position = self.handle.tell()
         count = 80
-        s = ""
+        # Only the new chunk and the end of the previous one are searched,
+        # and the chunks double in size, so long lines are scanned in linear
+        # time
+        tail = ""
         temp = self.handle.read(count)
         while temp:
-            s += temp
+            s = tail + temp
             index = s.find(self.sep)
             if index != -1:
+                index += position - len(tail)
                 # Update file handle
-                self.handle.seek(position + index + 1)
-                # Update approximate count
-                count = mma(count, index, 100)
-
-                return position + index
+                self.handle.seek(index + 1)
+                return index
+            position += len(temp)
+            tail = s[len(s) - len(self.sep) + 1:]
+            count = min(count * 2, self.max_read)
             temp = self.handle.read(count)
         # EOF
         return None
@@ -142,3 +160,153 @@ class LineSlicer(IterSlicer):
         else:
             self._state = value
         self.handle.seek(self._state + 1)
+
+
+def open_map(handle):
+    """
+    Maps a file read-only into memory.
+
+    :Parameters:
+        handle : file or str
+            open file or path of the file
+
+    :return: tuple(mmap, size), with a mmap of None for an empty file
+    """
+
+    if hasattr(handle, "fileno"):
+        fd = handle.fileno()
+        size = os.fstat(fd).st_size
+        if not size:
+            return None, 0
+        return mmap.mmap(fd, size, access=mmap.ACCESS_READ), size
+
+    h = open(handle, "rb")
+    try:
+        return open_map(h)
+    finally:
+        h.close()
+
+def find_boundaries(m, size, ranges, sep="\n"):
+    """
+    Finds the offsets splitting a mapped file into line-aligned byte ranges.
+
+    The file is cut at `ranges - 1` evenly spaced offsets, and each cut is
+    moved forward to the start of the next line by searching the map, so only
+    a line or so is scanned per cut. Ranges holding no complete line are
+    dropped, so there may be fewer ranges than asked for.
+
+    :Parameters:
+        m : mmap
+            mapped file, or None if the file is empty
+        size : int
+            size of the file
+        ranges : int
+            number of ranges wanted
+
+    :return: list of offsets, starting with 0 and ending with `size`
+    """
+
+    if not size:
+        return []
+
+    boundaries = [0]
+    for i in xrange(1, ranges):
+        offset = max(size * i // ranges - len(sep), boundaries[-1])
+        index = m.find(sep, offset)
+        if index == -1:
+            break
+        offset = index + len(sep)
+        if offset >= size:
+            break
+        if offset > boundaries[-1]:
+            boundaries.append(offset)
+    boundaries.append(size)
+    return boundaries
+
+def range_lines(handle, start, stop, sep="\n"):
+    """
+    Yields the lines of a byte range of a file, as made by `LineRangeSlicer`.
+
+    Lines keep their separator, like the lines of a file. The file is mapped
+    into memory, so a range is read without copying the rest of the file.
+
+    :Parameters:
+        handle : file or str
+            open file or path of the file
+        start : int
+            offset of the first line of the range
+        stop : int
+            offset just after the last line of the range
+    """
+
+    m, size = open_map(handle)
+    if m is None:
+        return
+    try:
+        stop = min(stop, size)
+        position = start
+        while position < stop:
+            index = m.find(sep, position, stop)
+            if index == -1:
+                yield m[position:stop]
+                break
+            end = index + len(sep)
+            yield m[position:end]
+            position = end
+    finally:
+        m.close()
+
+class LineRangeSlicer(IterSlicer):
+    """
+    Slicer splitting a file into byte ranges of whole lines.
+
+    Each range is a workunit, yielded as a (start, stop) tuple of byte
+    offsets; the workunit reads its lines with `range_lines`. Only the
+    file size and the lines around each cut are read to plan the ranges, so
+    splitting a file of many gigabytes is quick.
+    """
+
+    default_ranges = 64
+    """Number of ranges a file is split into when none is given"""
+
+    def __init__(self, handle, ranges=None, sep="\n"):
+        """
+        :Parameters:
+            handle : file or str
+                open file or path of the file
+            ranges : int
+                number of ranges, by default `default_ranges`
+        """
+
+        if ranges is None:
+            ranges = self.default_ranges
+        if ranges < 1:
+            raise ValueError, "ranges must be at least 1"
+
+        self.handle = handle
+        self.sep = sep
+
+        m, size = open_map(handle)
+        try:
+            boundaries = find_boundaries(m, size, ranges, sep)
+        finally:
+            if m is not None:
+                m.close()
+
+        self.size = size
+        self.ranges = zip(boundaries, boundaries[1:])
+        IterSlicer.__init__(self, self.ranges)
+
+    def __len__(self):
+        return len(self.ranges)
+
+    def __getitem__(self, index):
+        return self.ranges[index]
+
+    def lines(self, workunit):
+        """
+        Yields the lines of a range yielded by this slicer.
+        """
+
+        start, stop = workunit
+        return range_lines(self.handle, start, stop, self.sep)
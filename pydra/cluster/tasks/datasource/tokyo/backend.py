@@ -1,13 +1,30 @@
 import pyrant
 
+from pydra.cluster.tasks.datasource.pool import pool
+
+
+def check_tyrant(handle):
+    """
+    Checks that a Tyrant connection still works.
+    """
+
+    len(handle)
+
 
 class TokyoBackend(object):
     """
     Backend for interfacing with Tokyo Cabinet databases (through Tyrant).
+
+    Connections are taken from the connection pool of the process and given
+    back to it on disconnect.
     """
 
     handle = None
 
+    pool = pool
+    """`ConnectionPool` connections are shared through, or None to drop
+    each connection on disconnect"""
+
     def __init__(self, host='127.0.0.1', port=1978, separator=None, literal=False):
         """
         Initialize the backend.
@@ -23,6 +40,7 @@ class TokyoBackend(object):
             if v is None:
                 del self.kwargs[k]
 
+        self._key = None
         self.connect()
 
     def __del__(self):
@@ -36,13 +54,23 @@ class TokyoBackend(object):
         if not self.handle:
             argnew = self.kwargs.copy()
             argnew.update(kwargs)
-            self.handle = pyrant.Tyrant(*args, **argnew)
+            if self.pool is not None and not args:
+                self._key = ("tokyo", tuple(sorted(argnew.items())))
+                self.handle = self.pool.acquire(self._key,
+                    lambda: pyrant.Tyrant(**argnew), check_tyrant)
+            else:
+                self._key = None
+                self.handle = pyrant.Tyrant(*args, **argnew)
 
     def disconnect(self):
         """
         Disconnect from the current database, if connected.
+
+        A pooled connection is returned to the pool.
         """
 
+        if self.handle and self._key:
+            self.pool.release(self._key, self.handle)
         self.handle = None
 
     @property
@@ -1,3 +1,5 @@
+import itertools
+
 import pyrant.query
 
 
@@ -20,6 +22,9 @@ class TokyoSelector(object):
 
     delayable = True
 
+    chunk_size = 1000
+    """Records fetched with each multi_get() of a prefix scan"""
+
     def __init__(self, db, *args):
 
         if hasattr(db, "handle"):
@@ -57,12 +62,130 @@ class TokyoSelector(object):
             return iter(self.handle.query.filter(*self.query))
 
         if prefix:
-            keys = self.handle.prefix_keys(self.query[0].expr)
-            return iter(self.handle.multi_get(keys))
+            return chunked_items(self.handle,
+                self.handle.prefix_keys(self.query[0].expr), self.chunk_size)
         else:
             raise ValueError, "only 'startswith' conditions work with non-table databases"
 
 
+def chunked_items(handle, keys, chunk_size=None):
+    """
+    Yields the records of keys, fetching them with one multi_get() per chunk
+    of keys, so only a chunk of records is held in memory.
+    """
+
+    if chunk_size is None:
+        chunk_size = TokyoSelector.chunk_size
+    for start in xrange(0, len(keys), chunk_size):
+        for item in handle.multi_get(keys[start:start + chunk_size]):
+            yield item
+
+def prefix_items(db, workunit, chunk_size=None):
+    """
+    Yields the records of a workunit made by `TokyoPrefixRanges`.
+
+    :Parameters:
+        db
+            Tyrant connection, or a `TokyoBackend`
+        workunit : list
+            [prefix, pieces] of the sub-prefix range
+        chunk_size : int
+            records fetched with each multi_get()
+    """
+
+    handle = getattr(db, "handle", db)
+    prefix, pieces = workunit
+    for suffix, scan in pieces:
+        key = prefix + suffix
+        if scan:
+            for item in chunked_items(handle, handle.prefix_keys(key),
+                                      chunk_size):
+                yield item
+        else:
+            value = handle.get(key)
+            if value is not None:
+                yield key, value
+
+class TokyoPrefixRanges(object):
+    """
+    Splits a key prefix scan into sub-prefix ranges, one workunit per range.
+
+    The keys with the prefix are grouped by the character following the
+    prefix. A group of more than `unit_keys` keys is split again on the
+    next character, until every group fits in a workunit. Consecutive
+    groups are then packed into ranges of at most `unit_keys` keys.
+
+    Each workunit is a [prefix, pieces] list. Each piece is a [suffix, scan]
+    pair. If scan is set, the piece covers every key starting with the
+    prefix followed by the suffix. Otherwise it covers only the key equal
+    to the prefix followed by the suffix. A worker reads the records of its
+    range with `prefix_items`, independently of the other ranges.
+
+    Only the keys are read to plan the ranges; records are fetched by the
+    workers, in chunks.
+    """
+
+    unit_keys = 10000
+    """Number of keys planned for each workunit"""
+
+    def __init__(self, db, prefix, unit_keys=None):
+
+        if hasattr(db, "handle"):
+            self.handle = db.handle
+        else:
+            self.handle = db
+
+        self.prefix = prefix
+        if unit_keys is not None:
+            self.unit_keys = unit_keys
+        if self.unit_keys < 1:
+            raise ValueError, "unit_keys must be at least 1"
+
+    def groups(self):
+        """
+        Splits the keys with the prefix into groups of at most unit_keys
+        keys.
+
+        :return: list of (suffix, scan, count) in key order
+        """
+
+        groups = []
+        keys = sorted(self.handle.prefix_keys(self.prefix))
+        self._split(keys, len(self.prefix), groups)
+        return groups
+
+    def _split(self, keys, depth, groups):
+        """
+        Groups sorted keys sharing their first depth characters by the
+        character that follows, splitting groups that are too large.
+        """
+
+        start = len(self.prefix)
+        if keys and len(keys[0]) == depth:
+            # the shared characters are a key themselves
+            groups.append((keys[0][start:], False, 1))
+            keys = keys[1:]
+        for c, group in itertools.groupby(keys, lambda key: key[depth]):
+            group = list(group)
+            if len(group) > self.unit_keys:
+                self._split(group, depth + 1, groups)
+            else:
+                groups.append((group[0][start:depth + 1], True, len(group)))
+
+    def __iter__(self):
+        pieces = []
+        size = 0
+        for suffix, scan, count in self.groups():
+            if pieces and size + count > self.unit_keys:
+                yield [self.prefix, pieces]
+                pieces = []
+                size = 0
+            pieces.append([suffix, scan])
+            size += count
+        if pieces:
+            yield [self.prefix, pieces]
+
+
 class TokyoCondition(pyrant.query.Condition):
     """
     Representation of a query condition. Maps lookups to protocol constants.
@@ -1,13 +1,26 @@
 from __future__ import with_statement
 
+from bisect import bisect_left
+from itertools import chain, islice
 from threading import Lock
 import logging
+import os
+import random
+import shutil
+import tempfile
 
 from twisted.internet import reactor, threads
 
 from tasks import Task, TaskNotFoundException, \
     STATUS_RUNNING, STATUS_COMPLETE
-# from pydra.cluster.tasks.datasource import *
+from pydra.cluster.tasks.datasource.intermediate import FileRunOutput, \
+    FileRunInput, FilePickleOutput, FileUnpicleSubslicer, SQLTableOutput, \
+    SQLTableKeyInput, combine_groups, directory_path, encode_run, \
+    group_values, iter_run, merge_runs
+from pydra.cluster.tasks.datasource.shuffle import ShuffleFetcher, \
+    delete_segments, locate, node_host, parse_locator, shuffle_dir, \
+    shuffle_port
+from pydra.util import makedirs
 
 logger = logging.getLogger('root')
 
@@ -33,6 +46,122 @@ class AppendableDict(dict):
         super(AppendableDict, self).__getitem__(key).append(value)
 
 
+def is_sink(output):
+    """returns whether the output of a MapReduceTask is a sink"""
+    return hasattr(output, 'open') and hasattr(output, 'finish')
+
+
+class HashPartitioner(object):
+    """Partitions keys by their hash.
+
+    str, unicode and int keys are hashed directly.  Other keys are formatted
+    with str() first so their hash is the same on every worker."""
+
+    needs_sample = False
+
+    hashed_types = (str, unicode, int, long)
+
+    def partition(self, key, reducers):
+        if type(key) not in self.hashed_types:
+            key = str(key)
+        return hash(key) % reducers
+
+    def state(self):
+        """returns the state needed by maps to partition keys"""
+        return None
+
+    def load(self, state):
+        pass
+
+
+class RangePartitioner(HashPartitioner):
+    """Partitions keys into ranges so each partition holds a contiguous,
+    sorted range of keys.
+
+    Ranges are built from a sample of map output so each partition receives
+    about the same number of values: dense ranges of keys are split across
+    several reducers.  A key holding more than a reducer's share of the
+    values in the sample (a heavy hitter) can't be split since it must be
+    reduced once, so it is given a partition of its own.
+
+    Range boundaries are sent to maps with their args, so keys must be JSON
+    serializable.  Tuple keys are converted back from JSON lists."""
+
+    needs_sample = True
+
+    sample_maps = 4
+    """Number of map inputs sampled before the map stage"""
+    sample_size = 1000
+    """Maximum number of keys sampled from each map"""
+
+    def __init__(self):
+        self.boundaries = None
+        self.heavy_hitters = []
+
+    def sample(self, output):
+        """returns a sample of (key, weight) pairs from the output of a map,
+        the weight of a key is its number of values"""
+
+        items = [(k, len(vs)) for k, vs in output.iteritems()]
+        if len(items) <= self.sample_size:
+            return items
+
+        scale = float(len(items)) / self.sample_size
+        return [(k, weight * scale) for k, weight \
+                in random.sample(items, self.sample_size)]
+
+    def build(self, sample, reducers):
+        """builds range boundaries for reducers from (key, weight) pairs"""
+
+        weights = {}
+        for k, weight in sample:
+            weights[k] = weights.get(k, 0) + weight
+        if not weights:
+            self.boundaries = []
+            return
+
+        share = float(sum(weights.itervalues())) / reducers
+        self.heavy_hitters = []
+        boundaries = []
+        total = 0
+        previous = None
+        for k in sorted(weights):
+            if len(boundaries) == reducers - 1:
+                break
+            weight = weights[k]
+            if weight >= share:
+                self.heavy_hitters.append(k)
+                # close the partition before the heavy hitter
+                if total and len(boundaries) < reducers - 2:
+                    boundaries.append(previous)
+                    total = 0
+            total += weight
+            if total >= share:
+                boundaries.append(k)
+                total = 0
+            previous = k
+
+        self.boundaries = boundaries
+
+    def partition(self, key, reducers):
+        return bisect_left(self.boundaries, key)
+
+    def state(self):
+        return self.boundaries
+
+    def load(self, state):
+        # JSON turns tuple keys into lists, which don't compare with tuples
+        self.boundaries = [_tuples(k) for k in state]
+
+
+def _tuples(value):
+    """converts lists, and the lists in them, back into tuples"""
+
+    if isinstance(value, list):
+        return tuple(_tuples(v) for v in value)
+    return value
+
+
 class IntermediateResults(object):
     """Datahandler for not direct input/output handling.
 
@@ -57,7 +186,15 @@ class IntermediateResults(object):
       partition;
     * load() returns iterator which is used as a input iterator
       for a reduce task (subslicers);
-    * iterator loads (key, values) tuples from a backend.
+    * iterator merges the sorted dumps of the partition from a backend and
+      generates one (key, iterator of values) tuple per key, in key order.
+
+    in memory shuffle:
+    * hold() encodes the partitions of a map output as runs which are
+      returned to the main worker instead of being dumped;
+    * update_held() keeps the runs in memory on the main worker;
+    * held runs are reduced by the main worker, or spill() dumps them to the
+      backend when they take too much memory.
     """
 
     # mapreduce-i9e-(taks_id)-(partition)-(map_id)
@@ -67,19 +204,40 @@ class IntermediateResults(object):
     def __init__(self):
         self.task_id = "mapreduce_task"
         self.reducers = 1
+        # task running on the worker using the intermediate results
+        self.parent = None
 
         self._partitions = {}
+        self._held = {}
+        self.held_bytes = 0
+        self.stats = {}
+
+        self.partitioner = HashPartitioner()
 
         self.map_output = None
         self.reduce_input = None
 
     def clear(self):
+        """removes all dumps from the backend"""
+
+        if hasattr(self.map_output, 'remove'):
+            for keys in self._partitions.itervalues():
+                for key in keys:
+                    self.map_output.remove(key)
+        self._forget()
+
+
+    def _forget(self):
+        """forgets the dumps and held runs of all partitions"""
         self._partitions.clear()
+        self._held.clear()
+        self.held_bytes = 0
+        self.stats.clear()
 
 
     def partition(self, key):
         """partition key depending on a number of a reducers"""
-        return hash(str(key)) % self.reducers
+        return self.partitioner.partition(key, self.reducers)
 
 
     def partition_output(self, output):
@@ -105,24 +263,128 @@ class IntermediateResults(object):
         """updates partition-dictionary for future iterator generation."""
 
         for p, filename in partitions.items():
+            if isinstance(filename, (tuple, list)):
+                # dumped by a map along with its size
+                filename, records, values = filename
+                self._count(p, records, values)
+
             if p in self._partitions:
                 self._partitions[p].append(filename)
             else:
                 self._partitions[p] = [filename]
 
 
+    def _count(self, p, records, values):
+        stats = self.stats.setdefault(p, {'dumps':0, 'records':0, 'values':0})
+        stats['dumps'] += 1
+        stats['records'] += records
+        stats['values'] += values
+
+
+    def update_held(self, runs):
+        """keeps the runs returned by a map in memory.  runs is the
+        partitions-dictionary returned by hold()"""
+
+        for p, (run, records, values) in runs.items():
+            self._count(p, records, values)
+            self._held.setdefault(p, []).append(run)
+            self.held_bytes += len(run)
+
+
+    def held_runs(self, p):
+        """returns the runs of partition p held in memory"""
+        return self._held.get(p, [])
+
+
+    def spill(self):
+        """dumps the runs held in memory to the backend, one dump per
+        partition.  returns the number of bytes spilled."""
+
+        spilled = self.held_bytes
+        for p, runs in sorted(self._held.items()):
+            key = self.pattern % (self.task_id, p, 'spill%d' % \
+                                  len(self._partitions.get(p, [])))
+            tuples = combine_groups(merge_runs([iter_run(r) for r in runs]))
+            self.update_partitions({p: self._dump_run(p, key, tuples)})
+        self._held.clear()
+        self.held_bytes = 0
+        return spilled
+
+
+    def partition_stats(self):
+        """returns the sizes of the partitions dumped by maps and the skew
+        of the partitions: the largest partition's share of values relative
+        to the mean"""
+
+        values = [s['values'] for s in self.stats.itervalues()]
+        if values and sum(values):
+            skew = max(values) / (float(sum(values)) / len(values))
+        else:
+            skew = 1.0
+        return {'partitions':dict(self.stats), 'skew':skew}
+
+
+    def take_runs(self, minimum):
+        """removes the dumps of partitions that have at least minimum dumps
+        so they can be merged.  At most the merge factor of the reduce
+        input are taken from each partition.  returns a list of
+        (partition, keys) tuples."""
+
+        maximum = getattr(self.reduce_input, 'merge_factor', None)
+        taken = []
+        for p, keys in self._partitions.items():
+            if len(keys) >= minimum:
+                taken.append((p, keys[:maximum]))
+                self._partitions[p] = keys[maximum:] if maximum else []
+        return taken
+
+
+    def merge(self, p, keys, mergeid):
+        """merges dumps of a partition into a single dump, removing the
+        merged dumps.  returns corresponding partitions-dictionary"""
+
+        key = self.pattern % (self.task_id, p, mergeid)
+        runs = [self.reduce_input.read(k) for k in keys]
+        self.map_output.dump_sorted(key, combine_groups(merge_runs(runs)))
+
+        if hasattr(self.map_output, 'remove'):
+            for k in keys:
+                self.map_output.remove(k)
+
+        return {p: key}
+
+
     def __iter__(self):
         return self._partitions.itervalues()
 
 
-    def load(self, key):
+    def partitions(self):
+        """returns (partition, keys) tuples in partition order.  Partitions
+        only held in memory have no keys."""
+        ps = set(self._partitions) | set(self._held)
+        return [(p, self._partitions.get(p, [])) for p in sorted(ps)]
+
+
+    def load(self, key, partition=None, runs=None):
+        """returns an iterator over the dumps listed in key, the dumps of
+        partition.  runs are the runs of the partition held in memory, as
+        returned by held_runs(), they are read instead of the dumps."""
+        if runs is not None:
+            return self.load_held(runs)
         self.reduce_input.input = key
         return self.reduce_input
 
 
+    def load_held(self, runs):
+        """returns an iterator merging runs returned by held_runs()"""
+        runs = [iter_run(run) for run in runs]
+        return group_values(merge_runs(runs))
+
+
     def dump(self, pdict, mapid):
         """dumps a dictionary to a backend.
-        returns corresponding partitions-dictionary"""
+        returns corresponding partitions-dictionary, with the number of
+        records and values dumped to each partition"""
 
         logger.debug("im: dumping %s" % str(pdict))
 
@@ -131,28 +393,224 @@ class IntermediateResults(object):
         for p, tuples in pdict:
 
             key = self.pattern % (self.task_id, p, mapid)
-            partitions[p] = key
 
             logger.debug("im: dumping %s to %s" % (str(tuples), key))
 
-            self.map_output.dump(key, tuples)
+            key = self._dump_run(p, key, tuples)
+            partitions[p] = (key, len(tuples),
+                             sum(len(vs) for k, vs in tuples))
 
         return partitions
 
 
+    def _dump_run(self, p, key, tuples):
+        """writes the tuples of partition p to the backend.  returns the key
+        the dump is listed under in the partitions-dictionary"""
+        self.map_output.dump(key, tuples)
+        return key
+
+
+    def _remove_run(self, p, key):
+        """removes a dump of partition p written by _dump_run() on this
+        worker, key is the key it was dumped to"""
+        if hasattr(self.map_output, 'remove'):
+            self.map_output.remove(key)
+
+
+    def hold(self, pdict):
+        """encodes a partitioned map output as runs which are returned to
+        the main worker instead of being dumped.  returns a
+        partitions-dictionary of the runs and the number of records and
+        values in each of them.  Runs are compressed like the dumps of the
+        backend."""
+
+        codec = getattr(self.map_output, 'compression', None)
+        runs = {}
+        for p, tuples in pdict:
+            runs[p] = (encode_run(tuples, codec), len(tuples),
+                       sum(len(vs) for k, vs in tuples))
+        return runs
+
+
 class IntermediateResultsFiles(IntermediateResults):
-    """Storing intermediate results in flat files."""
+    """Storing intermediate results in flat files.
+
+    dir is a path or a selector with a path, it must be reachable from
+    every worker.  Each dump is written as a binary run of records sorted by
+    key which reducers read through mmap.  format='pickle' stores each dump
+    as a pickled list instead.
+
+    compression names the codec runs are compressed with: 'zlib', 'fast'
+    (zlib at its fastest level) or 'bz2'.  Compression reduces the volume of
+    intermediate data at the cost of CPU on maps and reducers."""
 
-    def __init__(self, dir):
+    formats = {
+        'run': (FileRunOutput, FileRunInput),
+        'pickle': (FilePickleOutput, FileUnpicleSubslicer),
+    }
+
+    def __init__(self, dir, format='run', compression=None):
         super(IntermediateResultsFiles, self).__init__()
         self.dir = dir
 
-        self.map_output = FilePickleOutput(dir=dir)
-        self.reduce_input = FileUnpicleSubslicer(dir=dir)
+        output, input = self.formats[format]
+        self.map_output = output(dir=dir, compression=compression)
+        self.reduce_input = input(dir=dir)
+
+
+class IntermediateResultsShuffle(IntermediateResultsFiles):
+    """Storing intermediate results on the local disk of the nodes.
+
+    Each map writes its dumps to the shuffle directory of its own node, no
+    directory is shared between nodes.  Dumps are identified by locators
+    holding the address of the shuffle server of the node that wrote them.
+    Reducers and merges pull the dumps written on other nodes with a
+    `ShuffleFetcher`, which limits concurrent fetches and retries failed
+    ones.  Dumps are removed from every node once the task is complete.
+
+    dir and port default to SHUFFLE_DIR and SHUFFLE_PORT.  host defaults to
+    the host of the node running the worker, as known by the master."""
+
+    def __init__(self, dir=None, host=None, port=None, format='run',
+                 compression=None):
+        if dir is None:
+            dir = shuffle_dir()
+        super(IntermediateResultsShuffle, self).__init__(dir, format,
+                                                         compression)
+        self._host = host
+        self.port = port or shuffle_port()
+        self.fetcher = ShuffleFetcher()
+
+        # names of the dumps written on each node, including dumps since
+        # merged
+        self._dumps = {}
+
+
+    @property
+    def host(self):
+        """host of the shuffle server of this node"""
+        if self._host:
+            return self._host
+        worker = self.parent.get_worker() if self.parent else None
+        if worker is None:
+            # a standalone task only reads its own dumps
+            return 'localhost'
+        return node_host(worker.worker_key)
+
+
+    def locate(self, key):
+        """returns the locator of a dump written on this node"""
+        return locate(self.host, self.port, key)
+
+
+    def fetch(self, locators):
+        """fetches the dumps written on other nodes into a temporary
+        directory.  returns the paths of the dumps and the temporary
+        directory, which must be removed once the dumps are read."""
+
+        local_dir = directory_path(self.dir)
+        makedirs(local_dir)
+        tmp = tempfile.mkdtemp(prefix='fetch-', dir=local_dir)
+
+        paths = []
+        remote = []
+        for locator in locators:
+            host, port, key = parse_locator(locator)
+            if (host, port) == (self.host, self.port):
+                paths.append(os.path.join(local_dir, key))
+            else:
+                paths.append(os.path.join(tmp, key))
+                remote.append((host, port, key))
+
+        try:
+            self.fetcher.fetch(remote, tmp)
+        except:
+            shutil.rmtree(tmp)
+            raise
+        return paths, tmp
+
+
+    def load(self, locators, partition=None, runs=None):
+        if runs is not None:
+            return self.load_held(runs)
+        paths, tmp = self.fetch(locators)
+        self.reduce_input.input = paths
+        return self._read_fetched(tmp)
+
+
+    def _read_fetched(self, tmp):
+        try:
+            for group in self.reduce_input:
+                yield group
+        finally:
+            shutil.rmtree(tmp)
+
+
+    def merge(self, p, locators, mergeid):
+        """merges dumps of a partition into a single dump on this node,
+        removing the merged dumps written on this node.  returns
+        corresponding partitions-dictionary"""
+
+        paths, tmp = self.fetch(locators)
+        try:
+            key = self.pattern % (self.task_id, p, mergeid)
+            makedirs(directory_path(self.dir))
+            runs = [self.reduce_input.read(path) for path in paths]
+            self.map_output.dump_sorted(key, combine_groups(merge_runs(runs)))
+        finally:
+            shutil.rmtree(tmp)
+
+        for locator in locators:
+            host, port, k = parse_locator(locator)
+            if (host, port) == (self.host, self.port):
+                self.map_output.remove(k)
+
+        return {p: self.locate(key)}
+
+
+    def update_partitions(self, partitions):
+        super(IntermediateResultsShuffle, self).update_partitions(partitions)
+        for locator in partitions.itervalues():
+            if isinstance(locator, (tuple, list)):
+                locator = locator[0]
+            host, port, key = parse_locator(locator)
+            self._dumps.setdefault((host, port), set()).add(key)
+
+
+    def _dump_run(self, p, key, tuples):
+        makedirs(directory_path(self.dir))
+        self.map_output.dump(key, tuples)
+        return self.locate(key)
+
+
+    def clear(self):
+        """removes all dumps of the task from every node that wrote them,
+        including dumps merged away before the reduce stage.  The nodes are
+        contacted in a thread, returns a deferred that fires once they are
+        done."""
+
+        dumps = self._dumps.items()
+        self._dumps = {}
+        self._forget()
+        return threads.deferToThread(self._delete_dumps, dumps)
+
+
+    def _delete_dumps(self, dumps):
+        for (host, port), keys in dumps:
+            try:
+                delete_segments(host, port, sorted(keys),
+                                self.fetcher.get_key(), self.fetcher.timeout)
+            except Exception, e:
+                logger.warn('Failed to remove dumps of %s from %s:%s: %s' % \
+                            (self.task_id, host, port, e))
 
 
 class IntermediateResultsSQL(IntermediateResults):
-    """Storing intermediate results in SQL table."""
+    """Storing intermediate results in SQL table.
+
+    Maps bulk insert their dumps, reducers read their partition with a
+    single query ordered by key.  db is a `SQLBackend`, each worker uses the
+    connection of the backend in its process."""
 
     def __init__(self, table, db):
         super(IntermediateResultsSQL, self).__init__()
@@ -162,18 +620,201 @@ class IntermediateResultsSQL(IntermediateResults):
         self.reduce_input = SQLTableKeyInput(db=db, table=table)
 
 
+    def _dump_run(self, p, key, tuples):
+        self.map_output.dump(key, tuples, str(self.task_id), p)
+        return key
+
+
+    def _remove_run(self, p, key):
+        self.map_output.remove(key, str(self.task_id), p)
+
+
+    def merge(self, p, keys, mergeid):
+        key = self.pattern % (self.task_id, p, mergeid)
+        self.reduce_input.task_id = str(self.task_id)
+        self.reduce_input.partition = p
+        runs = [self.reduce_input.read(k) for k in keys]
+        self.map_output.dump_sorted(key, combine_groups(merge_runs(runs)),
+                                    str(self.task_id), p)
+
+        for k in keys:
+            self.map_output.remove(k, str(self.task_id), p)
+
+        return {p: key}
+
+
+    def load(self, key, partition=None, runs=None):
+        if runs is not None:
+            return self.load_held(runs)
+        self.reduce_input.input = key
+        self.reduce_input.task_id = str(self.task_id)
+        self.reduce_input.partition = partition
+        return self.reduce_input
+
+
+    def clear(self):
+        """removes the rows of all dumps of the task"""
+        self.map_output.remove_task(str(self.task_id))
+        self._forget()
+
+
+class ChainOutput(object):
+    """Output of a MapReduceTask that is the input of the next stage of a
+    pipeline.
+
+    Each reducer dumps its output to the backend of intermediate, so it stays
+    partitioned on the nodes instead of being returned to the main worker.
+    The next MapReduceTask of the pipeline uses the same ChainOutput as its
+    input, each of its maps reads the output of one reducer as (key, value)
+    tuples.  The dumps are removed once the next stage is complete.
+
+    intermediate must not be the intermediate results of either stage.  The
+    stages must run on the same main worker, such as in a TaskContainer."""
+
+    def __init__(self, intermediate):
+        self.im = intermediate
+        self.manifest = []
+
+
+    def open(self, partition):
+        return ChainWriter(self, partition)
+
+
+    def finish(self, manifest):
+        """records the dumps of the reducers for the next stage"""
+
+        self.manifest = sorted(manifest, key=lambda entry: entry['partition'])
+        for entry in self.manifest:
+            self.im.update_partitions({entry['partition']: entry['key']})
+        return self.manifest
+
+
+    def __iter__(self):
+        return iter(self.manifest)
+
+
+    def load(self, entry):
+        """returns an iterator over the (key, value) tuples written by a
+        reducer, entry is its manifest entry"""
+
+        for k, vs in self.im.load([entry['key']], entry['partition']):
+            for v in vs:
+                yield k, v
+
+
+    def clear(self):
+        """removes the dumps once the next stage is complete"""
+
+        self.manifest = []
+        return self.im.clear()
+
+
+class ChainWriter(object):
+    """Collects the output of a reducer and dumps it when it is closed"""
+
+    def __init__(self, chain, partition):
+        self.chain = chain
+        self.partition = partition
+        self.output = AppendableDict()
+        # key of the dump once close() starts writing it
+        self.key = None
+
+    def __setitem__(self, key, value):
+        self.output[key] = value
+
+    def close(self):
+        im = self.chain.im
+        self.key = im.pattern % (im.task_id, self.partition, 'chain')
+        tuples = self.output.items()
+        key = im._dump_run(self.partition, self.key, tuples)
+        return {
+            'partition': self.partition,
+            'key': key,
+            'records': sum(len(vs) for k, vs in tuples),
+        }
+
+    def abort(self):
+        """discards the output of a failed reducer, including the dump of
+        the partition if close() failed while writing it"""
+        self.output = AppendableDict()
+        if self.key is not None:
+            self.chain.im._remove_run(self.partition, self.key)
+            self.key = None
+
+
 class MapReduceTask(Task):
 
     datasources = {}
 
     input = None
+    """
+    Input of the maps, or the `ChainOutput` of the previous stage of a
+    pipeline.
+    """
     output = None
+    """
+    dict that the results of all reducers are collected in on the main
+    worker, or a sink such as `FileSink` or `SQLSink` that each reducer
+    writes its results to directly.  With a sink, reducers only return a
+    manifest entry for their partition and the task returns the manifest.
+    A `ChainOutput` keeps the results on the nodes as the input of the next
+    stage of a pipeline.
+    """
 
     map = None
     reduce = None
 
+    combiner = None
+    """
+    Optional Task class run on the output of each map before it is dumped,
+    once per partition.  It is given the same input and output as a reduce
+    task.  Values it emits are collected into lists so the reduce task
+    receives them the same way as the values emitted by a map.  A combiner
+    must be associative: the reducer may receive combined and uncombined
+    values for the same key.  For aggregations such as sums the reduce class
+    can usually be used as the combiner.
+    """
+
     reducers = 1
 
+    partitioner = HashPartitioner
+    """
+    Class partitioning map output between reducers.  If the partitioner
+    needs a sample, such as `RangePartitioner`, sample maps are run on the
+    first inputs before the map stage and their output is discarded.
+    """
+
+    reduce_slowstart = None
+    """
+    Fraction of the maps that must be complete before the dumps of each
+    partition start being merged, or None to wait for all maps.  Once all
+    maps have been requested and this fraction has completed, partitions with
+    at least premerge_runs dumps are merged into a single dump by merge
+    workunits while the remaining maps finish.  Reduce tasks then merge
+    fewer, larger dumps.
+    """
+    premerge_runs = 8
+    """Minimum number of dumps in a partition for it to be merged early"""
+
+    memory_shuffle = False
+    """
+    Whether map output is shuffled in memory instead of through the backend
+    of the intermediate results, for small jobs.  Maps return their output
+    as runs which are held in memory on the main worker, and the main worker
+    reduces the held partitions itself so the runs never travel with
+    workunit args.  Once the held runs exceed memory_shuffle_limit, or a map
+    has more than memory_map_limit bytes of output, the runs are spilled to
+    the backend and the remaining maps dump their output as usual.
+    """
+    memory_shuffle_limit = 16 * 1024 * 1024
+    """Bytes of map output held in memory before it is spilled"""
+    memory_map_limit = 256 * 1024
+    """
+    Bytes of runs a map may return to the main worker.  Results are sent
+    through Perspective Broker, which refuses strings over 640KB, so a map
+    with more output dumps it to the backend instead.
+    """
+
     description = "Abstract Map-Reduce Task"
 
     sequential = False
@@ -182,14 +823,30 @@ class MapReduceTask(Task):
     def __init__(self, msg=None):
         Task.__init__(self, msg)
         self.__lock = Lock()
+        self.sample_tasks = {}
         self.map_tasks = {}
+        self.held_maps = set()
+        self.merge_tasks = {}
         self.reduce_tasks = {}
         
         self.im = self.intermediate
         self.im.task_id = msg
+        self.im.parent = self
         self.im.reducers = self.reducers
+        self.im.partitioner = self.partitioner()
+        self.partition_stats = None
 
-        self.maptask = MapWrapper(self.map('MapTask'), self.im, self)
+        if isinstance(self.output, ChainOutput):
+            self.output.im.task_id = '%s.chain' % msg
+            self.output.im.parent = self
+
+        if self.combiner:
+            combiner = self.combiner('CombineTask')
+            combiner.parent = self
+        else:
+            combiner = None
+        self.maptask = MapWrapper(self.map('MapTask'), self.im, self,
+                                  combiner)
 
         self.reducetask = ReduceWrapper(self.reduce('ReduceTask'), self.im,self)
 
@@ -207,11 +864,23 @@ class MapReduceTask(Task):
 
         Cleanup is in _complete() which will be called when there is no more
         work remaining.
+        sample:
+        * if the partitioner needs a sample, sample_next() starts a map task
+          returning a sample of its output for each of the first inputs.
+          The partitioner is built once all samples are returned;
+
         map:
         * work(): initialization and calling map_next() for every worker
           available;
         * map_next(): checking if any data to process and starting a map task,
           if no more data available, call reduce_stage();
+
+        * memory_next(): whether the output of the next map is held in
+          memory, spill() once the held runs exceed memory_shuffle_limit;
+
+        merge:
+        * merge_next(): once reduce_slowstart of the maps are complete,
+          starting merge tasks for partitions with many dumps;
         
         reduce:
         * reduce_next(): checking if any data to process and starting a reduce
@@ -227,6 +896,26 @@ class MapReduceTask(Task):
         self._status = STATUS_RUNNING
         self._reduce_called = False
         self._input_iter = enumerate(self.input)
+        self._maps_requested = 0
+        self._maps_completed = 0
+        self._maps_exhausted = False
+        self._merge_count = 0
+        self._spilled = False
+        self._sample = []
+        self.manifest = []
+
+        if self.im.partitioner.needs_sample:
+            # the sampled inputs are mapped again after sampling
+            sampled = list(islice(self._input_iter,
+                                  self.im.partitioner.sample_maps))
+            self._input_iter = chain(sampled, self._input_iter)
+            for id, i in sampled:
+                self.sample_next(id, i)
+
+            if self.sample_tasks:
+                logger.debug('mapreduce: sample stage')
+                return
+            self.im.partitioner.build(self._sample, self.reducers)
 
         # let's start the processing
         logger.debug('mapreduce: map stage')
@@ -238,13 +927,18 @@ class MapReduceTask(Task):
         Sends work requests to the master.  This function will send either
         Map requests or Reduce requests depending on what work remains.
         """
+        if self.sample_tasks:
+            return
+
         if not self._reduce_called:
             while self.map_next():
                 pass
+            self.merge_next()
 
-        if not self.map_tasks:
+        if not self.map_tasks and not self.merge_tasks:
             if not self._reduce_called:
-                self._partition_iter = enumerate(self.im)
+                self.report_partitions()
+                self._partition_iter = iter(self.im.partitions())
                 self._reduce_called = True
 
             while self.reduce_next():
@@ -256,14 +950,22 @@ class MapReduceTask(Task):
         try:
             id, i = self._input_iter.next()
         except StopIteration:
+            self._maps_exhausted = True
             return False
 
         mapid = 'map%d' % id
         self.map_tasks[mapid] = 1
+        self._maps_requested += 1
         map_args = {
                     'id': mapid,
                     'input_key': i,
                    }
+        state = self.im.partitioner.state()
+        if state is not None:
+            map_args['partitioner'] = state
+        if self.memory_next():
+            map_args['memory'] = self.memory_map_limit
+            self.held_maps.add(mapid)
 
         logger.debug("mapreduce: requesting worker for %s: %s"
                 % (mapid, self.maptask.get_key()) )
@@ -272,20 +974,112 @@ class MapReduceTask(Task):
         return True
 
 
+    def memory_next(self):
+        """returns whether the output of the next map is held in memory"""
+        return bool(self.memory_shuffle) and not self._spilled
+
+
+    def spill(self, force=False):
+        """dumps the runs held in memory to the backend once they exceed
+        memory_shuffle_limit, or when forced because a map dumped its
+        output.  Runs of maps completing after the spill are dumped as soon
+        as they are returned."""
+
+        if not (force or self._spilled or \
+                self.im.held_bytes > self.memory_shuffle_limit):
+            return
+
+        if not self._spilled:
+            logger.info('mapreduce: %d bytes held in memory, spilling to '
+                        'the intermediate results' % self.im.held_bytes)
+            self._spilled = True
+        if self.im.held_bytes:
+            self.im.spill()
+
+
+    def sample_next(self, id, i):
+        """requests a map of an input that returns a sample of its output"""
+
+        sampleid = 'sample%d' % id
+        self.sample_tasks[sampleid] = 1
+        sample_args = {
+                        'id': sampleid,
+                        'input_key': i,
+                        'sample': True,
+                      }
+
+        logger.debug("mapreduce: requesting worker for %s: %s"
+                % (sampleid, self.maptask.get_key()) )
+        self.parent.request_worker(self.maptask.get_key(), sample_args,
+                                   sampleid)
+
+
+    def report_partitions(self):
+        """records and logs the sizes of the partitions after the map
+        stage"""
+
+        self.partition_stats = self.im.partition_stats()
+        values = [s['values'] for s in \
+                  self.partition_stats['partitions'].itervalues()]
+        if values:
+            logger.info('mapreduce: %d partitions, values min %d max %d, '
+                        'skew %.2f' % (len(values), min(values), max(values),
+                        self.partition_stats['skew']))
+        heavy_hitters = getattr(self.im.partitioner, 'heavy_hitters', None)
+        if heavy_hitters:
+            logger.info('mapreduce: heavy hitters %s' % heavy_hitters)
+
+
+    def merge_next(self):
+        """requests merges of partitions with enough dumps once the slow
+        start threshold of maps is complete"""
+
+        if self.reduce_slowstart is None or not self._maps_exhausted \
+                or not self.map_tasks:
+            return
+        if self._maps_completed < self.reduce_slowstart * self._maps_requested:
+            return
+
+        for p, keys in self.im.take_runs(self.premerge_runs):
+            mergeid = 'merge%d' % self._merge_count
+            self._merge_count += 1
+            self.merge_tasks[mergeid] = 1
+            merge_args = {
+                            'partition_id': p,
+                            'partition': keys,
+                            'merge': mergeid,
+                         }
+
+            logger.debug("mapreduce: requesting worker for %s: %s"
+                    % (mergeid, self.reducetask.get_key()) )
+            self.parent.request_worker(self.reducetask.get_key(), merge_args,
+                                       mergeid)
+
+
     def reduce_next(self):
         """more work for reduce task"""
 
         try:
-            id, p = self._partition_iter.next()
+            p, keys = self._partition_iter.next()
         except StopIteration:
             return False
 
-        reduceid = 'reduce%d' % id
-        self.reduce_tasks[reduceid] = 1
+        reduceid = 'reduce%d' % p
         reduce_args = {
-                        'partition': p,
+                        'partition_id': p,
+                        'partition': keys,
                       }
+        runs = self.im.held_runs(p)
+        if runs:
+            # held runs are reduced here so they don't travel through the
+            # master and the database with the args of a workunit
+            logger.debug("mapreduce: reducing %s on the main worker" % \
+                         reduceid)
+            reduce_args['runs'] = runs
+            self.reducetask._start(reduce_args, self.reduce_result)
+            return True
 
+        self.reduce_tasks[reduceid] = 1
         logger.debug("mapreduce: requesting worker for %s: %s"
                 % (reduceid, self.reducetask.get_key()) )
         self.parent.request_worker(self.reducetask.get_key(), reduce_args, \
@@ -294,20 +1088,56 @@ class MapReduceTask(Task):
         return True
 
 
+    def reduce_result(self, result):
+        """adds the result of a reduce task to the output"""
+        if is_sink(self.output):
+            self.manifest.append(result)
+        else:
+            self.output.update(result)
+
+
     def _work_unit_complete(self, result, id):
         """retrieving results form remote task"""
 
-        logger.debug("mapreduce: got REMOTE result %s from %s" % (result, id))
+        # results of maps shuffled in memory are large, only format them
+        # when they are logged
+        logger.debug("mapreduce: got REMOTE result %s from %s", result, id)
         with self.__lock:
             # map/reduce specific post processing
             if id in self.map_tasks:
-                logger.debug('   map result %s: %s' % (id, result))
-                self.im.update_partitions(result)
+                logger.debug('   map result %s: %s', id, result)
+                if id in self.held_maps:
+                    self.held_maps.remove(id)
+                    held, result = result
+                    if held:
+                        self.im.update_held(result)
+                        self.spill()
+                    else:
+                        # the output was too large to be returned and was
+                        # dumped, partitions can't be both held and dumped
+                        self.spill(True)
+                        self.im.update_partitions(result)
+                else:
+                    self.im.update_partitions(result)
                 del self.map_tasks[id]
+                self._maps_completed += 1
+
+            elif id in self.sample_tasks:
+                logger.debug('   sample result %s' % id)
+                self._sample.extend(result)
+                del self.sample_tasks[id]
+                if not self.sample_tasks:
+                    self.im.partitioner.build(self._sample, self.reducers)
+                    self._sample = []
+
+            elif id in self.merge_tasks:
+                logger.debug('   merge result %s: %s' % (id, result))
+                self.im.update_partitions(result)
+                del self.merge_tasks[id]
 
             elif id in self.reduce_tasks:
                 logger.debug('   reduce result %s: %s' % (id, result))
-                self.output.update(result)
+                self.reduce_result(result)
                 del self.reduce_tasks[id]
 
             # call request work to ensure that any additional work gets
@@ -320,7 +1150,8 @@ class MapReduceTask(Task):
                         self.get_worker().worker_key)
                 self.get_worker().request_worker_release()
 
-            if not self.map_tasks and not self.reduce_tasks:
+            if not self.sample_tasks and not self.map_tasks \
+                    and not self.merge_tasks and not self.reduce_tasks:
                 # all work is done, call the task specific function to combine
                 # the results
                 self._complete()
@@ -338,35 +1169,41 @@ class MapReduceTask(Task):
             return
 
         self.im.clear()
-
-        logger.debug('mapreduce: finished')
-        logger.info(self.output)
+        if isinstance(self.input, ChainOutput):
+            # output of the previous stage is no longer needed
+            self.input.clear()
+
+        if is_sink(self.output):
+            results = self.output.finish(self.manifest)
+            logger.info('mapreduce: finished, %d records written to %d '
+                        'partitions' % (sum(e['records'] for e in results),
+                        len(results)))
+        else:
+            results = self.output
+            logger.info('mapreduce: finished, %d results' % len(results))
 
         self._status = STATUS_COMPLETE
 
         #make a callback, if any
         if self.__callback:
-            self.__callback(self.output, **self._callback_args)
+            self.__callback(results, **self._callback_args)
 
 
-    def get_subtask(self, task_path):
+    def _get_subtask(self, task_path, clean=False):
+        """overridden to return the map and reduce wrappers.  The wrappers
+        keep the state of the task, such as its intermediate results, so
+        they are returned even when a clean subtask is requested."""
         if len(task_path) == 1:
             if task_path[0] == self.__class__.__name__:
-                return self
+                return task_path, self
             else:
-                raise TaskNotFoundException("Task not found")
-
-        # pop this classes name off the list
-        task_path.pop(0)
+                raise TaskNotFoundException("Task not found: %s" % task_path)
 
-        # what if it is MapTask
-        try:
-            return self.maptask.get_subtask(task_path)
-        except TaskNotFoundException:
-            pass
+        for wrapper in (self.maptask, self.reducetask):
+            if task_path[1] == wrapper.task.__class__.__name__:
+                return task_path[:2], wrapper
 
-        # what if it is ReduceTask
-        return self.reducetask.get_subtask(task_path)
+        raise TaskNotFoundException("Task not found: %s" % task_path)
 
 
     def progress(self):
@@ -384,11 +1221,12 @@ class MapReduceWrapper():
     * get_subtask() to return self instead of subtask directly,
     * start() to run special self.work() instead of subtask's"""
 
-    def __init__(self, task, im, parent):
+    def __init__(self, task, im, parent, combiner=None):
         self.task = task
         self.im = im
         self.parent = parent
         self.task.parent = parent
+        self.combiner = combiner
 
 
     def get_key(self):
@@ -399,7 +1237,12 @@ class MapReduceWrapper():
         return self.parent.get_worker()
 
 
-    def get_subtask(self, task_path):
+    @property
+    def _status(self):
+        return self.task._status
+
+
+    def get_subtask(self, task_path, clean=False):
         """It is pretending it's the wrapped task."""
 
         # this is a wrapper
@@ -407,7 +1250,13 @@ class MapReduceWrapper():
             return self
 
         # not looking for the task we are wrapping
-        return self.task.get_subtask(task_path)
+        return self.task.get_subtask(task_path, clean)
+
+
+    def _get_subtask(self, task_path, clean=False):
+        if len(task_path) == 1 and task_path[0] == self.task.__class__.__name__:
+            return task_path, self
+        return self.task._get_subtask(task_path, clean)
 
 
     def __repr__(self):
@@ -447,6 +1296,11 @@ class MapWrapper(MapReduceWrapper):
         if args.has_key('input_key') and hasattr(self.parent, 'input'):
             args['input'] = self.parent.input.load(args['input_key'])
 
+        sample = args.pop('sample', False)
+        memory = args.pop('memory', None)
+        if 'partitioner' in args:
+            self.im.partitioner.load(args.pop('partitioner'))
+
         output = AppendableDict()
         args['output'] = output
 
@@ -455,10 +1309,30 @@ class MapWrapper(MapReduceWrapper):
 
         self.task._work(**args) # ignoring results
 
-        pdict = self.im.partition_output(output)
+        if sample:
+            results = self.im.partitioner.sample(output)
+            if callback:
+                callback(results, **callback_args)
+            return results
 
-        logger.debug("%s._work() dumping i9e" % id)
-        results = self.im.dump(pdict, id) # partitions are our results
+        pdict = self.im.partition_output(output)
+        if self.combiner:
+            pdict = self.combine(pdict)
+
+        held = False
+        if memory is not None:
+            # the output is returned to the main worker if it is small
+            # enough to be sent, otherwise the same partitions are dumped
+            pdict = list(pdict)
+            results = self.im.hold(pdict)
+            held = sum(len(run) for run, records, values \
+                       in results.itervalues()) <= memory
+        if not held:
+            logger.debug("%s._work() dumping i9e" % id)
+            results = self.im.dump(pdict, id) # partitions are our results
+        self.count(results, held)
+        if memory is not None:
+            results = (held, results)
 
         logger.debug('%s - MapWrapper - work complete' % \
                      self.get_worker().worker_key)
@@ -474,6 +1348,33 @@ class MapWrapper(MapReduceWrapper):
         return results
 
 
+    def count(self, results, memory):
+        """increments the counters of the map output, in total and for each
+        partition"""
+
+        counters = self.task.counters
+        for p, (key, records, values) in results.iteritems():
+            counters.increment('mapreduce.map_output_records', records)
+            counters.increment('mapreduce.map_output_values', values)
+            counters.increment('mapreduce.partition.%d.values' % p, values)
+            if memory:
+                counters.increment('mapreduce.map_output_held_bytes',
+                                   len(key))
+
+
+    def combine(self, pdict):
+        """runs the combiner on the items of each partition, returns the
+        combined partitions"""
+
+        combined = []
+        for p, tuples in pdict:
+            output = AppendableDict()
+            self.combiner._work(input=iter(tuples), output=output)
+            combined.append((p, output.items()))
+
+        return combined
+
+
 class ReduceWrapper(MapReduceWrapper):
 
     def _start(self, args={}, callback=None, callback_args={}):
@@ -483,11 +1384,37 @@ class ReduceWrapper(MapReduceWrapper):
         """
         logger.debug('%s - ReduceWrapper.work()' % self.get_worker().worker_key)
 
-        args['input'] = self.im.load(args['partition'])
-        output = args['output'] = {}
-
-        self.task._work(**args) # ignoring results
-        results = output
+        if 'merge' in args:
+            # merging dumps of a partition before the reduce stage
+            results = self.im.merge(args['partition_id'], args['partition'],
+                                    args['merge'])
+        elif is_sink(getattr(self.parent, 'output', None)):
+            # results are written to the sink, only the manifest entry for
+            # the partition is returned
+            args['input'] = self.im.load(args['partition'],
+                                         args.get('partition_id'),
+                                         args.pop('runs', None))
+            output = args['output'] = \
+                self.parent.output.open(args['partition_id'])
+
+            try:
+                self.task._work(**args) # ignoring results
+                results = output.close()
+            except:
+                output.abort()
+                raise
+            self.task.increment('mapreduce.reduce_output_records',
+                                results['records'])
+        else:
+            args['input'] = self.im.load(args['partition'],
+                                         args.get('partition_id'),
+                                         args.pop('runs', None))
+            output = args['output'] = {}
+
+            self.task._work(**args) # ignoring results
+            results = output
+            self.task.increment('mapreduce.reduce_output_records',
+                                len(output))
 
         logger.debug('%s - ReduceWrapper - work complete' % \
                      self.get_worker().worker_key)
@@ -21,8 +21,9 @@ from __future__ import with_statement
 
 import logging
 from threading import RLock
+import time
 
-from pydra.cluster.tasks import Task, TaskNotFoundException
+from pydra.cluster.tasks import Task, TaskNotFoundException, STATUS_COMPLETE
 from pydra.cluster.tasks.datasource import DataSource
 
 class ParallelTask(Task):
@@ -38,9 +39,33 @@ class ParallelTask(Task):
     datasource = None
     """The datasource description."""
 
+    combine = None
+    """
+    Optional associative function for merging the results of two workunits:
+    ``combine(results, other_results)``.  When defined, the results of all
+    workunits in a batch are merged on the worker that ran them before they
+    are sent to the main worker.  The master sends the results of each node
+    one call at a time, and the main worker merges the results of the
+    batches held in the meantime.  Merged results are passed to
+    `work_units_complete()` instead of `work_unit_complete()`.
+    """
+
+    checkpoint_interval = None
+    """
+    Seconds between checkpoints of the completed workunits and the partial
+    results returned by `checkpoint_state()`.  A main worker restarted for
+    the same task instance resumes from the last checkpoint and only runs the
+    missing workunits.  None disables checkpointing.
+    """
+
     def __init__(self, msg=None):
         Task.__init__(self, msg)
         self._lock = RLock()             # general lock
+        self._data_in_progress = {}
+        self._requesting = False         # work units are being requested
+        self._checkpoint_store = None
+        self._checkpoint_completed = set()  # indexes of completed workunits
+        self._checkpoint_time = 0
         self._subtask = None              # subtask that is parallelized
         self._subtask_class = None      # class of subtask
         self._subtask_args = None       # args for initializing subtask
@@ -106,14 +131,23 @@ class ParallelTask(Task):
             else:
                 raise TaskNotFoundException("Task not found: %s" % task_path)
         
-        # discard old version
-        if clean:
+        # discard old version.  A subtask that has been set up is kept so its
+        # state is reused by the next workunit.
+        if clean and not (self._subtask and self._subtask._reusable()):
             self._subtask = None
         
         #recurse down into the child
         consumed, subtask = self.subtask._get_subtask(task_path[1:])
         return task_path[:2], subtask
 
+    def _teardown(self):
+        """
+        Overridden to tear down the subtask
+        """
+        if self._subtask:
+            self._subtask._teardown()
+        Task._teardown(self)
+
     def request_workers(self):
         """
         Create work requests for all planned subtasks.
@@ -128,8 +162,26 @@ class ParallelTask(Task):
         for data, index in self.get_work_units():
             self.logger.debug('Paralleltask - assigning remote work: key=%s, args=%s'
                 % ('--', index))
+            data_size = self.workunit_size(data)
+            if hasattr(data, 'transmitable'):
+                data = data.transmitable()
             self.parent.request_worker(self.subtask.get_key(), {'data': data},
-                index)
+                index, data_size)
+
+    def workunit_size(self, data):
+        """
+        Estimates the number of bytes of data in a workunit.  The estimate is
+        passed to the scheduler with the request for a worker.  Workunits
+        planned by `FilePlanner` know their size; override this to estimate
+        the size of other workunits.
+
+        :Parameters:
+            data
+                The data of the workunit
+
+        :return: size in bytes, or None if unknown
+        """
+        return getattr(data, 'data_size', None)
 
     def get_work_units(self):
         """
@@ -148,12 +200,17 @@ class ParallelTask(Task):
         
         while True:
             data, index = next(slicer), self._workunit_count
-        
-            yield data, index
-        
+            
             with self._lock:
                 self._workunit_count += 1
+                if index in self._checkpoint_completed:
+                    # completed before the last checkpoint
+                    continue
+                # stored before the workunit is handed out, its results may
+                # be returned before the generator resumes
                 self._data_in_progress[index] = data
+        
+            yield data, index
 
     def _stop(self):
         """
@@ -166,30 +223,110 @@ class ParallelTask(Task):
         """
         Work function overridden to delegate workunits to other Workers.
         """
-        # request initial workers
-        self.request_workers()
+        if self.checkpoint_interval is not None:
+            self._restore_checkpoint()
+        
+        # request initial workers.  The task is not complete while workunits
+        # are still being requested, even if every workunit handed out so far
+        # has completed.
+        with self._lock:
+            self._requesting = True
+        try:
+            self.request_workers()
+        finally:
+            with self._lock:
+                self._requesting = False
         self.logger.debug('Paralleltask - initial work assigned!')
+        
+        with self._lock:
+            if not self._data_in_progress and self._status != STATUS_COMPLETE:
+                # every workunit completed while requesting, or before the
+                # last checkpoint
+                self._work_complete()
+
+    def checkpoint_state(self):
+        """
+        Returns the partial results accumulated by `work_unit_complete()` so
+        they can be saved with a checkpoint.  The value must be picklable.
+        Called with the task lock held.
+        
+        The default implementation returns None.
+        """
+        return None
+
+    def restore_checkpoint(self, state):
+        """
+        Restores partial results returned by `checkpoint_state()` when the
+        task resumes from a checkpoint.
+        
+        The default implementation does nothing.
+        """
+        pass
+
+    def _restore_checkpoint(self):
+        """
+        Loads the last checkpoint for this task, if any.
+        """
+        self._checkpoint_store = self.get_worker().get_checkpoint_store(self)
+        if not self._checkpoint_store:
+            return
+        
+        checkpoint = self._checkpoint_store.load()
+        if checkpoint:
+            completed, state = checkpoint
+            self.logger.info('ParallelTask - resuming from checkpoint, %s '
+                             'workunits complete' % len(completed))
+            with self._lock:
+                self.restore_checkpoint(state)
+                self._checkpoint_completed = completed
+                self._workunit_completed = len(completed)
+        self._checkpoint_time = time.time()
+
+    def _checkpoint(self, force=False):
+        """
+        Saves a checkpoint if checkpoint_interval has passed since the last
+        one.  Must be called with the lock held.
+        """
+        now = time.time()
+        if force or now - self._checkpoint_time >= self.checkpoint_interval:
+            try:
+                self._checkpoint_store.save(self._checkpoint_completed,
+                                            self.checkpoint_state())
+                self._checkpoint_time = now
+            except Exception, e:
+                self.logger.exception('ParallelTask - checkpoint failed')
 
     def _batch_complete(self, results):
         for workunit, result, failed in results:
             if not failed:
-                self._work_unit_complete(results, workunit)
+                self._work_unit_complete(result, workunit)
 
     def _work_unit_complete(self, results, index):
         """
         A work unit completed.  Handle the common management tasks to remove the data
         from in_progress.  Also call task specific work_unit_complete(...)
         
+        If the results were merged with `combine()` index is a list of the
+        merged workunits and work_units_complete(...) is passed a list of
+        their data instead.
+        
         This method *MUST* lock while it is altering the lists of data
         """
         self.logger.debug('Paralleltask - Work unit completed')
         with self._lock:
             # run the task specific post process
+            if isinstance(index, (list, tuple)):
+                indexes = index
+                data = [self._data_in_progress[i] for i in indexes]
+                self.work_units_complete(data, results)
+            else:
+                indexes = (index,)
+                data = self._data_in_progress[index]
+                self.work_unit_complete(data, results)
             
-            self.work_unit_complete(self._data_in_progress[index], results)
-            
-            # remove the workunit from _in_progress
-            del self._data_in_progress[index]
+            # remove the workunit(s) from _in_progress
+            for i in indexes:
+                del self._data_in_progress[i]
             
             #check stop flag
             if self.STOP_FLAG:
@@ -202,15 +339,59 @@ class ParallelTask(Task):
                 self.logger.debug('ParallelTask - releasing a worker')
                 self.get_worker().request_worker_release()
             
-            self._workunit_completed += 1
+            self._workunit_completed += len(indexes)
             
             #check for more work
-            if not self._data_in_progress:
-                #all work is done, call the task specific function to combine the results 
-                self.logger.debug('Paralleltask - all workunits complete, calling task post process')
-                results = self.work_complete()
-                self._complete(results)
+            if not self._data_in_progress and not self._requesting:
+                self._work_complete()
                 return
+            
+            if self._checkpoint_store:
+                self._checkpoint_completed.update(indexes)
+                self._checkpoint()
+
+    def _work_complete(self):
+        """
+        All work is done, call the task specific function to combine the
+        results.  Must be called with the lock held.
+        """
+        self.logger.debug('Paralleltask - all workunits complete, calling task post process')
+        results = self.work_complete()
+        if self._checkpoint_store:
+            self._checkpoint_store.remove()
+        self._complete(results)
+
+    def combine_results(self, results):
+        """
+        Merges the results of a batch of workunits with `combine()`.  Called
+        on the worker that ran the batch, before results are sent to the main
+        worker.  Failed workunits are left as is.
+        
+        @param results - list of (workunit, results, failed) tuples
+        @returns list of results, where all successful workunits are merged
+                 into a single entry whose workunit is a list of the keys of
+                 the merged workunits.
+        """
+        if not self.combine:
+            return results
+        
+        keys = []
+        combined = None
+        merged = []
+        for workunit, result, failed in results:
+            if failed:
+                merged.append((workunit, result, failed))
+                continue
+            
+            combined = self.combine(combined, result) if keys else result
+            if isinstance(workunit, (list, tuple)):
+                keys.extend(workunit)
+            else:
+                keys.append(workunit)
+        
+        if keys:
+            merged.insert(0, (keys, combined, False))
+        return merged
 
     def _worker_failed(self, index):
         """
@@ -286,7 +467,23 @@ class ParallelTask(Task):
         Method stub for method called to post process results.  This
         is implemented by users that want to include automatic post-processing
         
+        Results merged with `combine()` are passed to `work_units_complete()`
+        instead.
+        
         @param workunit - key and other args sent when assigning the workunit
         @param results - results sent by the completed subtask
         """
         pass
+
+    def work_units_complete(self, workunits, results):
+        """
+        Method stub for method called to post process the results of several
+        workunits merged with `combine()`.  By default work_unit_complete()
+        is called with the list of workunits, tasks defining `combine()`
+        override one of them to handle merged results.
+        
+        @param workunits - list of the keys and other args sent when
+                           assigning each merged workunit
+        @param results - merged results of the workunits
+        """
+        self.work_unit_complete(workunits, results)
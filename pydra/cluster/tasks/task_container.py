@@ -17,6 +17,10 @@
     along with Pydra.  If not, see <http://www.gnu.org/licenses/>.
 """
 
+from __future__ import with_statement
+
+from threading import RLock
+
 from pydra.cluster.tasks import Task, TaskNotFoundException, STATUS_FAILED, \
         STATUS_STOPPED, STATUS_RUNNING, STATUS_PAUSED, STATUS_COMPLETE
 
@@ -32,14 +36,17 @@ class SubTaskWrapper():
     This class acts as a proxy for all Task methods
     
         percentage - the percentage of work the task accounts for.
+        depends_on - indexes of the subtasks that must complete before this
+                     task can start.
     """
-    def __init__(self, task, parent, percentage):
+    def __init__(self, task, parent, percentage, depends_on=[]):
         self.task = task
         self.percentage = percentage
         self.parent = parent
+        self.depends_on = depends_on
 
-    def get_subtask(self, task_path):
-        return self.task.get_subtask(task_path)
+    def get_subtask(self, task_path, clean=False):
+        return self.task.get_subtask(task_path, clean)
 
     def get_key(self):
         """
@@ -73,23 +80,87 @@ class TaskContainer(Task):
 
     TaskContainer does no work itself.  Its purpose is to allow a bigger job
     to be broken into discrete functions.  IE.  downloading and processing.
+
+    Subtasks form a directed acyclic graph.  A subtask is started as soon as
+    all of the subtasks it depends on are complete, so independent branches
+    run concurrently, each requesting its own workers.  In a sequential
+    container each subtask depends on the one added before it unless its
+    dependencies are given explicitly.
+
+    A subtask with no dependencies is passed the args of the container.  A
+    subtask with one dependency is passed its results, and a subtask with
+    several dependencies is passed their results merged by `fan_in()`.  The
+    results of the container are the results of the subtasks that nothing
+    depends on, merged the same way when there is more than one.
     """
     def __init__(self, msg, sequential=True):
         Task.__init__(self, msg)
         self.subtasks = []
         self.sequential = sequential
+        self._lock = RLock()
+        self._args = {}
+        self._results = {}
+        self._started = set()
         for task in self.subtasks:
             task.parent = self
 
-    def add_task(self, task, percentage=None):
+    def add_task(self, task, percentage=None, depends_on=None):
         """
         Adds a task to the container
+
+        @param task - task to add
+        @param percentage - percentage of the work this task accounts for
+        @param depends_on - task, index, or list of tasks/indexes that must
+                            complete before this task starts.  They must
+                            already be in the container.  Defaults to the
+                            previous task if the container is sequential.
         """
-        subtask = SubTaskWrapper(task, self, percentage)
+        if depends_on is None:
+            if self.sequential and self.subtasks:
+                depends_on = [len(self.subtasks)-1]
+            else:
+                depends_on = []
+        elif not isinstance(depends_on, (list, tuple)):
+            depends_on = [depends_on]
+
+        dependencies = []
+        for dependency in depends_on:
+            if not isinstance(dependency, int):
+                indexes = [i for i, subtask in enumerate(self.subtasks) \
+                                if subtask.task is dependency]
+                if not indexes:
+                    raise ValueError('Dependency is not in this container: %s'
+                                     % dependency)
+                dependency = indexes[0]
+            elif not 0 <= dependency < len(self.subtasks):
+                raise ValueError('Dependency is not in this container: %s'
+                                 % dependency)
+            dependencies.append(dependency)
+
+        subtask = SubTaskWrapper(task, self, percentage, dependencies)
         self.subtasks.append(subtask)
         task.parent=subtask
         task.id = '%s-%d' % (self.id,len(self.subtasks))
 
+    def fan_in(self, results):
+        """
+        Merges the results of several subtasks, either into the args of a
+        subtask that depends on all of them, or into the results of the
+        container.  Override this to combine results differently.
+
+        @param results - list of results, ordered by subtask index
+        @returns dict of kwargs: {'results':results}
+        """
+        return {'results':results}
+
+    def _gather(self, indexes):
+        """
+        Returns the results of the subtasks, merged if there is more than one
+        """
+        if len(indexes) == 1:
+            return self._results[indexes[0]]
+        return self.fan_in([self._results[i] for i in indexes])
+
     def reset(self):
         for subtask in self.subtasks:
             subtask.task.reset()
@@ -121,30 +192,68 @@ class TaskContainer(Task):
             raise TaskNotFoundException("Task not found")
 
     def _work(self, **kwargs):
-        # start first subtask
-        self._current_subtask = 0
-        self._start_subtask(args=kwargs)
+        # start all subtasks without dependencies
+        with self._lock:
+            self._args = kwargs
+            self._results = {}
+            self._started = set()
+            ready = self._ready_subtasks()
+        for index, args in ready:
+            self._start_subtask(index, args)
 
-    def _start_subtask(self, args={}):
+    def _ready_subtasks(self):
+        """
+        Finds subtasks whose dependencies are complete and marks them started.
+        Must be called with the lock held.
+
+        @returns list of (index, args) for subtasks that should be started
+        """
+        ready = []
+        for index, subtask in enumerate(self.subtasks):
+            if index in self._started:
+                continue
+            if [i for i in subtask.depends_on if i not in self._results]:
+                continue
+            self._started.add(index)
+            if subtask.depends_on:
+                args = self._gather(subtask.depends_on)
+            else:
+                args = self._args
+            ready.append((index, args))
+        return ready
+
+    def _start_subtask(self, index, args={}):
         """
         Starts a subtask
         """
-        subtask = self.subtasks[self._current_subtask]
+        subtask = self.subtasks[index]
         subtask.task.logger = self.logger
         logger.debug('TaskContainer - starting subtask: %s' % subtask)
-        subtask.task.start(args=args, callback=self._subtask_complete)
+        subtask.task.start(args=args, callback=self._subtask_complete,
+                           callback_args={'index':index})
         logger.debug('TaskContainer - STARTED! subtask: %s' % subtask)
 
-    def _subtask_complete(self, results):
+    def _subtask_complete(self, results, index=0):
         """
-        Callback when a subtask is complete.  Will either move on
-        to the next subtask or call the callback
+        Callback when a subtask is complete.  Starts any subtasks that were
+        waiting for it, or calls the callback when all subtasks are complete
         """
-        
-        self._current_subtask += 1
-        if self._current_subtask < len (self.subtasks):
-            self._start_subtask(args=results)
-        else:
+        with self._lock:
+            self._results[index] = results
+            ready = self._ready_subtasks()
+            complete = len(self._results) == len(self.subtasks)
+            if complete:
+                dependencies = set()
+                for subtask in self.subtasks:
+                    dependencies.update(subtask.depends_on)
+                sinks = [i for i in range(len(self.subtasks)) \
+                            if i not in dependencies]
+                results = self._gather(sinks)
+
+        for index, args in ready:
+            self._start_subtask(index, args)
+
+        if complete:
             self._complete(results)
 
     def _stop(self):
@@ -155,6 +264,14 @@ class TaskContainer(Task):
         for subtask in self.subtasks:
             subtask._stop()
 
+    def _teardown(self):
+        """
+        Overridden to tear down all children
+        """
+        for subtask in self.subtasks:
+            subtask.task._teardown()
+        Task._teardown(self)
+
     def progress(self):
         """
         progress - returns the progress as a number 0-100.
@@ -162,32 +279,57 @@ class TaskContainer(Task):
         A container task's progress is a derivitive of its children.
         the progress of the child counts for a certain percentage of the
         progress of the parent.  This weighting can be set manually or
-        divided evenly by calculatePercentage()
+        divided evenly between the children without a percentage.
+        
+        Progress is measured along the critical path: the chain of dependent
+        subtasks with the most remaining work.  Subtasks running in parallel
+        with the critical path do not make the container appear closer to
+        finishing than it is.  For a sequential container this is the
+        weighted sum of the progress of the children.
         """
-        progress = 0
+        if not self.subtasks:
+            return 0
+        
         auto_total = 100
         auto_subtask_count = len(self.subtasks)
         for subtask in self.subtasks:
             if subtask.percentage:
                 auto_total -= subtask.percentage
                 auto_subtask_count -= 1
-        auto_percentage = auto_total / auto_subtask_count / float(100)
+        if auto_subtask_count:
+            auto_percentage = auto_total / float(auto_subtask_count)
         
-        for subtask in self.subtasks:
+        # remaining work of the longest path starting from each subtask.
+        # dependencies are always added before the tasks that depend on them
+        # so iterating in reverse visits dependents first.
+        count = len(self.subtasks)
+        total = [0.0] * count
+        remaining = [0.0] * count
+        for index in reversed(range(count)):
+            subtask = self.subtasks[index]
             if subtask.percentage:
-                percentage = subtask.percentage/float(100)
+                weight = subtask.percentage
             else:
-                percentage = auto_percentage
+                weight = auto_percentage
             
             # if task is done it complete 100% of its work
             if subtask.task._status == STATUS_COMPLETE:
-                progress += 100*percentage
+                done = 1
             
             # task is only partially complete
             else:
-                progress += subtask.task.progress()*percentage
+                done = subtask.task.progress()/float(100)
+            
+            dependents = [i for i in range(index+1, count) \
+                            if index in self.subtasks[i].depends_on]
+            total[index] = weight + max([0] + [total[i] for i in dependents])
+            remaining[index] = weight*(1-done) + \
+                            max([0] + [remaining[i] for i in dependents])
         
-        return progress
+        critical_path = max(total)
+        if not critical_path:
+            return 0
+        return (critical_path - max(remaining)) * 100 / critical_path
 
     def progressMessage(self):
         """ 
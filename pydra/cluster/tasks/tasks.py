@@ -20,11 +20,13 @@
 import logging
 logger = logging.getLogger('root')
 
-from twisted.internet import threads
+from twisted.internet import reactor, threads
 from twisted.internet.defer import Deferred
+from twisted.python.threadable import isInIOThread
 
 from pydra.cluster.tasks import TaskNotFoundException, STATUS_STOPPED, \
         STATUS_RUNNING, STATUS_COMPLETE
+from pydra.cluster.tasks.counters import Counters
 from pydra.logs.logger import get_task_logger
 
 class Task(object):
@@ -47,6 +49,17 @@ class Task(object):
     workunit = None
     STOP_FLAG = False
     form = None
+    _setup_complete = False
+    _local_counters = None
+
+    work_batch = None
+    """
+    Optional vectorized version of `work()`: ``work_batch(items)``.  When
+    defined, a worker running a batch of workunits for this task calls it
+    once with a list of the data of every workunit in the batch, instead of
+    calling `work()` once per workunit.  It must return a list of results in
+    the same order as items.
+    """
 
     msg = None
     description = 'Default description about Task baseclass.'
@@ -105,6 +118,37 @@ class Task(object):
         else:
             raise TaskNotFoundException("Task not found: %s" % task_path)
 
+    def _setup(self):
+        """
+        Calls `setup()` if it has not been called for this instance yet.
+        """
+        if not self._setup_complete:
+            self.logger.debug('%s - Task._setup()' % self)
+            self.setup()
+            self._setup_complete = True
+
+    def _reusable(self):
+        """
+        Whether this instance may be kept to run further workunits.  Only an
+        instance of a class overriding `setup()` that has been set up is
+        reused; any other instance is replaced so state set by `work()` does
+        not leak from one workunit to the next.
+        """
+        return self._setup_complete and \
+            self.__class__.setup.im_func is not Task.setup.im_func
+
+    def _teardown(self):
+        """
+        Calls `teardown()` if `setup()` was called for this instance.
+        
+        Subclasses of `Task` with subtasks should override this method in
+        order to tear down subtasks.
+        """
+        if self._setup_complete:
+            self.logger.debug('%s - Task._teardown()' % self)
+            self._setup_complete = False
+            self.teardown()
+
     def _stop(self):
         """
         Stop the task.
@@ -136,10 +180,30 @@ class Task(object):
         self._callback_args=callback_args
         
         self._status = STATUS_RUNNING
+        self._setup()
         results = self._work(**args)
         
         return results
 
+    def _work_batch(self, items):
+        """
+        Call `work_batch()` for the data of a batch of workunits.
+        
+        :Parameters:
+            items : list
+                data for each workunit
+        
+        :returns: A list of results, one for each item.
+        """
+        self._status = STATUS_RUNNING
+        self._setup()
+        results = self.work_batch(items)
+        if len(results) != len(items):
+            raise ValueError('work_batch() returned %d results for %d items'
+                             % (len(results), len(items)))
+        self._status = STATUS_COMPLETE
+        return results
+
     def _work(self, **kwargs):
         """
         Call `work()`, then `_complete()`.
@@ -200,6 +264,32 @@ class Task(object):
         else:
             return None
 
+    @property
+    def counters(self):
+        """
+        The `Counters` of the worker running this task.  They are sent with
+        the results of the workunit and added up by the main worker and the
+        master.  A task without a worker has counters of its own.
+        """
+        counters = getattr(self.get_worker(), 'counters', None)
+        if counters is None:
+            if self._local_counters is None:
+                self._local_counters = Counters()
+            counters = self._local_counters
+        return counters
+
+    def increment(self, name, amount=1):
+        """
+        Increments a counter, such as the number of records read by the task.
+        
+        :Parameters:
+            name : str
+                Name of the counter
+            amount : int
+                Amount added to the counter
+        """
+        self.counters.increment(name, amount)
+
     def request_worker(self, *args, **kwargs):
         """
         Requests a worker for a subtask from the task's parent.
@@ -249,8 +339,8 @@ class Task(object):
                                              task_id, \
                                              subtask_key, workunit)
             self.logger.debug('Task - got subtask')
-            self.work_deferred = threads.deferToThread(subtask._start, args, \
-                                            callback, callback_args)
+            self._run_in_thread(subtask._start, args, callback, callback_args,
+                                errback, errback_args)
         
         elif self._status == STATUS_RUNNING:
             # only start root task if not already running
@@ -261,17 +351,31 @@ class Task(object):
             
             self.logger.debug('Task - starting task: %s' % self)
             if self.get_worker():
-                self.work_deferred = threads.deferToThread(self._start, args,
-                    callback, callback_args)
+                self._run_in_thread(self._start, args, callback,
+                                    callback_args, errback, errback_args)
             else:
                 # Standalone; just return the result of work()
                 return self.work()
         
-        if errback and self.work_deferred:
-            self.work_deferred.addErrback(errback, **errback_args)
-        
         return 1
 
+    def _run_in_thread(self, f, args, callback, callback_args, errback,
+                       errback_args):
+        """
+        Runs f in the reactor's threadpool.  The threadpool may only be used
+        from the reactor thread, tasks started from another thread, such as
+        the subtasks of a TaskContainer, are handed to the reactor thread.
+        """
+        if not isInIOThread():
+            reactor.callFromThread(self._run_in_thread, f, args, callback,
+                                   callback_args, errback, errback_args)
+            return
+
+        self.work_deferred = threads.deferToThread(f, args, callback,
+                                                   callback_args)
+        if errback:
+            self.work_deferred.addErrback(errback, **errback_args)
+
     def start_subtask(self, subtask, args, workunit, task_id, callback, \
                       callback_args):
         """
@@ -333,6 +437,30 @@ class Task(object):
         
         return self._status
 
+    def setup(self):
+        """
+        Prepare state that is reused by every workunit this instance runs,
+        such as loading a large model or opening database connections.
+        
+        `setup()` is called once per worker, before the first call to
+        `work()`.  A subtask overriding `setup()` is kept by its parent
+        instead of being reinstantiated for each workunit, so held workers
+        only pay the cost of `setup()` once.  Subtasks that don't override it
+        get a new instance for every workunit.  `teardown()` is called when the
+        worker shuts down or switches to another version of the task.
+        
+        The default implementation does nothing.
+        """
+        pass
+
+    def teardown(self):
+        """
+        Release state created by `setup()`.
+        
+        The default implementation does nothing.
+        """
+        pass
+
     def work(self, *args, **kwargs):
         """
         Do the actual computation of the task.
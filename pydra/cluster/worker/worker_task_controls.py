@@ -17,15 +17,21 @@
     along with Pydra.  If not, see <http://www.gnu.org/licenses/>.
 """
 from __future__ import with_statement
-from threading import Lock
+from threading import Event, Lock, Thread
+from Queue import Queue, Empty
+import time
 
 import simplejson
-from twisted.internet import reactor
+from twisted.internet import reactor, threads
+from twisted.python.failure import Failure
+from twisted.python.threadable import isInIOThread
 
 from pydra.cluster.constants import WORKER_STATUS_WORKING, \
         WORKER_STATUS_FINISHED, WORKER_STATUS_IDLE
 from pydra.cluster.module import Module
-from pydra.logs import get_task_logger
+from pydra.cluster.tasks.checkpoint import CheckpointStore
+from pydra.cluster.tasks.counters import Counters
+from pydra.logs import get_task_logger, close_task_logger
 
 # init logging
 import logging
@@ -33,13 +39,44 @@ logger = logging.getLogger('root')
 
 
 def BatchIterator(batch, key, version, task_class, module_search_path, args,
-                  main_worker, task_id, callback):
-    """Creates an iterator used for cycling through workunits in the batch"""
+                  main_worker, task_id, callback, workunit_args=None):
+    """
+    Creates an iterator used for cycling through workunits in the batch.  If
+    workunit_args is given each workunit is run with its own args, otherwise
+    all workunits are run with args.
+    """
     for subtask in batch.keys():
         workunits = batch[subtask]
-        for workunit in workunits:
-            yield key, version, task_class, module_search_path, args, subtask, \
-                workunit, main_worker, task_id, callback
+        if workunit_args:
+            unit_args = workunit_args[subtask]
+        else:
+            unit_args = [args] * len(workunits)
+        for workunit, args_ in zip(workunits, unit_args):
+            yield key, version, task_class, module_search_path, args_, \
+                subtask, workunit, main_worker, task_id, callback
+
+class _WorkUnitResults(object):
+    """
+    Callback for subtasks run by `_run_batch_in_thread()`.  A subtask may
+    complete after `_start()` returns, e.g. a ParallelTask waiting on its own
+    workunits, so the results are taken from the callback and not from the
+    return value of `_start()`.
+    """
+    def __init__(self):
+        self._event = Event()
+        self.results = None
+    
+    def __call__(self, results, **kwargs):
+        self.results = results
+        self._event.set()
+    
+    def wait(self, timeout):
+        """
+        Waits up to timeout seconds for the results, returns whether they
+        were received.
+        """
+        self._event.wait(timeout)
+        return self._event.isSet()
 
 def BatchIteratorNoArgs(batch):
     """Creates an iterator used for cycling through workunits in the batch"""
@@ -61,6 +98,29 @@ class WorkerTaskControls(Module):
         '_lock_connection',
         'task_manager'
     ]
+    
+    results_queue_limit = 1000
+    """
+    When more than this many results are queued on the main worker it
+    throttles the master: receive_results() reports it is throttling and the
+    master stops dispatching workunits for the task until the worker calls
+    results_resumed once the queue has drained to results_queue_resume.
+    """
+    results_queue_resume = 250
+    results_batch_size = 100
+    """Maximum number of queued results processed per batch"""
+    batch_in_thread = True
+    """
+    Run all workunits of a batch in a single worker thread.  Args are parsed
+    and the subtask is resolved once per subtask rather than once per
+    workunit, and the reactor is not involved between workunits.  Setting
+    this to False runs each workunit with its own `_run_task()` call.
+    """
+    batch_poll_interval = 1
+    """
+    Seconds between checks of STOP_FLAG while a batch run in a thread waits
+    for a subtask that completes asynchronously
+    """
 
     def __init__(self):
 
@@ -78,14 +138,39 @@ class WorkerTaskControls(Module):
         self._lock = Lock()
         self._task = None
         self._task_instance = None
+        self._task_version = None
+        self._task_id = None
         self._results = None
         self._stop_flag = None
         self._subtask = None
         self._batch = None
+        self._batch_subtasks = None     # subtask keys of the running batch
+        
+        # counters incremented by the task on this worker that have not been
+        # sent to the master, and on the main worker the counters of the
+        # whole task including those received with results
+        self.counters = Counters()
+        self.task_counters = Counters()
         
         # shutdown tracking
         self._pending_releases = 0
         self._pending_shutdown = False
+        
+        # results ingestion.  results received from other workers are queued
+        # and processed by a consumer thread so the reactor is not blocked
+        # by post-processing in the task.
+        self._results_queue = Queue()
+        self._results_lock = Lock()
+        self._results_consumer = None
+        self._results_throttling = False
+        self._ingestion_stats = {
+            'received':0,
+            'processed':0,
+            'batches':0,
+            'throttled':0,
+            'lag_total':0.0,
+            'lag_max':0.0,
+        }
     
     def _register(self, manager):
         super(WorkerTaskControls, self)._register(manager)
@@ -113,25 +198,232 @@ class WorkerTaskControls(Module):
 
         else:
             #completed normally
+            self._results = self.combine_results(self._results)
+            
             # if the master is still there send the results
             with self._lock_connection:
                 if self.master:
-                    deferred = self.master.callRemote("send_results", self._results)
+                    deferred = self.master.callRemote("send_results",
+                            self._results, self._collect_counters())
                     deferred.addCallback(self.send_successful)
                     deferred.addErrback(self.send_results_failed)
 
 
-    def run_batch(self, key, version, task_class, module_search_path, args,
-                  workunits, main_worker=None, task_id=None):
+    def _collect_counters(self):
         """
-        Creates the batch iterator which will yield arguments for each
-        run_task call, and then starts the batch cycle
+        Collects the counters incremented since results were last sent.  They
+        are added to the counters of the task seen by this worker.
+        """
+        counters = self.counters.collect()
+        self.task_counters.merge(counters)
+        return counters
+
+    def combine_results(self, results):
+        """
+        Merges the results of the batch if the parent of the subtask supports
+        combining results (see `ParallelTask.combine`).  This reduces the
+        number of results the main worker must process to one per batch.
+        
+        Results of a batch mixing workunits of several subtasks are not
+        combined, the results do not record which subtask they belong to.
         """
-        self._results = []
+        with self._lock:
+            subtask_keys = self._batch_subtasks or [self._subtask]
+        if len(subtask_keys) != 1:
+            return results
+        subtask_key = list(subtask_keys)[0]
+        subtask = self._task_instance.get_subtask(subtask_key.split('.'))
+        parent = subtask.parent
+        if getattr(parent, 'combine', None):
+            return parent.combine_results(results)
+        return results
+
+    def run_batch(self, task_tuple, args, workunits, main_worker=None,
+                  task_id=None, workunit_args=None):
+        """
+        Runs a batch of workunits.  Workunits for subtasks that implement
+        `Task.work_batch()` are run with a single call per subtask.  For the
+        remaining workunits the batch iterator is created, which will yield
+        arguments for each run_task call, and then the batch cycle is started.
+        
+        @param task_tuple - task tuple from `TaskManager.retrieve_task()`
+        @param args - kwargs for the task
+        @param workunits - dict of subtask_key: list of workunit keys
+        @param main_worker - key for the main worker of this task
+        @param task_id - ID of the task instance
+        @param workunit_args - dict of subtask_key: list of the args for each
+                               workunit, or None if the workunits use args
+        """
+        key, version, task_class, module_search_path = task_tuple
+        with self._lock:
+            self._task = key
+            self._results = []
+            self._batch_subtasks = set(workunits)
+        self._load_task(key, version, task_class, task_id)
+        
+        vectorized = {}
+        workunits = dict(workunits)
+        for subtask_key in workunits.keys():
+            subtask = self._task_instance.get_subtask(subtask_key.split('.'))
+            # wrappers such as the MapReduce map and reduce wrappers are not
+            # Tasks and have no work_batch
+            if getattr(subtask, 'work_batch', None):
+                vectorized[subtask_key] = workunits.pop(subtask_key)
+        
+        if self.batch_in_thread:
+            deferred = threads.deferToThread(self._run_batch_in_thread,
+                    workunits, vectorized, args, workunit_args, task_id)
+            deferred.addErrback(self._batch_in_thread_failed)
+            deferred.addCallback(lambda x: self.batch_complete())
+            return
+        
         self._batch = BatchIterator(workunits, key, version, task_class, \
                                 module_search_path, args, main_worker, \
-                                task_id, self.batched_work_complete)
-        self.run_next()
+                                task_id, self.batched_work_complete, \
+                                workunit_args)
+        
+        if vectorized:
+            deferred = threads.deferToThread(self._run_work_batches,
+                    vectorized, args, workunit_args, task_id)
+            deferred.addCallback(lambda x: self.run_next())
+        else:
+            self.run_next()
+
+    def _run_batch_in_thread(self, batch, vectorized, args, workunit_args,
+                             task_id):
+        """
+        Runs every workunit of a batch in this thread.  Shared args are parsed
+        once, and the subtask and its logger are resolved once per subtask.
+        A subtask instance that can't be reused (see `Task._reusable()`) is
+        replaced by a clean instance before the next workunit.  The results
+        of each workunit are taken from the callback of the subtask, waiting
+        for subtasks that complete asynchronously.  A workunit that raises
+        an exception is recorded as failed and the rest of the batch
+        continues.
+        
+        This is run in a worker thread.
+        
+        @param batch - dict of subtask_key: list of workunit keys
+        @param vectorized - dict of subtask_key: list of workunit keys for
+                            subtasks that implement `Task.work_batch()`
+        @param args - kwargs for the task
+        @param workunit_args - dict of subtask_key: list of the args for each
+                               workunit, or None if the workunits use args
+        @param task_id - ID of the task instance
+        """
+        if vectorized:
+            self._run_work_batches(vectorized, args, workunit_args, task_id)
+        
+        shared_args = None
+        for subtask_key, workunits in batch.items():
+            if self._task_instance.STOP_FLAG:
+                return
+            
+            with self._lock:
+                self._subtask = subtask_key
+            
+            if workunit_args:
+                unit_args = [self._parse_args(a) for a in \
+                                                workunit_args[subtask_key]]
+            else:
+                if shared_args is None:
+                    shared_args = self._parse_args(args)
+                unit_args = [shared_args] * len(workunits)
+            
+            task_path = subtask_key.split('.')
+            subtask = self._task_instance.get_subtask(task_path, True)
+            task_logger = get_task_logger(self.worker_key, task_id,
+                                          subtask_key)
+            results = []
+            try:
+                for workunit, unit_args_ in zip(workunits, unit_args):
+                    if self._task_instance.STOP_FLAG:
+                        return
+                    if subtask is None:
+                        # the last instance can't be reused
+                        subtask = self._task_instance.get_subtask(task_path,
+                                                                  True)
+                    subtask.logger = task_logger
+                    callback = _WorkUnitResults()
+                    try:
+                        subtask._start(unit_args_, callback)
+                        while not callback.wait(self.batch_poll_interval):
+                            if self._task_instance.STOP_FLAG:
+                                return
+                        results.append((workunit, callback.results, False))
+                    except Exception, e:
+                        results.append((workunit, Failure().getTraceback(),
+                                        True))
+                    # wrappers are not Tasks and are always reused
+                    reusable = getattr(subtask, '_reusable', None)
+                    if reusable and not reusable():
+                        subtask = None
+            finally:
+                close_task_logger(task_logger)
+                with self._lock:
+                    self._results.extend(results)
+
+    def _batch_in_thread_failed(self, failure):
+        """
+        Errback for `_run_batch_in_thread()`.  Failures of workunits are
+        recorded as results so this is only reached by errors in the worker.
+        """
+        logger.error('Error running batch: %s' % failure.getTraceback())
+
+    def _run_work_batches(self, batch, args, workunit_args, task_id):
+        """
+        Runs workunits with `Task.work_batch()`, one call per subtask.  The
+        results are split back into the results of each workunit.  If
+        work_batch() raises an exception every workunit in the call fails.
+        
+        This is run in a worker thread.
+        """
+        for subtask_key, workunits in batch.items():
+            if self._task_instance.STOP_FLAG:
+                return
+            
+            with self._lock:
+                self._subtask = subtask_key
+            
+            if workunit_args:
+                unit_args = [self._parse_args(a) for a in \
+                                                workunit_args[subtask_key]]
+            else:
+                unit_args = [self._parse_args(args)] * len(workunits)
+            items = [a.get('data', None) for a in unit_args]
+            
+            subtask = self._task_instance.get_subtask(subtask_key.split('.'),
+                                                      True)
+            subtask.logger = get_task_logger(self.worker_key, task_id,
+                                             subtask_key)
+            try:
+                results = subtask._work_batch(items)
+                results = [(workunit, result, False) for workunit, result \
+                                in zip(workunits, results)]
+            except Exception, e:
+                logger.exception('work_batch failed for %s' % subtask_key)
+                failure = Failure().getTraceback()
+                results = [(workunit, failure, True) for workunit in workunits]
+            finally:
+                close_task_logger(subtask.logger)
+            
+            with self._lock:
+                self._results.extend(results)
+
+    def _parse_args(self, args):
+        """
+        If args is a string, it may be unicode instead of str. This is a
+        Django issue. Try to make everybody happy by treating the string as
+        JSON.
+        """
+        # This is almost certainly the wrong thing to do, but it's historical.
+        try:
+            return dict(
+                    (str(k), v) for k, v in
+                    simplejson.loads(args).iteritems()
+            )
+        except:
+            return args
 
     def run_next(self):
         """
@@ -146,7 +438,7 @@ class WorkerTaskControls(Module):
             self.batch_complete()
 
     def run_task(self, key, version, args={}, workunits=None, \
-                    main_worker=None, task_id=None):
+                    main_worker=None, task_id=None, workunit_args=None):
         
         if workunits and (len(workunits.values()[0]) > 1 or len(workunits) > 1):
             # batch exists if there is more than one workunit for the first
@@ -154,7 +446,7 @@ class WorkerTaskControls(Module):
             # check all of the subtasks
             deferred = self.task_manager.retrieve_task(key, version)
             deferred.addCallback(self.run_batch, args, workunits, main_worker,
-                task_id)
+                task_id, workunit_args)
         else:
             # no batch or single workunit in batch, can skip batching mechanism
             if workunits:
@@ -202,37 +494,43 @@ class WorkerTaskControls(Module):
             self._task = key
             self._subtask = subtask_key
 
-        # If args is a string, it may be unicode instead of str. This is a
-        # Django issue. Try to make everybody happy by treating the string as
-        # JSON.
+        clean_args = self._parse_args(args)
+        self._load_task(key, version, task_class, task_id, subtask_key)
+
+        # start the task.  If this is actually a subtask, then the task is
+        # responsible for starting the subtask instead of the main task
+        return self._task_instance.start(clean_args, subtask_key, workunit,
+                        task_id, \
+                        callback=callback,
+                        callback_args = {'workunit':workunit},
+                        errback=callback,
+                        errback_args={'workunit':workunit, 'failed':True})
 
-        # This is almost certainly the wrong thing to do, but it's historical.
-        try:
-            clean_args = dict(
-                    (str(k), v) for k, v in
-                    simplejson.loads(args).iteritems()
-            )
-        except:
-            clean_args = args
+
+    def _load_task(self, key, version, task_class, task_id,
+                   subtask_key=None):
+        """
+        Creates the task instance if this worker does not already have an
+        instance of this version of the task.
+        """
+        # a held worker may be sent work for a different version of the task.
+        # the old instance is torn down so it can't be reused.
+        if self._task_instance and self._task_version != (key, version):
+            self.teardown_task()
 
         # only create a new task instance if this is the root task.  Otherwise
         # subtasks will be created within the structure of the task.
         if not self._task_instance:
+            self._task_version = (key, version)
+            self._task_id = task_id
+            self.counters = Counters()
+            self.task_counters = Counters()
             self._task_instance = task_class()
             self._task_instance.parent = self
             if not subtask_key:
                 self._task_instance.logger = get_task_logger(self.worker_key, \
                                                                 task_id)
 
-        # start the task.  If this is actually a subtask, then the task is
-        # responsible for starting the subtask instead of the main task
-        return self._task_instance.start(clean_args, subtask_key, workunit,
-                        task_id, \
-                        callback=callback,
-                        callback_args = {'workunit':workunit},
-                        errback=callback,
-                        errback_args={'workunit':workunit, 'failed':True})
-
 
     def stop_task(self):
         """
@@ -243,6 +541,22 @@ class WorkerTaskControls(Module):
             self._task_instance._stop()
             
 
+    def teardown_task(self):
+        """
+        Tears down the current task instance, releasing any state created by
+        `Task.setup()` in it or its subtasks.
+        """
+        if self._task_instance:
+            logger.debug('Tearing down task: %s' % (self._task_version,))
+            try:
+                self._task_instance._teardown()
+            except Exception, e:
+                logger.exception('Error tearing down task')
+            self._task_instance = None
+            self._task_version = None
+            self._task_id = None
+
+
     def status(self):
         """
         Return the status of the current task if running, else None
@@ -296,6 +610,11 @@ class WorkerTaskControls(Module):
                         worker
         @param failed - was there an exception thrown in the task
         """
+        # tasks complete in a worker thread, or in the results consumer
+        if not isInIOThread():
+            reactor.callFromThread(self.work_complete, results, workunit,
+                                   failed)
+            return
         
         # create traceback if its an error
         if failed:
@@ -319,7 +638,8 @@ class WorkerTaskControls(Module):
             results = ((workunit, results, failed),)
             with self._lock_connection:
                 if self.master:
-                    deferred = self.master.callRemote("send_results", results)
+                    deferred = self.master.callRemote("send_results", results,
+                                                      self._collect_counters())
                     deferred.addCallback(self.send_successful)
                     deferred.addErrback(self.send_results_failed)
                 
@@ -387,18 +707,135 @@ class WorkerTaskControls(Module):
             return self._task_instance.progress()
 
 
-    def receive_results(self, worker_key, results, subtask_key):
+    def receive_results(self, worker_key, results, subtask_key,
+                        counters=None):
         """
         Function called to make the subtask receive the results processed by
         another worker.  This call is ignored if STOP flag is already set.
+        The counters sent with the results are added to the counters of the
+        task.
+        
+        Results are queued and passed to the subtask by a consumer thread.
+        The response is the `ingestion_stats()` of this worker, which tells
+        the master whether the worker is throttling it because the queue has
+        grown past results_queue_limit.
         """
-        if not self._task_instance.STOP_FLAG:
-            logger.info('received REMOTE results for: %s' % subtask_key)
-            subtask = self._task_instance.get_subtask(subtask_key.split('.'))
-            for key, result, failed in results:
-                if failed:
-                    continue
-                subtask.parent._work_unit_complete(result, key)
+        if self._task_instance.STOP_FLAG:
+            return
+        
+        logger.info('received REMOTE results for: %s' % subtask_key)
+        if counters:
+            self.task_counters.merge(counters)
+        with self._results_lock:
+            if not self._results_consumer:
+                self._results_consumer = Thread(target=self._consume_results)
+                self._results_consumer.setDaemon(True)
+                self._results_consumer.start()
+            
+            self._results_queue.put((time.time(), subtask_key, results))
+            self._ingestion_stats['received'] += len(results)
+            
+            if not self._results_throttling and \
+                    self._results_queue.qsize() > self.results_queue_limit:
+                logger.debug('results queue is full, throttling master')
+                self._ingestion_stats['throttled'] += 1
+                self._results_throttling = True
+        
+        return self.ingestion_stats()
+
+    def _consume_results(self):
+        """
+        Consumer thread for queued results.  Results are processed in batches
+        of up to results_batch_size.  A None in the queue stops the thread.
+        """
+        stop = False
+        while not stop:
+            batch = [self._results_queue.get()]
+            try:
+                while len(batch) < self.results_batch_size:
+                    batch.append(self._results_queue.get_nowait())
+            except Empty:
+                pass
+            
+            if None in batch:
+                batch = batch[:batch.index(None)]
+                stop = True
+            
+            lag = 0.0
+            for queued, subtask_key, results in batch:
+                try:
+                    self._process_results(subtask_key, results)
+                except Exception, e:
+                    logger.exception('Error processing results for %s' % \
+                                     subtask_key)
+                lag = time.time() - queued
+                
+                with self._results_lock:
+                    stats = self._ingestion_stats
+                    stats['processed'] += len(results)
+                    stats['lag_total'] += lag * len(results)
+                    stats['lag_max'] = max(stats['lag_max'], lag)
+            
+            if not batch:
+                continue
+            
+            with self._results_lock:
+                self._ingestion_stats['batches'] += 1
+                if self._results_throttling and \
+                        self._results_queue.qsize() <= self.results_queue_resume:
+                    self._results_throttling = False
+                    reactor.callFromThread(self._resume_results)
+            logger.debug('processed %s queued results, lag %.3fs' % \
+                         (len(batch), lag))
+
+    def _process_results(self, subtask_key, results):
+        """
+        Passes results to the subtask that requested the workunits.
+        
+        This is run in the consumer thread.  Calls the task makes to this
+        worker, such as request_worker(), are handed to the reactor thread.
+        """
+        if self._task_instance.STOP_FLAG:
+            return
+        subtask = self._task_instance.get_subtask(subtask_key.split('.'))
+        if len(results) > 1 and getattr(subtask.parent, 'combine', None):
+            # results of several batches of a node, sent together by the
+            # master
+            results = subtask.parent.combine_results(results)
+        for key, result, failed in results:
+            if failed:
+                continue
+            subtask.parent._work_unit_complete(result, key)
+
+    def _resume_results(self):
+        """
+        Informs the master that the results queue has drained so it resumes
+        dispatching workunits for the task.
+        """
+        with self._lock_connection:
+            if self.master:
+                self.master.callRemote('results_resumed',
+                                       self.ingestion_stats())
+
+    def ingestion_stats(self):
+        """
+        Returns statistics about results received by this worker:
+            * received - number of results received
+            * processed - number of results passed to the task
+            * queued - number of received results waiting to be processed
+            * batches - number of batches processed by the consumer thread
+            * throttled - number of times the master was throttled
+            * throttling - whether the master is being throttled
+            * lag_avg, lag_max - seconds between receiving and processing
+        """
+        with self._results_lock:
+            stats = dict(self._ingestion_stats)
+            stats['throttling'] = self._results_throttling
+        stats['queued'] = self._results_queue.qsize()
+        stats['lag_avg'] = stats['lag_total'] / stats['processed'] \
+                                if stats['processed'] else 0.0
+        del stats['lag_total']
+        return stats
 
 
     def release_worker(self):
@@ -416,16 +853,27 @@ class WorkerTaskControls(Module):
                 return
         
         logger.debug('Released, shutting down')
+        if self._results_consumer:
+            self._results_queue.put(None)
+        self.teardown_task()
         self.emit('WORKER_FINISHED')
         reactor.stop()
 
 
-    def request_worker(self, subtask_key, args, workunit_key):
+    def request_worker(self, subtask_key, args, workunit_key, data_size=None):
         """
         Requests a work unit be handled by another worker in the cluster
+
+        @param data_size - estimated bytes of data in the work unit, if known
         """
+        if not isInIOThread():
+            reactor.callFromThread(self.request_worker, subtask_key, args,
+                                   workunit_key, data_size)
+            return
+        
         logger.info('requesting worker for: %s' % subtask_key)
-        deferred = self.master.callRemote('request_worker', subtask_key, args, workunit_key)
+        deferred = self.master.callRemote('request_worker', subtask_key, args,
+                                          workunit_key, data_size)
 
 
     def request_worker_release(self):
@@ -434,6 +882,10 @@ class WorkerTaskControls(Module):
         specify which worker to release because the main worker does not know
         which worker is optimal to release if there is a choice.
         """
+        if not isInIOThread():
+            reactor.callFromThread(self.request_worker_release)
+            return
+        
         with self._lock:
             self._pending_releases += 1
             deferred = self.master.callRemote('request_worker_release')
@@ -469,6 +921,17 @@ class WorkerTaskControls(Module):
         return None    
 
 
+    def get_checkpoint_store(self, task):
+        """
+        Returns a CheckpointStore for a task run by this worker.  Checkpoints
+        are kept on this node so a main worker restarted here for the same
+        task instance can resume.
+        """
+        if self._task_id is None:
+            return None
+        return CheckpointStore(self._task_id, task.get_key())
+
+
     def subtask_started(self, batch):
         """
         Called to inform the task that a queued subtask was started on a remote
@@ -16,6 +16,32 @@
     You should have received a copy of the GNU General Public License
     along with Pydra.  If not, see <http://www.gnu.org/licenses/>.
 """
+from __future__ import with_statement
+
+import cPickle
+import multiprocessing
+import signal
+import time
+import traceback
+from threading import Lock
+
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred
+from twisted.python.failure import Failure
+
+from pydra.cluster.tasks.counters import Counters
+
+import logging
+logger = logging.getLogger('root')
+
+
+class WorkUnitFailed(Exception):
+    """
+    Raised (as a Failure) when a workunit run by a `LocalWorker` throws an
+    exception.  The value is the formatted traceback from the process that ran
+    the workunit.
+    """
+    pass
 
 
 class WorkerProxy():
@@ -23,11 +49,278 @@ class WorkerProxy():
     Proxy for a Worker used when running a task from the commandline.  When
     run from the command line or in another script there will be no worker
     associated with the Task.  Several functions of the task require a worker
-    this proxy class fills in that role by implementing the same methods, 
+    this proxy class fills in that role by implementing the same methods,
     though they rarely actually do anything
     """
 
     worker_key = 'Worker_Proxy'
 
     def get_worker(self):
-        return self
\ No newline at end of file
+        return self
+
+    def get_key(self):
+        """
+        recursive task key generation function.  This stops the recursion
+        """
+        return None
+
+    def request_worker_release(self):
+        pass
+
+    def get_checkpoint_store(self, task):
+        """
+        Tasks run without a cluster are not checkpointed.
+        """
+        return None
+
+
+def run_work_unit(task_class, subtask_key, args, workunit, worker=None):
+    """
+    Runs a single workunit the same way a Worker would: a root task is
+    instantiated, the subtask is looked up by its key, and it is started with
+    the args sent with the work request.
+
+    This function is run inside the processes of a `LocalWorker` pool so
+    task_class must be importable by those processes.
+
+    @param task_class - class of the root task
+    @param subtask_key - key identifying the subtask to run
+    @param args - kwargs that will be passed to the subtask
+    @param workunit - key of the workunit
+    @param worker - worker proxy the root task is run by, defaults to a new
+                    `WorkerProxy`
+    @returns tuple(workunit, results, failed) in the same format a Worker
+             sends results.  If the workunit failed results is the traceback.
+    """
+    try:
+        task = task_class()
+        task.parent = worker or WorkerProxy()
+        subtask = task.get_subtask(subtask_key.split('.'), True)
+        results = subtask._start(args, _discard_results)
+        return workunit, results, False
+    except Exception:
+        return workunit, traceback.format_exc(), True
+
+
+def run_counted_work_unit(task_class, subtask_key, args, workunit):
+    """
+    Runs a workunit with `run_work_unit()`, also returning the counters it
+    incremented.
+
+    @returns tuple(results, counters) where results is the tuple returned by
+             `run_work_unit()` and counters is a dict
+    """
+    worker = WorkerProxy()
+    worker.counters = Counters()
+    result = run_work_unit(task_class, subtask_key, args, workunit, worker)
+    return result, worker.counters.collect()
+
+
+def run_pickled_work_unit(pickled):
+    """
+    Runs a workunit with `run_counted_work_unit()` from its pickled args,
+    returning the pickled result.  `LocalWorker` pickles both itself so that
+    args or results that can't be pickled fail the workunit, rather than
+    being dropped by the pool without calling back.
+
+    @param pickled - pickled tuple of args for `run_counted_work_unit()`
+    @returns pickled tuple(results, counters)
+    """
+    args = cPickle.loads(pickled)
+    result = run_counted_work_unit(*args)
+    try:
+        return cPickle.dumps(result, cPickle.HIGHEST_PROTOCOL)
+    except Exception:
+        workunit = args[3]
+        return cPickle.dumps(((workunit, traceback.format_exc(), True), {}),
+                             cPickle.HIGHEST_PROTOCOL)
+
+
+def _init_process():
+    """
+    Initializes a `LocalWorker` pool process.  The signal handlers installed
+    by the reactor are inherited by the forked processes, restore the defaults
+    so the pool can terminate them.
+    """
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+
+
+def _discard_results(results, **kwargs):
+    """
+    Callback for subtasks run by `run_work_unit()`, results are returned by
+    `_start()` instead.
+    """
+    pass
+
+
+class LocalWorker(WorkerProxy):
+    """
+    Worker that runs an entire task tree on this host, without a Master or
+    Node.  The root task runs in this process, and workunits requested through
+    `request_worker()` are run in a `multiprocessing` pool.  Results are
+    returned to the task with `_work_unit_complete()` on the reactor thread,
+    the same as `WorkerTaskControls.receive_results()`.
+
+    Setting processes to 0 runs workunits in the reactor's threadpool instead
+    of a process pool.  This is useful for debugging and as a baseline for
+    measuring the overhead of the cluster.
+
+    Timing and workunit counters for the last run, including the estimated
+    bytes of data requested, are kept in `stats`.  The
+    counters incremented by the task and its workunits are added up in
+    `counters`.
+    """
+
+    worker_key = 'Local_Worker'
+
+    def __init__(self, processes=None):
+        """
+        @param processes - number of processes in the pool.  defaults to the
+                           number of cores.  0 runs workunits in threads.
+        """
+        self.processes = processes
+        self.stats = {}
+        self.counters = Counters()
+        self._lock = Lock()
+        self._pool = None
+        self._task = None
+        self._deferred = None
+
+    def run(self, task, args={}):
+        """
+        Runs a task.  The reactor must be running, or started after this
+        call, for the task to make progress.
+
+        @param task - root task to run
+        @param args - kwargs passed to the task
+        @returns a Deferred that fires with the results of the task
+        """
+        if self.processes != 0:
+            self._pool = multiprocessing.Pool(self.processes, _init_process)
+
+        self._task = task
+        self._deferred = Deferred()
+        self.counters = Counters()
+        self.stats = {
+            'requested':0,
+            'data_size':0,
+            'completed':0,
+            'released':0,
+            'started':time.time(),
+            'elapsed':None
+        }
+
+        task.parent = self
+        task.start(args=args, callback=self._task_complete,
+                   errback=self._task_failed)
+        return self._deferred
+
+    def request_worker(self, subtask_key, args, workunit_key, data_size=None):
+        """
+        Runs a workunit in the pool.  Called by tasks the same way they would
+        request a worker from the cluster.
+        """
+        with self._lock:
+            self.stats['requested'] += 1
+            if data_size:
+                self.stats['data_size'] += data_size
+
+        args = (self._task.__class__, subtask_key, args, workunit_key)
+        if self._pool:
+            try:
+                pickled = cPickle.dumps(args, cPickle.HIGHEST_PROTOCOL)
+            except Exception:
+                result = (workunit_key, traceback.format_exc(), True)
+                reactor.callFromThread(self.receive_results, subtask_key,
+                                       result)
+                return
+            self._pool.apply_async(run_pickled_work_unit, (pickled,),
+                callback=lambda result: reactor.callFromThread(
+                    self.receive_results, subtask_key, *cPickle.loads(result)))
+        else:
+            reactor.callFromThread(reactor.callInThread, self._run_in_thread,
+                                   subtask_key, *args)
+
+    def _run_in_thread(self, subtask_key, *args):
+        result, counters = run_counted_work_unit(*args)
+        reactor.callFromThread(self.receive_results, subtask_key, result,
+                               counters)
+
+    def request_worker_release(self):
+        """
+        There are no held workers to release, only counted.
+        """
+        with self._lock:
+            self.stats['released'] += 1
+
+    def receive_results(self, subtask_key, result, counters=None):
+        """
+        Passes the results of a workunit to the task that requested it.  A
+        failed workunit fails the whole run.
+        """
+        workunit, results, failed = result
+        if not self._deferred or self._deferred.called:
+            return
+        if counters:
+            self.counters.merge(counters)
+
+        if failed:
+            logger.error('LocalWorker - workunit %s failed: %s' %
+                         (workunit, results))
+            self._task._stop()
+            self._finish(Failure(WorkUnitFailed(results)))
+            return
+
+        with self._lock:
+            self.stats['completed'] += 1
+        subtask = self._task.get_subtask(subtask_key.split('.'))
+        subtask.parent._work_unit_complete(results, workunit)
+
+    def _task_complete(self, results, **kwargs):
+        reactor.callFromThread(self._finish, results)
+
+    def _task_failed(self, failure, **kwargs):
+        reactor.callFromThread(self._finish, failure)
+
+    def _finish(self, results):
+        if self._deferred.called:
+            return
+        self.stats['elapsed'] = time.time() - self.stats['started']
+        if self._pool:
+            # workunits may still be running if the task failed
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+
+        if isinstance(results, Failure):
+            self._deferred.errback(results)
+        else:
+            self._deferred.callback(results)
+
+
+def run_local(task, args={}, processes=None):
+    """
+    Runs a task on this host using a `LocalWorker`, blocking until it
+    completes.  This runs the reactor, so it may only be used once per
+    process; use `LocalWorker.run()` from code that runs its own reactor.
+
+    @param task - root task to run
+    @param args - kwargs passed to the task
+    @param processes - size of the process pool, see `LocalWorker`
+    @returns the results of the task
+    """
+    worker = LocalWorker(processes)
+    outcome = []
+
+    def start():
+        deferred = worker.run(task, args)
+        deferred.addBoth(outcome.append)
+        deferred.addBoth(lambda x: reactor.stop())
+
+    reactor.callWhenRunning(start)
+    reactor.run()
+
+    if isinstance(outcome[0], Failure):
+        outcome[0].raiseException()
+    return outcome[0]
@@ -16,4 +16,5 @@
     You should have received a copy of the GNU General Public License
     along with Pydra.  If not, see <http://www.gnu.org/licenses/>.
 """
-from pydra.logs.logger import init_logging, get_task_logger
\ No newline at end of file
+from pydra.logs.logger import init_logging, get_task_logger, \
+    close_task_logger
\ No newline at end of file
@@ -140,3 +140,17 @@ def get_task_logger(worker, task, subtask=None, workunit=None):
     logger.setLevel(settings.LOG_LEVEL)
 
     return logger
+
+
+def close_task_logger(logger):
+    """
+    Closes and removes the file handlers added to a logger by
+    `get_task_logger()`.  Loggers for workunits are only used once, closing
+    them keeps a worker running many workunits from leaking open files.
+
+    @param logger: logger returned by get_task_logger()
+    """
+    for handler in list(logger.handlers):
+        if isinstance(handler, FileHandler):
+            logger.removeHandler(handler)
+            handler.close()
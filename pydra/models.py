@@ -157,10 +157,13 @@ class TaskInstance(AbstractJob):
     run and whether it completed.
 
     queued:        Datetime when this task instance was queued
+    counters:      Counters incremented by the task, added up from the
+                   results of every workunit
     """
     queued  = models.DateTimeField(auto_now_add=True)
     results_json = models.TextField(null=True)
     results = None
+    counters_json = models.TextField(null=True)
     objects = TaskInstanceManager()
     workunit = None #not used, included for compatibility with WorkUnit
     
@@ -173,16 +176,26 @@ class TaskInstance(AbstractJob):
         self.last_succ_time   = None # when this task last time gets a worker
         self._worker_requests = [] # List of WorkUnit objects
         self.local_workunit   = None # a workunit executed by main worker
+        self.results_throttled = False # main worker is throttling results
+        self.ingestion_stats  = None # last ingestion stats of the main worker
+        self.checkpoint_node  = None # node of the failed main worker, the
+                                     # task is restarted there
     
         # others
         self._request_lock = Lock()
         
         if self.results_json:
             self.results = simplejson.loads(self.results_json)
+        if self.counters_json:
+            self.counters = simplejson.loads(self.counters_json)
+        else:
+            self.counters = {}
 
     def save(self, *args, **kwargs):
         if self.results:
             self.results_json = simplejson.dumps(self.results)
+        if self.counters:
+            self.counters_json = simplejson.dumps(self.counters)
         super(TaskInstance, self).save(*args, **kwargs)
 
     def __getattribute__(self, key):
@@ -233,6 +246,9 @@ class TaskInstance(AbstractJob):
     def transmitable(self):
         return None
 
+    def transmitable_args(self):
+        return None
+
     def compute_score(self):
         """
         Computes a priority score for this task, which will be used by the
@@ -268,7 +284,8 @@ class TaskInstance(AbstractJob):
                                                     if self.started else None,
             'completed':self.completed.strftime('%Y-%m-%d %H:%m:%S') \
                                                     if self.completed else None,
-            'results':self.results
+            'results':self.results,
+            'counters':self.counters
         }
 
     def queue_worker_request(self, request):
@@ -320,10 +337,13 @@ class WorkUnit(AbstractJob):
     workunit:  key that uniquely identifies this workunit within the 
                 datasource for the task.  This might also be the data itself
                 depending on how the key was initialized
+    data_size: estimated bytes of data in this workunit, if the task
+                estimated it
     """
     task_instance = models.ForeignKey(TaskInstance, related_name='workunits')
     workunit      = models.CharField(max_length=255)
     size          = models.IntegerField(default=1)
+    data_size     = models.BigIntegerField(null=True)
 
     def __getattribute__(self, key):
         if key == 'task_id':
@@ -343,12 +363,17 @@ class WorkUnit(AbstractJob):
                                                 if self.completed else None,
             'worker':self.worker,
             'status':self.status,
-            'log_retrieved':self.log_retrieved
+            'log_retrieved':self.log_retrieved,
+            'data_size':self.data_size
         }
 
     def transmitable(self):
         return {self.subtask_key:[self.workunit]}
 
+    def transmitable_args(self):
+        """ args for a single workunit are sent as the args of the job """
+        return None
+
 
 class Batch(AbstractJob):
     """
@@ -361,20 +386,12 @@ class Batch(AbstractJob):
     size          = models.IntegerField(default=1)
     
     def __init__(self, iterator=None):
+        self.workunits = {}
+        self._transmitable = {}
+        self._transmitable_args = {}
         if iterator:
-            workunits = {}
-            batch = {}
             for workunit in iterator:
-                workunits[workunit.workunit] = workunit
-                try:
-                    batch[workunit.subtask_key].append(workunit.workunit)
-                except KeyError:
-                    batch[workunit.subtask_key] = [workunit.workunit]
-            self.workunits = workunits
-            self._transmitable = batch
-        else:
-            self.workunits = []
-            self._transmitable = {}
+                self.add(workunit)
     
     def __getattribute__(self, key):
         if key == 'task_id':
@@ -404,11 +421,13 @@ class Batch(AbstractJob):
         """
         Adds a workunit to this batch
         """
-        self.workunits.append(workunit)
+        self.workunits[workunit.workunit] = workunit
         try:
             self._transmitable[workunit.subtask_key].append(workunit.workunit)
+            self._transmitable_args[workunit.subtask_key].append(workunit.args)
         except KeyError:
             self._transmitable[workunit.subtask_key] = [workunit.workunit]
+            self._transmitable_args[workunit.subtask_key] = [workunit.args]
     
     def save(self):
         """
@@ -419,3 +438,10 @@ class Batch(AbstractJob):
     
     def transmitable(self):
         return self._transmitable
+
+    def transmitable_args(self):
+        """
+        Returns the args of each workunit, in the same structure as
+        transmitable().  The args of the batch are the args of the task.
+        """
+        return self._transmitable_args
@@ -352,6 +352,21 @@ class TaskScheduler_Scheduling(TaskScheduler_Base):
         # verify schedule is advanced        
         self.assert_(s._schedule.calls, "scheduler wasn't advanced")
     
+    def test_queue_subtask_data_size(self):
+        """
+        Verifies:
+            * the estimated size of the workunit is saved with it
+        """
+        s = self.scheduler
+        response, worker, task = self.queue_and_run_task(True)
+        s._schedule.disable()
+        task = s.get_worker_job(worker.name)
+        job = s.request_worker(worker.name, 'test.foo.bar', 'args',
+                               'workunit_key', 1048576)
+        self.assertEqual(job.data_size, 1048576)
+        self.assertEqual(task.workunits.all()[0].data_size, 1048576)
+        self.assertEqual(job.json_safe()['data_size'], 1048576)
+    
     def test_queue_task_unknown_task(self):
         """
         A subtask request is submitted from a worker not running a task
@@ -596,6 +611,126 @@ class TaskScheduler_Scheduling(TaskScheduler_Base):
         self.assert_(task.status==STATUS_FAILED, task.status)
         self.assertSchedulerAdvanced()
     
+    def test_remove_main_worker(self):
+        """
+        The main worker of a running task disconnects
+        
+        Verifies:
+            * worker is removed from the active and main worker pools
+            * task is requeued as a root task with no workunit requests
+            * scheduler is advanced
+        """
+        s = self.scheduler
+        response, main_worker, task = self.queue_and_run_task(True)
+        s._schedule.disable()
+        s.request_worker(main_worker.name, 'test.foo.bar', 'args', 1)
+        
+        s.remove_worker(main_worker.name)
+        self.assertFalse(main_worker.name in s._active_workers)
+        self.assertFalse(main_worker.name in s._main_workers)
+        self.assertEqual(task.worker, None)
+        self.assertEqual(task.status, STATUS_STOPPED)
+        self.assertEqual(task._worker_requests, [task])
+        self.assertEqual(task.checkpoint_node, 'localhost')
+        self.assert_(task.id in s._active_tasks)
+        self.assertSchedulerAdvanced()
+
+    def test_remove_main_worker_resets_workers(self):
+        """
+        The main worker of a task with running and held workers disconnects
+        
+        Verifies:
+            * held workers are released to the idle pool
+            * results of running workers are discarded and the workers
+              returned to the idle pool
+        """
+        s = self.scheduler
+        response, main_worker, task = self.queue_and_run_task(True)
+        task = s.get_worker_job(main_worker.name)
+        task.local_workunit = task
+        self.add_worker(True)
+        self.add_worker(True)
+        (held_key, task_id), subtask = \
+            self.queue_and_run_subtask(main_worker, True, 1)
+        (running_key, task_id), other_subtask = \
+            self.queue_and_run_subtask(main_worker, True, 2)
+        s.send_results(held_key, ((subtask.subtask_key, 'woot!', False),))
+        self.assertEqual(task.waiting_workers, [held_key])
+        main_worker.remote.calls = []
+        
+        s.remove_worker(main_worker.name)
+        self.assertEqual(task.running_workers, [])
+        self.assertEqual(task.waiting_workers, [])
+        self.assert_(held_key in s._idle_workers)
+        self.assertFalse(held_key in s._waiting_workers)
+        s.workers[held_key].assertCalled(self, 'release_worker')
+        
+        s.send_results(running_key, ((other_subtask.subtask_key, 'stale',
+                                      False),))
+        self.assert_(running_key in s._idle_workers)
+        self.assertFalse(running_key in s._active_workers)
+        self.assertEqual(main_worker.remote.calls, [])
+
+    def test_restart_on_checkpoint_node(self):
+        """
+        A task whose main worker failed is restarted
+        
+        Verifies:
+            * an idle worker of the node holding the checkpoints is chosen
+            * no other worker is chosen while that node has workers
+            * any worker is chosen once the node is gone
+        """
+        s = self.scheduler
+        response, main_worker, task = self.queue_and_run_task(True)
+        s.remove_worker(main_worker.name)
+        del s.workers[main_worker.name]
+        
+        other = RemoteProxy('remote:0')
+        s.workers[other.name] = other
+        s._idle_workers.append(other.name)
+        local = self.add_worker()
+        s._schedule.enable()
+        self.assertEqual(s._schedule(), None)
+        self.assertEqual(s._idle_workers, [other.name])
+        
+        s._idle_workers.append(local.name)
+        self.assertEqual(s._schedule()[0], local.name)
+        self.assertEqual(s._idle_workers, [other.name])
+        self.assertEqual(task.checkpoint_node, None)
+        
+        task.worker = None
+        task.checkpoint_node = 'gone'
+        del s.workers[local.name]
+        task.queue_worker_request(task)
+        self.assertEqual(s._schedule()[0], other.name)
+
+    def test_restart_on_checkpoint_node_skipped(self):
+        """
+        A task whose main worker failed waits for a worker of the node
+        holding its checkpoints while other tasks are queued
+        
+        Verifies:
+            * the next queued task is given the idle worker of another node
+            * the restarted task is still queued
+        """
+        s = self.scheduler
+        response, main_worker, task = self.queue_and_run_task(True)
+        s.remove_worker(main_worker.name)
+        local = self.add_worker()
+        
+        s._schedule.disable()
+        queued = s._queue_task('foo.bar')
+        other = RemoteProxy('remote:0')
+        s.workers[other.name] = other
+        s._idle_workers.append(other.name)
+        s._schedule.enable()
+        
+        worker_key, task_id = s._schedule()
+        self.assertEqual(worker_key, other.name)
+        self.assertEqual(task_id, queued.id)
+        self.assert_(task.poll_worker_request())
+        self.assertEqual(task.checkpoint_node, 'localhost')
+
     def test_task_completed(self):
         """
         Verifies:
@@ -652,6 +787,29 @@ class TaskScheduler_Scheduling(TaskScheduler_Base):
         self.assertCalled(main_worker, 'receive_results')
         self.assertSchedulerAdvanced()
     
+    def test_subtask_completed_counters(self):
+        """
+        subtask on non-main_worker completes and sends counters
+        
+        Verifies:
+            * counters are added to the counters of the task
+            * counters are passed on to the mainworker with the results
+        """
+        s = self.scheduler
+        response, main_worker, task = self.queue_and_run_task(True)
+        task = self.scheduler.get_worker_job(main_worker.name)
+        other_worker = self.add_worker(True)
+        subtask_response, subtask = self.queue_and_run_subtask(main_worker, True)
+        subtask_response, subtask = self.queue_and_run_subtask(main_worker, True)
+        task.counters = {'records':1}
+        s.send_results(other_worker.name, ((subtask.workunit, 'results: woot!',
+                                    False),), {'records':2, 'bytes':10})
+        
+        self.assertEqual(task.counters, {'records':3, 'bytes':10})
+        args, kwargs, deferred = main_worker.remote.assertCalled(self,
+                                                            'receive_results')
+        self.assertEqual(args[-1], {'records':2, 'bytes':10})
+    
     def test_subtask_completed_zero_workunit_id(self):
         """
         subtask on non-main_worker completes but the workunit id is zero.  This
@@ -682,6 +840,75 @@ class TaskScheduler_Scheduling(TaskScheduler_Base):
         self.assertCalled(main_worker, 'receive_results')
         self.assertSchedulerAdvanced()
     
+    def test_subtask_completed_same_node(self):
+        """
+        subtasks on workers of the same node complete while the mainworker
+        has not acknowledged the results of the node yet
+        
+        Verifies:
+            * results are held until the mainworker acknowledges the call
+            * held results are sent together in one call, with their counters
+        """
+        s = self.scheduler
+        response, main_worker, task = self.queue_and_run_task(True)
+        task = self.scheduler.get_worker_job(main_worker.name)
+        for i in range(3):
+            self.add_worker(True)
+        subtasks = [self.queue_and_run_subtask(main_worker, True, i)[1] \
+                    for i in range(2, 5)]
+        for subtask in subtasks:
+            s.send_results(subtask.worker, ((subtask.workunit, 1, False),),
+                           {'records':1})
+        
+        calls = [c for c in main_worker.remote.calls \
+                 if c[0][0] == 'receive_results']
+        self.assertEqual(len(calls), 1)
+        calls[0][2].callback(None)
+        
+        calls = [c for c in main_worker.remote.calls \
+                 if c[0][0] == 'receive_results']
+        self.assertEqual(len(calls), 2)
+        args, kwargs, deferred = calls[1]
+        self.assertEqual(args[2], [(3, 1, False), (4, 1, False)])
+        self.assertEqual(args[4], {'records':2})
+        deferred.callback(None)
+        self.assertEqual(s._forwarding, {})
+    
+    def test_subtask_completed_throttled(self):
+        """
+        subtask completes while the mainworker is throttling results
+        
+        Verifies:
+            * ingestion stats of the mainworker are recorded
+            * workunits are not dispatched while the mainworker is throttling
+            * scheduler is advanced once the mainworker resumes
+        """
+        s = self.scheduler
+        response, main_worker, task = self.queue_and_run_task(True)
+        task = self.scheduler.get_worker_job(main_worker.name)
+        other_worker = self.add_worker(True)
+        subtask_response, subtask = self.queue_and_run_subtask(main_worker, True)
+        subtask_response, subtask = self.queue_and_run_subtask(main_worker, True)
+        s.send_results(other_worker.name, ((subtask.workunit, 'results: woot!',
+                                    False),))
+        args, kwargs, deferred = main_worker.remote.assertCalled(self,
+                                                            'receive_results')
+        deferred.callback({'throttling':True, 'queued':1001})
+        self.assert_(task.results_throttled)
+        self.assertEqual(task.ingestion_stats['queued'], 1001)
+        
+        s._schedule.disable()
+        s.request_worker(main_worker.name, 'test.foo.bar', 'args', 3)
+        s._schedule.enable()
+        self.assertEqual(s._schedule(), None)
+        self.scheduler._schedule.reset()
+        self.threads_.calls = []
+        
+        s.results_resumed(main_worker.name, {'throttling':False, 'queued':0})
+        self.assertFalse(task.results_throttled)
+        self.assertSchedulerAdvanced()
+        self.assert_(s._schedule())
+    
     def test_cancel_task(self):
         """
         Cancel task that is waiting in the pool
@@ -877,6 +1104,27 @@ class TaskScheduler_Statuses(TaskScheduler_Base):
         self.assertVerifyStatus(task, STATUS_RUNNING, 50)
         return self.status
 
+    def test_get_status_ingestion_stats(self):
+        """
+        Tests call to get status of a task whose mainworker has reported its
+        ingestion stats
+        
+        Verifies:
+            * ingestion stats are included in the status
+        """
+        response, worker, task = self.queue_and_run_task(True)
+        s = self.scheduler
+        task = s.get_worker_job(worker.name)
+        task.ingestion_stats = {'received':10, 'processed':8, 'queued':2,
+                                'throttling':False}
+        deferred = s.fetch_task_status()
+        deferred.addCallback(self.set_status)
+        args, kwargs, call_deferred = self.assertCalled(worker, 'task_status')
+        call_deferred.callback(50)
+        
+        self.assertVerifyStatus(task, STATUS_RUNNING, 50)
+        self.assertEqual(self.status[task.id]['i'], task.ingestion_stats)
+
     def test_get_status_empty_queue(self):
         """
         Tests call to get status when no tasks are queued
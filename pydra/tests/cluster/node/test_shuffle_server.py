@@ -0,0 +1,88 @@
+"""
+    Copyright 2009 Oregon State University
+
+    This file is part of Pydra.
+
+    Pydra is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    Pydra is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with Pydra.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+from Crypto.PublicKey import RSA
+
+from pydra.cluster.module import ModuleManager
+from pydra.cluster.node import shuffle_server
+from pydra.cluster.node.shuffle_server import ShuffleServer
+from pydra.tests.cluster.module.test_module_manager import TestAPI
+
+KEY = RSA.generate(1024)
+
+class ShuffleServerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.shuffle_dir = shuffle_server.shuffle_dir
+        self.shuffle_key = shuffle_server.shuffle_key
+        self.shuffle_port = shuffle_server.shuffle_port
+        shuffle_server.shuffle_dir = lambda: '%s/shuffle' % self.dir
+        shuffle_server.shuffle_key = lambda create: KEY
+        shuffle_server.shuffle_port = lambda: 0
+        self.module = None
+
+    def tearDown(self):
+        shuffle_server.shuffle_dir = self.shuffle_dir
+        shuffle_server.shuffle_key = self.shuffle_key
+        shuffle_server.shuffle_port = self.shuffle_port
+        shutil.rmtree(self.dir)
+        if self.module and self.module.port:
+            self.module.port.stopListening()
+
+    def test_register(self):
+        """
+        Tests registering the module with a manager
+        """
+        manager = ModuleManager()
+        module = ShuffleServer()
+        api = TestAPI()
+        manager.register(api)
+        manager.register(module)
+        self.assert_(module in manager._modules)
+        self.assertEqual(module.key, KEY)
+
+    def test_listen(self):
+        """
+        Verifies:
+            * the server listens once the node is initialized, on the host
+              of the node key
+            * the shuffle directory is served, and created
+            * initializing the node again with the same host keeps the
+              server
+        """
+        manager = ModuleManager()
+        self.module = ShuffleServer()
+        manager.register(self.module)
+        self.assertEqual(manager.get_services(), [])
+        self.failIf(self.module.port)
+
+        manager.emit_signal('NODE_INITIALIZED', '127.0.0.1:11890')
+        port = self.module.port
+        self.assertEqual(port.getHost().host, '127.0.0.1')
+        self.assertEqual(port.factory.dir, '%s/shuffle' % self.dir)
+        self.assertEqual(port.factory.key, KEY)
+        self.assert_(os.path.isdir('%s/shuffle' % self.dir))
+
+        manager.emit_signal('NODE_INITIALIZED', '127.0.0.1:11890')
+        self.assertEqual(self.module.port, port)
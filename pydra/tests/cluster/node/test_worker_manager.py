@@ -196,6 +196,18 @@ class WorkerManager(unittest.TestCase, ModuleTestCaseMixIn, WorkerConnectionMana
         wm.request_worker_release(worker.name)
         self.assertCalled(wm.master, 'request_worker_release')
 
+    def test_results_resumed(self):
+        """
+        Main worker resumes after throttling results
+        
+        Verify:
+            * master sent command
+        """
+        wm = self.wm
+        worker = self.add_worker()
+        wm.results_resumed(worker.name, {'throttling':False})
+        self.assertCalled(wm.master, 'results_resumed')
+
     def test_run_subtask_local(self):
         """
         Start a subtask on the mainworker
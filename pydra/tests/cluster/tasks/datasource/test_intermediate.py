@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from pydra.cluster.tasks.datasource.intermediate import encode_run, \
+    iter_run, merge_runs, FileRunOutput, FileRunInput, RUN_HEADER, \
+    BLOCK_HEADER, BLOCK_SIZE
+
+
+class Unmarshallable(object):
+
+    def __init__(self, value):
+        self.value = value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+
+class RunTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        tuples = [("b", [2]), ("a", [1, 1]), ("c", [u"three", 3.0])]
+        self.assertEqual(list(iter_run(encode_run(tuples))), sorted(tuples))
+
+    def test_empty(self):
+        self.assertEqual(list(iter_run(encode_run([]))), [])
+
+    def test_pickle_fallback(self):
+        tuples = [("a", [Unmarshallable(1)])]
+        run = encode_run(tuples)
+        self.assertEqual(run[5:8], "spn")
+        self.assertEqual(list(iter_run(run)), tuples)
+
+    def test_keys(self):
+        tuples = [(1, [1]), ((2, "b"), [2])]
+        run = encode_run(tuples)
+        self.assertEqual(run[5:7], "mm")
+        self.assertEqual(list(iter_run(run)), tuples)
+
+    def test_compressed(self):
+        tuples = [("key%06d" % i, [i, "value"]) for i in range(20000)]
+        plain = encode_run(tuples)
+        for codec in ("zlib", "fast", "bz2"):
+            run = encode_run(tuples, codec)
+            self.assert_(len(run) < len(plain) / 2, codec)
+            self.assertEqual(list(iter_run(run)), tuples)
+
+    def test_compressed_blocks(self):
+        """
+        Verifies:
+            * compressed runs are framed in blocks of about BLOCK_SIZE
+        """
+        tuples = [("key%06d" % i, [i]) for i in range(20000)]
+        run = encode_run(tuples, "fast")
+        offset = RUN_HEADER.size
+        sizes = []
+        while offset < len(run):
+            clen, size = BLOCK_HEADER.unpack_from(run, offset)
+            sizes.append(size)
+            offset += BLOCK_HEADER.size + clen
+        self.assert_(len(sizes) > 1)
+        for size in sizes[:-1]:
+            self.assert_(BLOCK_SIZE <= size < BLOCK_SIZE + 100)
+
+    def test_unknown_codec(self):
+        self.assertRaises(ValueError, FileRunOutput, "/tmp", "snappy")
+
+    def test_not_a_run(self):
+        self.assertRaises(ValueError, list, iter_run("not a run"))
+
+
+class FileRunTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_dump_read(self):
+        output = FileRunOutput(self.dir)
+        output.dump("run1", [("b", [1]), ("a", [2])])
+        FileRunOutput(self.dir, "zlib").dump("run2", [("a", [3])])
+        self.assertEqual(sorted(os.listdir(self.dir)), ["run1", "run2"])
+
+        input = FileRunInput(self.dir)
+        input.input = ["run1", "run2"]
+        self.assertEqual(groups(input), [("a", [2, 3]), ("b", [1])])
+
+        # iterating again restarts
+        self.assertEqual(len(list(input)), 2)
+
+        output.remove("run1")
+        self.assertEqual(os.listdir(self.dir), ["run2"])
+
+
+if __name__ == "__main__":
+    unittest.main()
+
+
+class MergeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_merge_runs(self):
+        runs = [[("a", [1]), ("c", [1])], [("b", [2]), ("c", [2])], []]
+        self.assertEqual(list(merge_runs(runs)),
+            [("a", [1]), ("b", [2]), ("c", [1]), ("c", [2])])
+
+    def test_spill(self):
+        """
+        Merges more runs than the merge factor
+
+        Verifies:
+            * every value is merged into one group per key
+            * spill runs are removed
+        """
+        output = FileRunOutput(self.dir)
+        expected = {}
+        for i in range(10):
+            output.dump("run%d" % i, [("k%d" % (j % 7), [i]) \
+                                      for j in range(i, i + 3)])
+            for j in range(i, i + 3):
+                expected.setdefault("k%d" % (j % 7), []).append(i)
+
+        spill_dir = tempfile.mkdtemp(dir=self.dir)
+        input = FileRunInput(self.dir)
+        input.merge_factor = 3
+        input.spill_dir = spill_dir
+        input.input = ["run%d" % i for i in range(10)]
+
+        merged = groups(input)
+        self.assertEqual([k for k, vs in merged], sorted(expected))
+        self.assertEqual(dict(merged), expected)
+        self.assertEqual(os.listdir(spill_dir), [])
+
+
+def groups(input):
+    return [(k, list(vs)) for k, vs in input]
@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from pydra.cluster.tasks.datasource.backend import SQLBackend
+from pydra.cluster.tasks.datasource.pool import ConnectionPool
+
+class _Connection(object):
+
+    def __init__(self):
+        self.closed = False
+        self.broken = False
+
+    def close(self):
+        self.closed = True
+
+def _check(connection):
+
+    if connection.broken:
+        raise IOError("connection lost")
+
+class ConnectionPoolTest(unittest.TestCase):
+
+    def setUp(self):
+
+        self.pool = ConnectionPool()
+        self.now = 1000.0
+        self.pool.clock = lambda: self.now
+
+    def test_reuse(self):
+        """
+        Verifies:
+            * released connections are reused by the same key only
+        """
+        first = self.pool.acquire("a", _Connection)
+        self.pool.release("a", first)
+        self.assertEqual(self.pool.acquire("a", _Connection), first)
+        other = self.pool.acquire("b", _Connection)
+        self.assertNotEqual(other, first)
+        self.assertEqual(self.pool.stats['connects'], 2)
+        self.assertEqual(self.pool.stats['reuses'], 1)
+        self.assertEqual(self.pool.idle(), 0)
+
+    def test_check(self):
+        """
+        Verifies:
+            * connections idle for long are checked
+            * broken connections are closed and replaced
+        """
+        first = self.pool.acquire("a", _Connection, _check)
+        self.pool.release("a", first)
+        self.now += self.pool.check_after + 1
+        self.assertEqual(self.pool.acquire("a", _Connection, _check), first)
+        self.pool.release("a", first)
+
+        first.broken = True
+        self.now += self.pool.check_after + 1
+        second = self.pool.acquire("a", _Connection, _check)
+        self.assertNotEqual(second, first)
+        self.assert_(first.closed)
+        self.assertEqual(self.pool.stats['checks'], 2)
+        self.assertEqual(self.pool.stats['failed_checks'], 1)
+
+    def test_check_unlocked(self):
+        """
+        Verifies:
+            * connections are checked without holding the pool lock
+        """
+        def check(connection):
+            self.assert_(self.pool._lock.acquire(False))
+            self.pool._lock.release()
+        first = self.pool.acquire("a", _Connection, check)
+        self.pool.release("a", first)
+        self.now += self.pool.check_after + 1
+        self.assertEqual(self.pool.acquire("a", _Connection, check), first)
+        self.assertEqual(self.pool.stats['checks'], 1)
+
+    def test_max_idle(self):
+
+        first = self.pool.acquire("a", _Connection)
+        self.pool.release("a", first)
+        self.now += self.pool.max_idle + 1
+        self.assertNotEqual(self.pool.acquire("b", _Connection), first)
+        self.assert_(first.closed)
+        self.assertEqual(self.pool.stats['expired'], 1)
+        self.assertEqual(self.pool.idle(), 0)
+
+    def test_max_connections(self):
+
+        connections = [self.pool.acquire("a", _Connection) for i in range(6)]
+        for connection in connections:
+            self.pool.release("a", connection)
+        self.assertEqual(self.pool.idle(), self.pool.max_connections)
+        self.assert_(connections[0].closed)
+        self.failIf(connections[-1].closed)
+
+    def test_reset(self):
+        """
+        Verifies:
+            * connections failing to reset are closed
+        """
+        def reset(connection):
+            raise IOError("connection lost")
+        first = self.pool.acquire("a", _Connection)
+        self.pool.release("a", first, reset)
+        self.assert_(first.closed)
+        self.assertEqual(self.pool.idle(), 0)
+
+    def test_fork(self):
+        """
+        Verifies:
+            * connections of the parent process are dropped, not closed
+        """
+        first = self.pool.acquire("a", _Connection)
+        self.pool.release("a", first)
+        self.pool._pid = os.getpid() + 1
+        self.assertNotEqual(self.pool.acquire("a", _Connection), first)
+        self.failIf(first.closed)
+
+    def test_clear(self):
+
+        first = self.pool.acquire("a", _Connection)
+        self.pool.release("a", first)
+        self.pool.clear()
+        self.assert_(first.closed)
+        self.assertEqual(self.pool.idle(), 0)
+
+class SQLBackendPoolTest(unittest.TestCase):
+
+    def setUp(self):
+
+        class PooledBackend(SQLBackend):
+            pool = ConnectionPool()
+        self.backend = PooledBackend
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "cheeses.db")
+
+    def tearDown(self):
+
+        self.backend.pool.clear()
+        shutil.rmtree(self.dir)
+
+    def test_reuse(self):
+        """
+        Verifies:
+            * backends for the same database reuse the connection
+            * uncommitted changes are rolled back
+        """
+        b = self.backend("sqlite3", self.path)
+        handle = b.handle
+        handle.execute("CREATE TABLE CHEESES (NAME)")
+        handle.commit()
+        handle.execute("INSERT INTO CHEESES VALUES ('quark')")
+        b.disconnect()
+
+        b = self.backend("sqlite3", self.path)
+        self.assertEqual(b.handle, handle)
+        self.assertEqual(b.handle.execute("SELECT * FROM CHEESES").fetchall(), [])
+        self.assertEqual(self.backend.pool.stats['reuses'], 1)
+        self.assertEqual(self.backend.pool.stats['connects'], 1)
+
+    def test_threads(self):
+        """
+        Verifies:
+            * SQLite connections released by one thread are not reused by
+              another
+        """
+        b = self.backend("sqlite3", self.path)
+        handle = b.handle
+        b.disconnect()
+
+        handles = []
+        def connect():
+            b = self.backend("sqlite3", self.path)
+            handles.append(b.handle)
+            b.handle.execute("SELECT 1").fetchall()
+            b.disconnect()
+        t = threading.Thread(target=connect)
+        t.start()
+        t.join()
+        self.assertEqual(len(handles), 1)
+        self.assertNotEqual(handles[0], handle)
+        self.assertEqual(self.backend("sqlite3", self.path).handle, handle)
+
+    def test_memory(self):
+
+        b = self.backend("sqlite3", ":memory:")
+        handle = b.handle
+        b.disconnect()
+        self.assertEqual(self.backend.pool.idle(), 0)
+        self.assertNotEqual(self.backend("sqlite3", ":memory:").handle, handle)
+
+if __name__ == "__main__":
+    unittest.main()
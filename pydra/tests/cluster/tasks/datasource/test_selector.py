@@ -1,9 +1,13 @@
 #!/usr/bin/env python
 
+import os
 import os.path
+import shutil
+import tempfile
 import unittest
 
-from pydra.cluster.tasks.datasource.selector import DirSelector, FileSelector, SQLSelector
+from pydra.cluster.tasks.datasource.selector import DirSelector, FileSelector, SQLSelector, \
+    FilePlanner, FileUnit, unit_lines, walk_files, SQLRangeSelector, range_rows
 
 # Odds are very good that you don't want to touch this. Both trial and
 # unittest have path quirks, and this seems to correctly handle both of them.
@@ -42,6 +46,82 @@ class FileSelectorTest(unittest.TestCase):
         handle2 = self.fs.handle
         self.assertEqual(handle, handle2)
 
+class FilePlannerTest(unittest.TestCase):
+
+    def setUp(self):
+
+        self.dir = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.dir, "sub"))
+        self.large = "".join("line %04d\n" % i for i in range(1000))
+        self.write("large.txt", self.large)
+        for i in range(20):
+            self.write(os.path.join("sub", "small%02d.txt" % i), "tiny %02d\n" % i)
+
+    def tearDown(self):
+
+        shutil.rmtree(self.dir)
+
+    def write(self, name, data):
+
+        f = open(os.path.join(self.dir, name), "wb")
+        f.write(data)
+        f.close()
+
+    def test_walk(self):
+
+        files = list(walk_files(self.dir))
+        self.assertEqual(len(files), 21)
+        self.assertEqual(files[0], (os.path.join(self.dir, "large.txt"), 10000))
+        self.assertEqual(list(walk_files(self.dir, False)), files[:1])
+
+    def test_plan(self):
+        """
+        Verifies:
+            * large files are split into line-aligned ranges
+            * small files are packed together
+            * units hold no more than unit_size bytes, except single lines
+            * every line is read once
+        """
+        units = list(DirSelector(self.dir).plan(1000))
+        large = [u for u in units if u.ranges[0][0].endswith("large.txt")]
+        small = [u for u in units if u not in large]
+        self.assertEqual(len(large), 10)
+        self.assertEqual(len(small), 1)
+        self.assertEqual(len(small[0]), 20)
+        for unit in units:
+            self.assert_(0 < unit.data_size <= 1000)
+            self.assertEqual(unit.data_size,
+                sum(stop - start for path, start, stop in unit))
+
+        lines = []
+        for unit in units:
+            lines.extend(unit_lines(unit.transmitable()))
+        self.assertEqual(len(lines), 1020)
+        self.assertEqual("".join(lines[:1000]), self.large)
+
+    def test_pack(self):
+        """
+        Verifies:
+            * a unit is started when the next file does not fit
+        """
+        units = list(FilePlanner(os.path.join(self.dir, "sub"), 24))
+        self.assertEqual([len(u) for u in units], [3] * 6 + [2])
+
+    def test_raw_split(self):
+
+        units = list(FileSelector(os.path.join(self.dir, "large.txt")).plan(
+            3000, sep=None))
+        self.assertEqual([u.ranges for u in units], [
+            [[os.path.join(self.dir, "large.txt"), start, stop]]
+            for start, stop in ((0, 2500), (2500, 5000), (5000, 7500),
+                                (7500, 10000))])
+
+    def test_unit(self):
+
+        unit = FileUnit([("a", 0, 10), ("b", 5, 8)])
+        self.assertEqual(unit.data_size, 13)
+        self.assertEqual(unit.transmitable(), [["a", 0, 10], ["b", 5, 8]])
+
 class SQLSelectorTest(unittest.TestCase):
 
     def setUp(self):
@@ -87,5 +167,71 @@ class SQLSelectorTest(unittest.TestCase):
         query = "SELECT * FROM CHEESES WHERE NAME IN (?, ?)"
         self.assertRaises(ValueError, SQLSelector, self.backend, query, "quark", "leicester", it="ni")
 
+class SQLRangeSelectorTest(unittest.TestCase):
+
+    def setUp(self):
+        from pydra.cluster.tasks.datasource.backend import SQLBackend
+
+        self.backend = SQLBackend("sqlite3", ":memory:")
+        self.backend.connect()
+
+        db = self.backend.handle
+        db.execute("CREATE TABLE CHEESES (ID INTEGER, NAME, AGED INTEGER)")
+        self.l = [(i, "cheese%04d" % i, i % 2) for i in range(1, 1001)]
+        db.executemany("INSERT INTO CHEESES VALUES (?, ?, ?)", self.l)
+        db.execute("INSERT INTO CHEESES VALUES (NULL, 'nameless', 0)")
+        db.commit()
+
+    def rows(self, selector):
+
+        return [list(range_rows(self.backend, workunit, 7))
+            for workunit in selector]
+
+    def test_integer_ranges(self):
+        """
+        Verifies:
+            * integer keys are split evenly
+            * every row is selected once, in one query per range
+        """
+        selector = SQLRangeSelector(self.backend, "CHEESES", "ID", 4)
+        workunits = list(selector)
+        self.assertEqual([params for query, params in workunits],
+            [[1, 251], [251, 501], [501, 751], [751]])
+        self.assert_("LIMIT" not in workunits[0][0])
+        rows = self.rows(workunits)
+        self.assertEqual([len(r) for r in rows], [250] * 4)
+        self.assertEqual(sum(rows, []), self.l)
+
+    def test_text_ranges(self):
+
+        selector = SQLRangeSelector(self.backend, "CHEESES", "NAME", 3,
+            columns="ID")
+        workunits = list(selector)
+        self.assertEqual([params for query, params in workunits],
+            [[u"cheese0001", u"cheese0335"], [u"cheese0335", u"cheese0669"],
+             [u"cheese0669"]])
+        rows = sum(self.rows(workunits), [])
+        self.assertEqual(sorted(rows), [(None,)] + [(i,) for i in range(1, 1001)])
+
+    def test_where(self):
+
+        selector = SQLRangeSelector(self.backend, "CHEESES", "ID", 2,
+            where="AGED = ?", params=[1])
+        rows = sum(self.rows(selector), [])
+        self.assertEqual(rows, [r for r in self.l if r[2]])
+
+    def test_more_ranges_than_keys(self):
+
+        selector = SQLRangeSelector(self.backend, "CHEESES", "ID", 10,
+            where="ID <= ?", params=[3])
+        self.assertEqual(sum(self.rows(selector), []), self.l[:3])
+        self.assertEqual(len(list(selector)), 3)
+
+    def test_empty(self):
+
+        selector = SQLRangeSelector(self.backend, "CHEESES", "ID",
+            where="ID > ?", params=[5000])
+        self.assertEqual(list(selector), [])
+
 if __name__ == "__main__":
     unittest.main()
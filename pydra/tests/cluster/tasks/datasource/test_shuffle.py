@@ -0,0 +1,241 @@
+#!/usr/bin/env python
+
+import os
+import shutil
+import socket
+import tempfile
+
+from Crypto.PublicKey import RSA
+from twisted.internet import reactor, threads
+from twisted.trial import unittest as twisted_unittest
+
+from pydra.cluster.tasks.datasource.shuffle import ShuffleConnection, \
+    ShuffleError, ShuffleFactory, ShuffleFetchError, ShuffleFetcher, \
+    ShuffleProtocol, delete_segments, locate, node_host, parse_locator, \
+    valid_name
+
+KEY = RSA.generate(1024)
+OTHER_KEY = RSA.generate(1024)
+
+
+class DroppingProtocol(ShuffleProtocol):
+    """
+    Drops the connection on the first requests it receives.
+    """
+
+    def lineReceived(self, line):
+        if self.factory.drops:
+            self.factory.drops -= 1
+            self.transport.loseConnection()
+        else:
+            ShuffleProtocol.lineReceived(self, line)
+
+
+class LocatorTest(twisted_unittest.TestCase):
+
+    def test_locator(self):
+        locator = locate("node1", 18802, "mapreduce-i9e-1-0-map0")
+        self.assertEqual(locator, "node1:18802/mapreduce-i9e-1-0-map0")
+        self.assertEqual(parse_locator(locator),
+                         ("node1", 18802, "mapreduce-i9e-1-0-map0"))
+
+    def test_node_host(self):
+        self.assertEqual(node_host("node1:11890:0"), "node1")
+        self.assertEqual(node_host("Worker_Proxy"), "localhost")
+
+    def test_valid_name(self):
+        self.assert_(valid_name("mapreduce-i9e-1-0-map0"))
+        for name in ("", "../etc/passwd", "a/b", ".hidden", "a\0"):
+            self.failIf(valid_name(name), name)
+
+
+class ShuffleServerTest(twisted_unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.dest = tempfile.mkdtemp()
+        self.factory = ShuffleFactory(self.dir, KEY)
+        self.factory.drops = 0
+        self.listener = reactor.listenTCP(0, self.factory,
+                                          interface="127.0.0.1")
+        self.port = self.listener.getHost().port
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+        shutil.rmtree(self.dest)
+        return self.listener.stopListening()
+
+    def write(self, name, data):
+        f = open(os.path.join(self.dir, name), "wb")
+        f.write(data)
+        f.close()
+
+    def read(self, name):
+        f = open(os.path.join(self.dest, name), "rb")
+        try:
+            return f.read()
+        finally:
+            f.close()
+
+    def fetcher(self):
+        fetcher = ShuffleFetcher(KEY)
+        fetcher.retry_delay = 0
+        fetcher.timeout = 10
+        return fetcher
+
+    def test_get(self):
+        """
+        Verifies:
+            * segments are copied on a single connection
+            * segments larger than a read are copied entirely
+        """
+        self.write("small", "data")
+        self.write("large", "x" * 200000)
+
+        def get():
+            connection = ShuffleConnection("127.0.0.1", self.port, KEY, 10)
+            try:
+                sizes = [connection.get(name, os.path.join(self.dest, name)) \
+                         for name in ("small", "large")]
+            finally:
+                connection.close()
+            self.assertEqual(sizes, [4, 200000])
+            self.assertEqual(self.read("small"), "data")
+            self.assertEqual(self.read("large"), "x" * 200000)
+        return threads.deferToThread(get)
+
+    def test_get_errors(self):
+        """
+        Verifies:
+            * missing segments and names outside the directory are errors
+            * the connection can be used after an error
+        """
+        self.write("segment", "data")
+
+        def get():
+            connection = ShuffleConnection("127.0.0.1", self.port, KEY, 10)
+            try:
+                for name in ("missing", "../segment"):
+                    self.assertRaises(ShuffleError, connection.get, name,
+                                      os.path.join(self.dest, "copy"))
+                self.failIf(os.listdir(self.dest))
+                connection.get("segment", os.path.join(self.dest, "segment"))
+            finally:
+                connection.close()
+            self.assertEqual(self.read("segment"), "data")
+        return threads.deferToThread(get)
+
+    def test_auth_failed(self):
+        """
+        Verifies:
+            * clients without the key are refused
+            * requests are refused before the challenge is answered
+        """
+        self.write("segment", "data")
+
+        def connect():
+            self.assertRaises(ShuffleError, ShuffleConnection, "127.0.0.1",
+                              self.port, OTHER_KEY, 10)
+
+            sock = socket.create_connection(("127.0.0.1", self.port), 10)
+            try:
+                f = sock.makefile("rb")
+                self.assert_(f.readline().startswith("CHALLENGE "))
+                sock.sendall("GET segment\r\n")
+                self.assertEqual(f.readline(),
+                                 "ERROR Authentication failed\r\n")
+                self.assertEqual(f.readline(), "")
+            finally:
+                sock.close()
+        return threads.deferToThread(connect)
+
+    def test_delete(self):
+        """
+        Verifies:
+            * only the segments named are removed
+            * missing segments are skipped
+        """
+        for name in ("mapreduce-i9e-1-0-map0", "mapreduce-i9e-1-1-map0",
+                     "mapreduce-i9e-10-0-map0"):
+            self.write(name, "data")
+
+        def delete():
+            count = delete_segments("127.0.0.1", self.port,
+                                    ["mapreduce-i9e-1-0-map0",
+                                     "mapreduce-i9e-1-1-map0",
+                                     "mapreduce-i9e-1-2-map0"], KEY, 10)
+            self.assertEqual(count, 2)
+            self.assertEqual(os.listdir(self.dir),
+                             ["mapreduce-i9e-10-0-map0"])
+            self.assertRaises(ShuffleError, delete_segments, "127.0.0.1",
+                              self.port, ["mapreduce-i9e-1-"], OTHER_KEY, 10)
+        return threads.deferToThread(delete)
+
+    def test_fetch(self):
+        """
+        Verifies:
+            * every segment is fetched, with concurrent connections
+        """
+        names = ["segment%d" % i for i in range(10)]
+        for name in names:
+            self.write(name, name * 100)
+
+        fetcher = self.fetcher()
+        fetcher.max_fetches = 3
+
+        def fetch():
+            fetcher.fetch([("127.0.0.1", self.port, name) for name in names],
+                          self.dest)
+            for name in names:
+                self.assertEqual(self.read(name), name * 100)
+            self.assertEqual(fetcher.stats['segments'], 10)
+            self.assertEqual(fetcher.stats['retries'], 0)
+        return threads.deferToThread(fetch)
+
+    def test_fetch_retry(self):
+        """
+        Verifies:
+            * fetches failing on a dropped connection are retried
+        """
+        self.factory.protocol = DroppingProtocol
+        self.factory.drops = 2
+        self.write("segment", "data")
+
+        fetcher = self.fetcher()
+
+        def fetch():
+            fetcher.fetch([("127.0.0.1", self.port, "segment")], self.dest)
+            self.assertEqual(self.read("segment"), "data")
+            self.assertEqual(fetcher.stats['retries'], 2)
+        return threads.deferToThread(fetch)
+
+    def test_fetch_failed(self):
+        """
+        Verifies:
+            * segments still failing after the retries are reported
+            * other segments are fetched
+        """
+        self.write("segment", "data")
+
+        # find a port nothing listens on
+        sock = socket.socket()
+        sock.bind(("127.0.0.1", 0))
+        closed = sock.getsockname()[1]
+        sock.close()
+
+        fetcher = self.fetcher()
+        fetcher.retries = 1
+        segments = [("127.0.0.1", self.port, "segment"),
+                    ("127.0.0.1", self.port, "missing"),
+                    ("127.0.0.1", closed, "segment")]
+
+        def fetch():
+            try:
+                fetcher.fetch(segments, self.dest)
+            except ShuffleFetchError, e:
+                self.assertEqual(sorted(e.segments), sorted(segments[1:]))
+            else:
+                self.fail("ShuffleFetchError not raised")
+            self.assertEqual(os.listdir(self.dest), ["segment"])
+            self.assertEqual(fetcher.stats['retries'], 2)
+        return threads.deferToThread(fetch)
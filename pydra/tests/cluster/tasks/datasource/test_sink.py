@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from pydra.cluster.tasks.datasource.backend import SQLBackend
+from pydra.cluster.tasks.datasource.sink import FileSink, SQLSink
+
+
+class FileSinkTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_write(self):
+        sink = FileSink(self.dir)
+        writer = sink.open(1)
+        writer["a"] = 1
+        writer["b"] = 2
+        entry = writer.close()
+
+        path = os.path.join(self.dir, "part-00001")
+        self.assertEqual(open(path).read(), "a\t1\nb\t2\n")
+        self.assertEqual(entry, {"partition": 1, "path": path, "records": 2,
+                                 "bytes": 8})
+        self.assertEqual(os.listdir(self.dir), ["part-00001"])
+
+    def test_formatter(self):
+        sink = FileSink(self.dir, lambda k, v: "%s=%s;" % (k, v))
+        writer = sink.open(0)
+        writer["a"] = 1
+        writer.close()
+        self.assertEqual(open(os.path.join(self.dir, "part-00000")).read(),
+                         "a=1;")
+
+    def test_abort(self):
+        """
+        Verifies:
+            * an aborted writer leaves no file behind
+        """
+        sink = FileSink(self.dir)
+        writer = sink.open(1)
+        writer["a"] = 1
+        writer.abort()
+        self.assertEqual(os.listdir(self.dir), [])
+
+    def test_finish(self):
+        sink = FileSink(self.dir)
+        manifest = [{"partition": 1}, {"partition": 0}]
+        self.assertEqual(sink.finish(manifest),
+                         [{"partition": 0}, {"partition": 1}])
+
+
+class SQLSinkTest(unittest.TestCase):
+
+    def setUp(self):
+        self.db = SQLBackend("sqlite", ":memory:")
+        self.db.handle.cursor().execute("CREATE TABLE out (word, count)")
+
+    def test_write(self):
+        sink = SQLSink(self.db, "out", ("word", "count"), batch_size=2)
+        writer = sink.open(3)
+        for i, word in enumerate("abcde"):
+            writer[word] = i
+            if i == 1:
+                # a full batch is inserted
+                self.assertEqual(self.count(), 2)
+        entry = writer.close()
+
+        self.assertEqual(self.count(), 5)
+        self.assertEqual(entry, {"partition": 3, "table": "out",
+                                 "records": 5})
+
+    def test_abort(self):
+        """
+        Verifies:
+            * rows of an aborted writer are rolled back, including full
+              batches already inserted
+        """
+        sink = SQLSink(self.db, "out", ("word", "count"), batch_size=2)
+        writer = sink.open(0)
+        for i, word in enumerate("abc"):
+            writer[word] = i
+        writer.abort()
+        self.assertEqual(self.count(), 0)
+
+    def test_partition_column(self):
+        """
+        Verifies:
+            * rows are written with their job and partition
+            * writing a partition again replaces its rows
+            * rows of the partition written by another job are kept
+        """
+        self.db.handle.cursor().execute(
+            "CREATE TABLE parts (word, count, job, p)")
+        for job in ("a", "a", "b"):
+            sink = SQLSink(self.db, "parts", ("word", "count"), batch_size=2,
+                           partition_column="p", job_column="job", job=job)
+            for partition in (0, 1):
+                writer = sink.open(partition)
+                for i, word in enumerate("abc"):
+                    writer[word] = i
+                writer.close()
+
+        cursor = self.db.handle.cursor()
+        cursor.execute("SELECT job, p, COUNT(*) FROM parts GROUP BY job, p")
+        self.assertEqual(cursor.fetchall(),
+                         [("a", 0, 3), ("a", 1, 3), ("b", 0, 3), ("b", 1, 3)])
+
+    def test_partition_column_job(self):
+        """
+        Verifies:
+            * a partition column can't be used without a job column
+        """
+        self.assertRaises(ValueError, SQLSink, self.db, "out",
+                          partition_column="p")
+
+    def count(self):
+        cursor = self.db.handle.cursor()
+        cursor.execute("SELECT COUNT(*) FROM out")
+        return cursor.fetchone()[0]
+
+
+if __name__ == "__main__":
+    unittest.main()
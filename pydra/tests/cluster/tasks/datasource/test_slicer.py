@@ -1,8 +1,11 @@
 #!/usr/bin/env python
 
+import os
+import tempfile
 import unittest
 
-from pydra.cluster.tasks.datasource.slicer import IterSlicer, CursorSlicer, MapSlicer, LineSlicer
+from pydra.cluster.tasks.datasource.slicer import IterSlicer, CursorSlicer, MapSlicer, LineSlicer, \
+    LineRangeSlicer, range_lines
 
 class _CursorDumb(object):
 
@@ -57,6 +60,31 @@ class CursorSlicerSmartTest(IterSlicerTest):
         self.cursor = _CursorSmart(self.l)
         self.slicer = CursorSlicer(self.cursor)
 
+class _CursorBatch(_CursorDumb):
+
+    def __init__(self, l):
+        _CursorDumb.__init__(self, l)
+        self.fetches = 0
+
+    def fetchmany(self, size):
+        self.fetches += 1
+        rows = self.l[self.i:self.i + size]
+        self.i += size
+        return rows
+
+class CursorSlicerBatchTest(IterSlicerTest):
+
+    def setUp(self):
+
+        self.l = [(i,) for i in range(10)]
+        self.cursor = _CursorBatch(self.l)
+        self.slicer = CursorSlicer(self.cursor, 4)
+
+    def test_batches(self):
+
+        list(self.slicer)
+        self.assertEqual(self.cursor.fetches, 4)
+
 class CursorSlicerRealTest(IterSlicerTest):
 
     def setUp(self):
@@ -114,5 +142,96 @@ class LineSlicerTest(unittest.TestCase):
         ls = self.slicer[50:100]
         self.assertEqual([51, 108], [pos for pos in ls])
 
+    def test_long_lines(self):
+
+        s = "\n" + "a" * 1000 + "\r\n" + "b" * 100000 + "\r\n" + "c"
+        self.assertEqual([1002, 101004], [pos for pos in LineSlicer(s)])
+        self.assertEqual([101003], [pos for pos in LineSlicer(s, "\r\n")])
+
+class LineRangeSlicerTest(unittest.TestCase):
+
+    def setUp(self):
+
+        self.lines = ["line %d %s\n" % (i, "x" * (i % 37)) for i in range(500)]
+        self.path = self.write("".join(self.lines))
+
+    def tearDown(self):
+
+        os.remove(self.path)
+
+    def write(self, data):
+
+        fd, path = tempfile.mkstemp()
+        os.write(fd, data)
+        os.close(fd)
+        return path
+
+    def read_ranges(self, slicer):
+
+        return [list(range_lines(self.path, start, stop))
+            for start, stop in slicer]
+
+    def test_ranges(self):
+        """
+        Verifies:
+            * ranges cover the file without overlapping
+            * ranges start at the beginning of a line
+        """
+        slicer = LineRangeSlicer(self.path, 7)
+        self.assertEqual(len(slicer), 7)
+        ranges = list(slicer)
+        self.assertEqual(ranges[0][0], 0)
+        self.assertEqual(ranges[-1][1], os.path.getsize(self.path))
+        for (start, stop), (next_start, next_stop) in zip(ranges, ranges[1:]):
+            self.assertEqual(stop, next_start)
+            self.assert_(start < stop)
+        lines = self.read_ranges(ranges)
+        self.assertEqual(sum(lines, []), self.lines)
+        for chunk in lines:
+            self.assert_(len(chunk) > 50)
+
+    def test_handle(self):
+        """
+        Verifies:
+            * open files can be split and read
+        """
+        handle = open(self.path, "rb")
+        try:
+            slicer = LineRangeSlicer(handle, 3)
+            lines = [list(slicer.lines(workunit)) for workunit in slicer]
+        finally:
+            handle.close()
+        self.assertEqual(sum(lines, []), self.lines)
+
+    def test_more_ranges_than_lines(self):
+        """
+        Verifies:
+            * ranges hold at least one line
+            * a last line without a separator is read
+        """
+        os.remove(self.path)
+        self.path = self.write("first\nsecond\nthird")
+        slicer = LineRangeSlicer(self.path, 100)
+        self.assertEqual(len(slicer), 3)
+        self.assertEqual(self.read_ranges(slicer),
+            [["first\n"], ["second\n"], ["third"]])
+
+    def test_single_line(self):
+
+        os.remove(self.path)
+        self.path = self.write("x" * 1000)
+        self.assertEqual(list(LineRangeSlicer(self.path, 4)), [(0, 1000)])
+
+    def test_empty(self):
+
+        os.remove(self.path)
+        self.path = self.write("")
+        self.assertEqual(list(LineRangeSlicer(self.path, 4)), [])
+        self.assertEqual(list(range_lines(self.path, 0, 0)), [])
+
+    def test_invalid(self):
+
+        self.assertRaises(ValueError, LineRangeSlicer, self.path, 0)
+
 if __name__ == "__main__":
     unittest.main()
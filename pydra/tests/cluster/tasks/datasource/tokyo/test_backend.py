@@ -4,7 +4,8 @@ import unittest
 
 from pydra.util.test import env_args
 from pydra.cluster.tasks.datasource.tokyo.backend import TokyoBackend
-from pydra.cluster.tasks.datasource.tokyo.selector import TokyoSelector
+from pydra.cluster.tasks.datasource.tokyo.selector import TokyoSelector, \
+    TokyoPrefixRanges, prefix_items
 
 
 class TokyoBackendTest(unittest.TestCase):
@@ -64,6 +65,30 @@ class TokyoBackendTest(unittest.TestCase):
         query = [(None, 'startswith', 'a')]
         self.assertEqual(self.run_query(query), self.l[:2])
 
+    def test_prefix_chunks(self):
+
+        selector = TokyoSelector(self.b, (None, 'startswith', ''))
+        selector.chunk_size = 2
+        self.assertEqual(sorted(selector), self.l)
+
+    def test_prefix_ranges(self):
+        """
+        Verifies:
+            * sub-prefix ranges hold about unit_keys keys
+            * every record is read once
+        """
+        self.b.handle['a'] = {'n':'a'}
+        units = list(TokyoPrefixRanges(self.b, 'a', 1))
+        self.assertEqual(units, [['a', [['', False]]], ['a', [['1', True]]],
+                                 ['a', [['2', True]]]])
+        units = list(TokyoPrefixRanges(self.b, '', 3))
+        self.assertEqual(units, [['', [['a', True]]],
+                                 ['', [['b', True], ['c', True]]]])
+        items = []
+        for unit in units:
+            items.extend(prefix_items(self.b, unit, 1))
+        self.assertEqual(sorted(items), sorted(self.l + [('a', {'n':'a'})]))
+
     def test_startswith(self):
 
         query = [('n', 'startswith', 'two')]
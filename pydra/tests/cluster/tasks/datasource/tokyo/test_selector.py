@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+
+import unittest
+
+from pydra.cluster.tasks.datasource.tokyo.selector import TokyoPrefixRanges, \
+    prefix_items
+
+
+class FakeTyrant(dict):
+    """
+    Records in memory, with the calls of a Tyrant connection used by prefix
+    scans.
+    """
+
+    def prefix_keys(self, prefix):
+        return [key for key in self if key.startswith(prefix)]
+
+    def multi_get(self, keys):
+        return [(key, self[key]) for key in keys]
+
+
+class TokyoPrefixRangesTest(unittest.TestCase):
+
+    def setUp(self):
+
+        self.db = FakeTyrant()
+        for key in ['a', 'b1', 'b2', 'bx', 'bx1', 'bx2', 'bx3', 'by', 'c']:
+            self.db[key] = {'n':key}
+
+    def read(self, units):
+        items = []
+        for unit in units:
+            items.extend(prefix_items(self.db, unit, 2))
+        return sorted(items)
+
+    def test_ranges(self):
+        """
+        Verifies:
+            * groups of characters are packed into ranges of unit_keys keys
+            * every record is read once
+        """
+        units = list(TokyoPrefixRanges(self.db, '', 10))
+        self.assertEqual(units, [['', [['a', True], ['b', True],
+                                       ['c', True]]]])
+        self.assertEqual(self.read(units), sorted(self.db.items()))
+
+    def test_split_group(self):
+        """
+        Verifies:
+            * a character group larger than unit_keys is split on longer
+              sub-prefixes
+            * a key equal to a split sub-prefix is read on its own
+            * every record is read once
+        """
+        units = list(TokyoPrefixRanges(self.db, '', 3))
+        self.assertEqual(units, [['', [['a', True], ['b1', True],
+                                       ['b2', True]]],
+                                 ['', [['bx', False], ['bx1', True],
+                                       ['bx2', True]]],
+                                 ['', [['bx3', True], ['by', True],
+                                       ['c', True]]]])
+        self.assertEqual(self.read(units), sorted(self.db.items()))
+
+    def test_single_keys(self):
+        """
+        Verifies:
+            * with unit_keys of 1 every key is a range of its own
+        """
+        units = list(TokyoPrefixRanges(self.db, 'b', 1))
+        self.assertEqual(len(units), 7)
+        self.assertEqual(self.read(units),
+                         sorted(i for i in self.db.items() if i[0] != 'a' \
+                                and i[0] != 'c'))
+
+    def test_exact(self):
+        """
+        Verifies:
+            * the key equal to the prefix is read
+        """
+        units = list(TokyoPrefixRanges(self.db, 'bx', 10))
+        self.assertEqual(units, [['bx', [['', False], ['1', True],
+                                         ['2', True], ['3', True]]]])
+        self.assertEqual([k for k, v in self.read(units)],
+                         ['bx', 'bx1', 'bx2', 'bx3'])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,169 @@
+"""
+    Copyright 2009 Oregon State University
+
+    This file is part of Pydra.
+
+    Pydra is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    Pydra is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with Pydra.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from pydra.cluster.tasks.checkpoint import CheckpointStore
+from pydra.tests.cluster.tasks.proxies import WorkerProxy
+from pydra.tests.cluster.tasks.test_parallel_task import TestParallelTask
+
+
+class CheckpointingParallelTask(TestParallelTask):
+    """
+    ParallelTask that checkpoints after every workunit
+    """
+    checkpoint_interval = 0
+
+    def checkpoint_state(self):
+        return list(self._finished)
+
+    def restore_checkpoint(self, state):
+        self._finished = state
+
+
+class CheckpointWorkerProxy(WorkerProxy):
+    """
+    Worker proxy that stores checkpoints in a temporary directory
+    """
+    def __init__(self, directory):
+        WorkerProxy.__init__(self)
+        self.directory = directory
+
+    def get_checkpoint_store(self, task):
+        return CheckpointStore(1, task.get_key(), self.directory)
+
+
+class CheckpointStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.store = CheckpointStore(1, 'Task', self.directory)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_load_missing(self):
+        """
+        Verifies None is returned when there is no checkpoint
+        """
+        self.assertEqual(self.store.load(), None)
+
+    def test_save_load(self):
+        """
+        Verifies:
+            * completed indexes and state are saved
+            * saving replaces the previous checkpoint
+        """
+        self.store.save([1, 2], 'state')
+        self.assertEqual(self.store.load(), (set([1, 2]), 'state'))
+        self.store.save(set([1, 2, 3]), {'a':1})
+        self.assertEqual(self.store.load(), (set([1, 2, 3]), {'a':1}))
+
+    def test_load_corrupt(self):
+        """
+        Verifies an unreadable checkpoint is ignored
+        """
+        self.store.save([1], None)
+        f = open(self.store.path, 'wb')
+        f.write('garbage')
+        f.close()
+        self.assertEqual(self.store.load(), None)
+
+    def test_remove(self):
+        """
+        Verifies the checkpoint and the directory for the task instance are
+        removed
+        """
+        self.store.save([1], None)
+        self.store.remove()
+        self.assertEqual(self.store.load(), None)
+        self.assertFalse(os.path.exists(self.store.directory))
+        self.store.remove()
+
+
+class ParallelTaskCheckpointTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def create_task(self):
+        task = CheckpointingParallelTask()
+        task.parent = CheckpointWorkerProxy(self.directory)
+        return task
+
+    def test_checkpoint_and_resume(self):
+        """
+        A task is restarted after completing some of its workunits
+
+        Verifies:
+            * progress is checkpointed as workunits complete
+            * restarted task only requests missing workunits
+            * partial results are restored
+            * checkpoint is removed when the task completes
+        """
+        pt = self.create_task()
+        pt._work()
+        self.assertEqual(len(pt.parent.request_worker.calls), 10)
+        for i in range(4):
+            pt._work_unit_complete(i, i)
+        
+        # restart the task
+        pt = self.create_task()
+        pt._work()
+        requested = [args[2] for args, kwargs in pt.parent.request_worker.calls]
+        self.assertEqual(requested, range(4, 10))
+        self.assertEqual(pt._finished, range(4))
+        self.assertEqual(pt.progress(), 40)
+        
+        for i in range(4, 10):
+            pt._work_unit_complete(i, i)
+        self.assert_(pt.complete)
+        self.assertEqual(pt._finished, range(10))
+        self.assertEqual(pt._checkpoint_store.load(), None)
+
+    def test_resume_all_complete(self):
+        """
+        A task is restarted after all workunits completed but before the
+        task completed
+
+        Verifies:
+            * no workunits are requested
+            * task completes
+        """
+        pt = self.create_task()
+        pt.parent.get_checkpoint_store(pt).save(range(10), range(10))
+        pt._work()
+        self.assertFalse(pt.parent.request_worker.calls)
+        self.assert_(pt.complete)
+
+    def test_checkpoint_disabled(self):
+        """
+        Verifies no checkpoints are written when checkpoint_interval is None
+        """
+        pt = TestParallelTask()
+        pt.parent = CheckpointWorkerProxy(self.directory)
+        pt._work()
+        pt._work_unit_complete(0, 0)
+        self.assertFalse(os.listdir(self.directory))
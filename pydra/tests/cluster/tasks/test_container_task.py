@@ -27,6 +27,36 @@ from pydra.cluster.tasks.task_container import TaskContainer
 from pydra.tests.cluster.tasks.proxies import StatusSimulatingTaskProxy, WorkerProxy
 from pydra.tests.cluster.tasks.impl.task import StartupAndWaitTask
 from pydra.tests.cluster.tasks.test_tasks import StandaloneTask
+from pydra.tests.proxies import CallProxy
+from pydra.cluster.worker_proxy import LocalWorker
+
+
+class IncrementTask(StandaloneTask):
+    """ adds one to the value it is passed """
+    def work(self, value):
+        return {'value':value+1}
+
+
+class SumTask(StandaloneTask):
+    """ sums the values of several tasks """
+    def work(self, results):
+        return {'value':sum([r['value'] for r in results])}
+
+
+class DiamondContainerTask(TaskContainer):
+    """
+    Container with two independent branches that fan in to a final task:
+    A -> (B, C) -> D
+    """
+    def __init__(self, msg=None):
+        TaskContainer.__init__(self, msg, sequential=False)
+        a = IncrementTask('a')
+        b = IncrementTask('b')
+        c = IncrementTask('c')
+        self.add_task(a)
+        self.add_task(b, depends_on=a)
+        self.add_task(c, depends_on=a)
+        self.add_task(SumTask('d'), depends_on=[b, c])
 
 
 class TestContainerTask(TaskContainer):
@@ -309,6 +339,101 @@ class TaskContainer_Test(twisted_unittest.TestCase):
         return threads.deferToThread(self.verify_sequential_work, task=ctask)
 
 
+class TaskContainerDAG_Test(twisted_unittest.TestCase):
+    """
+    Tests for running subtasks of a TaskContainer as a graph
+    """
+
+    def setUp(self):
+        self.ctask = DiamondContainerTask()
+        for subtask in self.ctask.subtasks:
+            CallProxy.patch(subtask.task, 'start', enabled=False)
+
+    def test_add_task_dependencies(self):
+        """
+        Verifies:
+            * sequential containers depend on the previous task by default
+            * explicit dependencies are resolved to indexes
+            * dependencies must already be in the container
+        """
+        ctask = TestContainerTask()
+        self.assertEqual([s.depends_on for s in ctask.subtasks],
+                         [[], [0], [1]])
+        self.assertEqual([s.depends_on for s in self.ctask.subtasks],
+                         [[], [0], [0], [1, 2]])
+        self.assertRaises(ValueError, ctask.add_task, StandaloneTask(),
+                          None, StandaloneTask())
+        self.assertRaises(ValueError, ctask.add_task, StandaloneTask(),
+                          None, 5)
+
+    def test_independent_subtasks_started(self):
+        """
+        Completes subtasks of a container
+
+        Verifies:
+            * only subtasks without dependencies start with the container
+            * independent subtasks are all started when their dependency
+              completes
+            * a subtask with several dependencies is passed the merged results
+            * container completes with results of the last task
+        """
+        ctask = self.ctask
+        tasks = [subtask.task for subtask in ctask.subtasks]
+        callback = CallProxy(None, False)
+        ctask._start({'value':1}, callback)
+        self.assertEqual([len(t.start.calls) for t in tasks], [1, 0, 0, 0])
+        
+        ctask._subtask_complete({'value':2}, index=0)
+        self.assertEqual([len(t.start.calls) for t in tasks], [1, 1, 1, 0])
+        args, kwargs = tasks[1].start.calls[0]
+        self.assertEqual(kwargs['args'], {'value':2})
+        
+        ctask._subtask_complete({'value':3}, index=2)
+        self.assertEqual(len(tasks[3].start.calls), 0)
+        ctask._subtask_complete({'value':3}, index=1)
+        args, kwargs = tasks[3].start.calls[0]
+        self.assertEqual(kwargs['args'], {'results':[{'value':3},
+                                                     {'value':3}]})
+        self.assertFalse(callback.calls)
+        
+        ctask._subtask_complete({'value':6}, index=3)
+        callback.assertCalled(self, {'value':6})
+
+    def test_progress_critical_path(self):
+        """
+        Verifies:
+            * progress is limited by the branch with the most work left
+            * progress is 100 when all subtasks are complete
+        """
+        ctask = TaskContainer('tester', sequential=False)
+        tasks = [StatusSimulatingTaskProxy() for i in range(3)]
+        ctask.add_task(tasks[0], 50)
+        ctask.add_task(tasks[1], 25)
+        ctask.add_task(tasks[2], 25, depends_on=tasks[1])
+        
+        tasks[0].value = 50
+        self.assertEqual(ctask.progress(), 0)
+        tasks[1].value = 100
+        self.assertEqual(ctask.progress(), 50)
+        tasks[2].value = 50
+        self.assertEqual(ctask.progress(), 50)
+        tasks[0].value = 100
+        self.assertEqual(ctask.progress(), 75)
+        tasks[2].value = 100
+        self.assertEqual(ctask.progress(), 100)
+
+    def test_run_local(self):
+        """
+        Runs the container with a LocalWorker
+
+        Verifies:
+            * results fan in to the final task
+        """
+        deferred = LocalWorker(0).run(DiamondContainerTask(), {'value':1})
+        deferred.addCallback(self.assertEqual, {'value':6})
+        return deferred
+
+
 class TaskContainer2_Test(unittest.TestCase):
     """
     Tests for verify functionality of Task class
@@ -0,0 +1,97 @@
+"""
+    Copyright 2009 Oregon State University
+
+    This file is part of Pydra.
+
+    Pydra is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    Pydra is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with Pydra.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import unittest
+
+from pydra.cluster.tasks import Task
+from pydra.cluster.tasks.counters import Counters, merge_counters
+
+
+class CountingWorker():
+    """worker with counters"""
+
+    def __init__(self):
+        self.counters = Counters()
+
+    def get_worker(self):
+        return self
+
+
+class Counters_Test(unittest.TestCase):
+
+    def test_increment(self):
+        """
+        Verifies:
+            * counters start at 0 and are incremented by amount
+        """
+        counters = Counters()
+        self.assertEqual(counters['records'], 0)
+        counters.increment('records')
+        counters.increment('records', 4)
+        counters.increment('bytes', 100)
+        self.assertEqual(counters['records'], 5)
+        self.assertEqual(counters.values(), {'records':5, 'bytes':100})
+
+    def test_collect(self):
+        """
+        Verifies:
+            * collect returns the counters and resets them
+        """
+        counters = Counters({'records':2})
+        counters.increment('records')
+        self.assertEqual(counters.collect(), {'records':3})
+        self.assertEqual(counters.values(), {})
+        self.assertEqual(len(counters), 0)
+
+    def test_merge(self):
+        """
+        Verifies:
+            * merged counters are added to existing counters
+        """
+        counters = Counters({'records':2})
+        counters.merge({'records':3, 'bytes':10})
+        self.assertEqual(counters.values(), {'records':5, 'bytes':10})
+
+        totals = {'records':1}
+        merge_counters(totals, {'records':1, 'bytes':10})
+        self.assertEqual(totals, {'records':2, 'bytes':10})
+
+
+class TaskCounters_Test(unittest.TestCase):
+
+    def test_worker_counters(self):
+        """
+        Verifies:
+            * tasks increment the counters of their worker
+        """
+        worker = CountingWorker()
+        task = Task('counting')
+        task.parent = worker
+        task.increment('records', 3)
+        self.assertEqual(worker.counters.values(), {'records':3})
+
+    def test_standalone_counters(self):
+        """
+        Verifies:
+            * a task without a worker has its own counters
+        """
+        task = Task('counting')
+        task.increment('records')
+        task.increment('records')
+        self.assertEqual(task.counters.values(), {'records':2})
@@ -1,12 +1,23 @@
 import unittest
 
-import tempfile, shutil
+import os, tempfile, shutil
+
+import simplejson
+
+from Crypto.PublicKey import RSA
+from twisted.internet import reactor, threads
+from twisted.trial import unittest as twisted_unittest
 
 from pydra.cluster.tasks.mapreduce import *
 from pydra.cluster.tasks.tasks import Task
 from pydra.cluster.tasks.mapreduce import MapReduceTask
+from pydra.cluster.tasks.datasource.backend import SQLBackend
+from pydra.cluster.tasks.datasource.shuffle import ShuffleFactory
+from pydra.cluster.tasks.datasource.sink import FileSink
 from proxies import *
 
+SHUFFLE_KEY = RSA.generate(1024)
+
 
 class TestMapReduce(MapReduceTask):
     pass
@@ -37,28 +48,30 @@ class AppendableDict_Test(unittest.TestCase):
 
 class IntermediateResultsFiles_Test(unittest.TestCase):
 
+    format = 'run'
+
     def setUp(self):
         self.tempdir = tempfile.mkdtemp()
         self.task_name = "test_task"
-        self.dir = DatasourceDir(self.tempdir)
+        self.dir = self.tempdir
 
     def tearDown(self):
         shutil.rmtree(self.tempdir)
 
     def test_partition(self):
 
-        a = { 'a': 1, 'b': 1, }
+        a = { 'a': [1], 'b': [1], }
 
-        im1 = IntermediateResultsFiles(self.dir) 
+        im1 = IntermediateResultsFiles(self.dir, self.format)
         im1.task_id = self.task_name
         im1.reducers = 2
 
         pdict = im1.partition_output(a)
         p1 = im1.dump(pdict, 'map1')
 
-        b = { 'b': 1, 'c': 1, }
+        b = { 'b': [1], 'c': [1], }
 
-        im2 = IntermediateResultsFiles(self.dir) 
+        im2 = IntermediateResultsFiles(self.dir, self.format)
         im2.task_id = self.task_name
         im2.reducers = 2
 
@@ -66,7 +79,7 @@ class IntermediateResultsFiles_Test(unittest.TestCase):
         p2 = im2.dump(pdict, 'map2')
 
         # getting results
-        im = IntermediateResultsFiles(self.dir) 
+        im = IntermediateResultsFiles(self.dir, self.format)
         im.task_id = self.task_name
         im.reducers = 2
 
@@ -75,14 +88,344 @@ class IntermediateResultsFiles_Test(unittest.TestCase):
 
         # reduce
         c = { 'a': 0, 'b': 0, 'c': 0 }
+        keys = []
         for p in im:
-            for k, v in im.load(p):
-                c[k] += 1
+            for k, vs in im.load(p):
+                keys.append(k)
+                c[k] += len(list(vs))
 
         self.assertEqual(c['a'], 1)
         self.assertEqual(c['b'], 2)
         self.assertEqual(c['c'], 1)
 
+        # each key is reduced once
+        self.assertEqual(sorted(keys), ['a', 'b', 'c'])
+
+    def test_load_sorted(self):
+        """
+        Verifies:
+            * each dump is read back in key order with all values
+        """
+        im = IntermediateResultsFiles(self.dir, self.format)
+        im.task_id = self.task_name
+
+        output = AppendableDict()
+        for k in ('c', 'a', 'b', 'a'):
+            output[k] = 1
+        im.update_partitions(im.dump(im.partition_output(output), 'map1'))
+
+        for p in im:
+            self.assertEqual([(k, list(vs)) for k, vs in im.load(p)],
+                             [('a', [1, 1]), ('b', [1]), ('c', [1])])
+
+    def test_merge(self):
+        """
+        Verifies:
+            * dumps of several maps are merged into one group per key in
+              key order
+            * values are returned in the order of the dumps
+        """
+        im = IntermediateResultsFiles(self.dir, self.format)
+        im.task_id = self.task_name
+
+        for i, words in enumerate(('b c', 'a c', 'c d')):
+            output = AppendableDict()
+            for word in words.split():
+                output[word] = i
+            im.update_partitions(im.dump(im.partition_output(output),
+                                         'map%d' % i))
+
+        for p in im:
+            self.assertEqual([(k, list(vs)) for k, vs in im.load(p)],
+                [('a', [1]), ('b', [0]), ('c', [0, 1, 2]), ('d', [2])])
+
+    def test_clear(self):
+        """
+        Verifies:
+            * clear() removes the dumps
+        """
+        im = IntermediateResultsFiles(self.dir, self.format)
+        im.task_id = self.task_name
+        im.update_partitions(im.dump(im.partition_output({'a':[1]}), 'map1'))
+        self.assert_(os.listdir(self.tempdir))
+
+        im.clear()
+        self.assertEqual(os.listdir(self.tempdir), [])
+
+
+class IntermediateResultsFilesPickle_Test(IntermediateResultsFiles_Test):
+
+    format = 'pickle'
+
+
+class IntermediateResultsFilesCompressed_Test(IntermediateResultsFiles_Test):
+
+    def setUp(self):
+        IntermediateResultsFiles_Test.setUp(self)
+        self.dir = self.tempdir
+        self.format = 'run'
+
+    def test_compressed(self):
+        """
+        Verifies:
+            * dumps are written and merged with compression
+        """
+        im = IntermediateResultsFiles(self.dir, compression='fast')
+        im.task_id = self.task_name
+        for i in range(3):
+            output = AppendableDict()
+            output['a'] = i
+            im.update_partitions(im.dump(im.partition_output(output),
+                                         'map%d' % i))
+        for p in im:
+            self.assertEqual([(k, list(vs)) for k, vs in im.load(p)],
+                             [('a', [0, 1, 2])])
+
+
+class IntermediateResultsShuffle_Test(twisted_unittest.TestCase):
+    """
+    Two nodes, each with its own shuffle directory and shuffle server
+    """
+
+    def setUp(self):
+        self.dirs = []
+        self.listeners = []
+        self.ims = []
+        for i in range(2):
+            dir = tempfile.mkdtemp()
+            listener = reactor.listenTCP(0, ShuffleFactory(dir, SHUFFLE_KEY),
+                                         interface='127.0.0.1')
+            im = IntermediateResultsShuffle(dir, '127.0.0.1',
+                                            listener.getHost().port)
+            im.task_id = 'test_task'
+            im.reducers = 2
+            im.fetcher.key = SHUFFLE_KEY
+            im.fetcher.timeout = 10
+            self.dirs.append(dir)
+            self.listeners.append(listener)
+            self.ims.append(im)
+
+    def tearDown(self):
+        for dir in self.dirs:
+            shutil.rmtree(dir)
+        for listener in self.listeners:
+            listener.stopListening()
+
+    def dump(self, im, output, mapid):
+        partitions = im.dump(im.partition_output(output), mapid)
+        for im in self.ims:
+            im.update_partitions(partitions)
+
+    def test_host(self):
+        """
+        Verifies:
+            * dumps are located on the node of the worker writing them
+            * standalone tasks locate dumps on this host
+        """
+        im = IntermediateResultsShuffle(self.dirs[0], port=18802)
+        self.assertEqual(im.locate('dump'), 'localhost:18802/dump')
+
+        class Worker:
+            worker_key = 'node1:11890:0'
+        task = Task('task')
+        task.parent = Worker()
+        task.parent.get_worker = lambda: task.parent
+        im.parent = task
+        self.assertEqual(im.locate('dump'), 'node1:18802/dump')
+
+    def test_load(self):
+        """
+        Verifies:
+            * maps dump to the local directory of their node
+            * reducers read the dumps of both nodes
+            * fetched copies are removed once read
+        """
+        a, b = self.ims
+        self.dump(a, {'a':[1], 'b':[1]}, 'map1')
+        self.dump(b, {'b':[2], 'c':[1]}, 'map2')
+        self.assertEqual(len(os.listdir(self.dirs[0])), 2)
+        self.assertEqual(len(os.listdir(self.dirs[1])), 2)
+
+        def reduce():
+            c = {}
+            for p in b:
+                for k, vs in b.load(p):
+                    c.setdefault(k, []).extend(vs)
+            self.assertEqual(c, {'a':[1], 'b':[1, 2], 'c':[1]})
+            self.assertEqual(len(os.listdir(self.dirs[1])), 2)
+            self.assert_(b.fetcher.stats['segments'] > 0)
+        return threads.deferToThread(reduce)
+
+    def test_merge_clear(self):
+        """
+        Verifies:
+            * dumps of other nodes are merged into a dump on this node
+            * clear removes the dumps from every node
+        """
+        a, b = self.ims
+        self.dump(a, {'a':[1]}, 'map1')
+        self.dump(b, {'a':[2]}, 'map2')
+
+        def merge():
+            [(p, keys)] = b.take_runs(2)
+            b.update_partitions(b.merge(p, keys, 'merge0'))
+            self.assertEqual(b._partitions[p],
+                             ['127.0.0.1:%d/mapreduce-i9e-test_task-%d-merge0' \
+                              % (b.port, p)])
+            self.assertEqual(len(os.listdir(self.dirs[1])), 1)
+            self.assertEqual([(k, list(vs)) for k, vs in \
+                              b.load(b._partitions[p])], [('a', [1, 2])])
+
+        def clear(result):
+            # the dump of map1 is only known by the merged partitions
+            return b.clear()
+
+        def check(result):
+            for dir in self.dirs:
+                self.assertEqual(os.listdir(dir), [])
+
+        deferred = threads.deferToThread(merge)
+        deferred.addCallback(clear)
+        deferred.addCallback(check)
+        return deferred
+
+
+class IntermediateResultsSQL_Test(unittest.TestCase):
+
+    def setUp(self):
+        self.db = SQLBackend('sqlite', ':memory:')
+
+    def test_partition(self):
+        """
+        Verifies:
+            * dumps from several maps are read back by partition
+        """
+        im = IntermediateResultsSQL('i9e', self.db)
+        im.task_id = 'test_task'
+        im.reducers = 2
+
+        im.update_partitions(im.dump(im.partition_output({'a':[1], 'b':[1]}),
+                                     'map1'))
+        im.update_partitions(im.dump(im.partition_output({'b':[2], 'c':[1]}),
+                                     'map2'))
+
+        c = {}
+        for p, keys in im.partitions():
+            for k, vs in im.load(keys, p):
+                c.setdefault(k, []).extend(vs)
+        self.assertEqual(c, {'a':[1], 'b':[1, 2], 'c':[1]})
+
+        im.clear()
+        cursor = self.db.handle.cursor()
+        cursor.execute('SELECT COUNT(*) FROM i9e')
+        self.assertEqual(cursor.fetchone()[0], 0)
+
+    def test_batches(self):
+        """
+        Verifies:
+            * dumps larger than a batch are inserted and read entirely
+            * keys are read grouped, with the values of every dump
+            * rows of dumps not reported by a map are skipped
+        """
+        im = IntermediateResultsSQL('i9e', self.db)
+        im.task_id = 7
+        im.map_output.batch_size = im.reduce_input.batch_size = 3
+
+        output = dict(('key%02d' % i, [i]) for i in range(10))
+        im.update_partitions(im.dump(im.partition_output(output), 'map1'))
+        im.update_partitions(im.dump(im.partition_output(output), 'map2'))
+        # dumped by a map that failed
+        im.dump(im.partition_output(output), 'map3')
+
+        [(p, keys)] = im.partitions()
+        results = [(k, list(vs)) for k, vs in im.load(keys, p)]
+        self.assertEqual(sorted(results),
+                         [('key%02d' % i, [i, i]) for i in range(10)])
+
+    def test_key_order(self):
+        """
+        Verifies:
+            * keys are read in key order rather than pickled order
+            * equal keys of different types are read as one group
+        """
+        im = IntermediateResultsSQL('i9e', self.db)
+        im.task_id = 'task1'
+
+        im.update_partitions(im.dump(im.partition_output({10:[1], 9:[2],
+                                                          'a':[3]}), 'map1'))
+        im.update_partitions(im.dump(im.partition_output({10L:[4], 100:[5],
+                                                          u'a':[6]}), 'map2'))
+
+        [(p, keys)] = im.partitions()
+        self.assertEqual([(k, list(vs)) for k, vs in im.load(keys, p)],
+                         [(9, [2]), (10, [1, 4]), (100, [5]), ('a', [3, 6])])
+
+    def test_merge(self):
+        """
+        Verifies:
+            * merged dumps replace the dumps they were merged from
+            * clear only removes the rows of its own task
+        """
+        im = IntermediateResultsSQL('i9e', self.db)
+        im.task_id = 'task1'
+        other = IntermediateResultsSQL('i9e', self.db)
+        other.task_id = 'task2'
+
+        for i in range(3):
+            im.update_partitions(im.dump(im.partition_output({'a':[i]}),
+                                         'map%d' % i))
+        other.dump(other.partition_output({'a':[5]}), 'map0')
+
+        [(p, keys)] = im.take_runs(3)
+        im.update_partitions(im.merge(p, keys, 'merge0'))
+        [(p, keys)] = im.partitions()
+        self.assertEqual(keys, ['mapreduce-i9e-task1-0-merge0'])
+        self.assertEqual([(k, list(vs)) for k, vs in im.load(keys, p)],
+                         [('a', [0, 1, 2])])
+
+        im.clear()
+        cursor = self.db.handle.cursor()
+        cursor.execute('SELECT task_id, COUNT(*) FROM i9e GROUP BY task_id')
+        self.assertEqual(cursor.fetchall(), [('task2', 1)])
+
+    def test_index(self):
+        im = IntermediateResultsSQL('i9e', self.db)
+        im.dump(im.partition_output({'a':[1]}), 'map1')
+        # creating the table again keeps the existing index
+        im.map_output.create_table()
+
+        cursor = self.db.handle.cursor()
+        cursor.execute("PRAGMA index_info(i9e_key)")
+        self.assertEqual([row[2] for row in cursor.fetchall()],
+                         ['task_id', 'part', 'run', 'seq'])
+
+    def test_read_streams(self):
+        """
+        Verifies:
+            * a dump is read in key order one batch at a time
+            * the read uses the index instead of sorting
+        """
+        im = IntermediateResultsSQL('i9e', self.db)
+        im.task_id = 'task1'
+        im.reduce_input.batch_size = 2
+        output = dict((k, [i]) for i, k in enumerate([10, 'b', 9, u'a', 2L]))
+        [(p, (key, records, values))] = im.dump(im.partition_output(output),
+                                                'map1').items()
+
+        reader = im.load([key], p)
+        run = reader.read(key)
+        self.assertEqual(run.next(), (2L, [4]))
+        self.assertEqual(list(run), [(9, [2]), (10, [0]), (u'a', [3]),
+                                     ('b', [1])])
+
+        cursor = self.db.handle.cursor()
+        cursor.execute("EXPLAIN QUERY PLAN SELECT k, v FROM i9e WHERE "
+                       "task_id = ? AND part = ? AND run = ? ORDER BY seq",
+                       ('task1', p, key))
+        plan = ' '.join(str(row[-1]) for row in cursor.fetchall())
+        self.assert_('i9e_key' in plan, plan)
+        self.failIf('TEMP B-TREE' in plan, plan)
+
 
 class MapReduceTask_Test(unittest.TestCase):
     """
@@ -202,6 +545,24 @@ class IdentityReduceTask(Task):
             output[k] = v
 
 
+class SumReduceTask(Task):
+
+    def _work(self, input, output, **kwargs):
+
+        for k, vs in input:
+            output[k] = sum(vs)
+
+
+class RecordingOutput():
+    """map output that records dumps"""
+
+    def __init__(self):
+        self.dumps = {}
+
+    def dump(self, key, tuples):
+        self.dumps[key] = sorted(tuples)
+
+
 class NullIM():
     """dummy intermediate results class"""
 
@@ -210,10 +571,11 @@ class NullIM():
 
 
     def dump(self, output, mapid):
-        return output, mapid
+        self.dumped = output, mapid
+        return {}
 
 
-    def load(self, fs):
+    def load(self, fs, partition=None, runs=None):
         return fs.iteritems()
 
 
@@ -235,8 +597,8 @@ class MapReduceWrapper_Test(unittest.TestCase):
         a = { 'a': 1, 'b': 1, }
         id = 'identity_map'
 
-        dump_results = self.maptask._start(args={'input': a.iteritems(), 'id': id})
-        output, mapid = dump_results
+        self.maptask._start(args={'input': a.iteritems(), 'id': id})
+        output, mapid = self.im.dumped
 
         self.assertEqual(mapid, id, "mapid differs from id")
 
@@ -266,3 +628,623 @@ class MapReduceWrapper_Test(unittest.TestCase):
         returned = self.reducetask.get_subtask(key.split('.'))
         self.assert_(returned is expected, 'ReduceTask retrieved was not the expected Task')
 
+
+
+class Combiner_Test(unittest.TestCase):
+
+    def setUp(self):
+        self.im = IntermediateResults()
+        self.im.reducers = 2
+        self.im.map_output = RecordingOutput()
+        self.worker = WorkerProxy()
+
+    def run_map(self, combiner=None):
+        maptask = MapWrapper(IdentityMapTask("IdentityMapTask"), self.im,
+                             self.worker, combiner)
+        input = [('a', 1), ('b', 1), ('a', 1), ('c', 2), ('a', 1)]
+        return maptask._start(args={'input': input, 'id': 'map0'})
+
+    def test_combiner(self):
+        """
+        Verifies:
+            * values of each key are combined before being dumped
+            * partitions are the same as without a combiner
+        """
+        uncombined = self.run_map()
+        dumps = self.im.map_output.dumps
+        self.assertEqual(sum(len(vs) for d in dumps.values() \
+                             for k, vs in d), 5)
+
+        self.im.map_output = RecordingOutput()
+        combined = self.run_map(SumReduceTask("SumReduceTask"))
+        self.assertEqual(sorted(combined), sorted(uncombined))
+        self.assertEqual(sum(r[2] for r in combined.values()), 3)
+
+        values = {}
+        for tuples in self.im.map_output.dumps.values():
+            values.update(tuples)
+        self.assertEqual(values, {'a':[3], 'b':[1], 'c':[2]})
+
+    def test_mapreducetask_combiner(self):
+        """
+        Verifies:
+            * the combiner class of a MapReduceTask is given to the map
+        """
+        class CombinedMapReduce(MapReduceTask):
+            map = IdentityMapTask
+            reduce = SumReduceTask
+            combiner = SumReduceTask
+            intermediate = self.im
+
+        task = CombinedMapReduce('combined')
+        self.assert_(isinstance(task.maptask.combiner, SumReduceTask))
+        self.assertEqual(task.maptask.combiner.parent, task)
+
+
+class WordMapTask(Task):
+
+    def _work(self, input, output, **kwargs):
+
+        for word in input:
+            output[word] = 1
+
+
+class ListInput():
+    """map input from a list of lists of words"""
+
+    def __init__(self, data):
+        self.data = data
+
+    def __iter__(self):
+        return iter(range(len(self.data)))
+
+    def load(self, i):
+        return self.data[i]
+
+
+class QueueWorker(WorkerProxy):
+    """worker that queues requested workunits until they are run"""
+
+    def __init__(self):
+        self.requests = []
+
+    def request_worker(self, subtask_key, args, workunit):
+        self.requests.append((subtask_key, args, workunit))
+
+    def run(self, task, workunit):
+        """runs a requested workunit and returns its results to the task"""
+        for request in self.requests:
+            if request[2] == workunit:
+                self.requests.remove(request)
+                subtask_key, args, workunit = request
+                subtask = task.get_subtask(subtask_key.split('.'))
+                results = subtask._start(args)
+                task._work_unit_complete(results, workunit)
+                return
+        raise KeyError(workunit)
+
+    def requested(self, prefix):
+        return sorted(r[2] for r in self.requests if r[2].startswith(prefix))
+
+
+class SlowStart_Test(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+
+        class SlowStartMapReduce(MapReduceTask):
+            input = ListInput([['a', 'b'], ['b', 'c'], ['a', 'c'], ['a']])
+            output = {}
+            map = WordMapTask
+            reduce = SumReduceTask
+            intermediate = IntermediateResultsFiles(self.tempdir)
+            reduce_slowstart = 0.5
+            premerge_runs = 2
+            memory_shuffle = False
+
+        self.task = SlowStartMapReduce('slowstart')
+        self.worker = QueueWorker()
+        self.task.parent = self.worker
+        self.results = []
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_slowstart(self):
+        """
+        Verifies:
+            * partitions are merged once the slow start fraction of maps is
+              complete
+            * reduce tasks wait for maps and merges
+            * merged partitions are reduced correctly
+        """
+        worker = self.worker
+        self.task._start({}, lambda results: self.results.append(results))
+        self.assertEqual(worker.requested('map'),
+                         ['map0', 'map1', 'map2', 'map3'])
+
+        worker.run(self.task, 'map0')
+        self.assertEqual(worker.requested('merge'), [])
+        worker.run(self.task, 'map1')
+        self.assertEqual(worker.requested('merge'), ['merge0'])
+        self.assertEqual(self.task.im._partitions, {0: []})
+
+        worker.run(self.task, 'merge0')
+        self.assertEqual(len(os.listdir(self.tempdir)), 1)
+        worker.run(self.task, 'map2')
+        worker.run(self.task, 'map3')
+        self.assertEqual(worker.requested('reduce'), [])
+        self.assertEqual(worker.requested('merge'), ['merge1'])
+
+        worker.run(self.task, 'merge1')
+        self.assertEqual(worker.requested('reduce'), ['reduce0'])
+        worker.run(self.task, 'reduce0')
+
+        self.assertEqual(self.results, [{'a':3, 'b':2, 'c':2}])
+        self.assertEqual(os.listdir(self.tempdir), [])
+
+    def test_no_slowstart(self):
+        """
+        Verifies:
+            * without slow start, reduce tasks start after all maps
+        """
+        worker = self.worker
+        self.task.reduce_slowstart = None
+        self.task._start({}, lambda results: self.results.append(results))
+        for i in range(4):
+            worker.run(self.task, 'map%d' % i)
+        self.assertEqual(worker.requested('merge'), [])
+        worker.run(self.task, 'reduce0')
+        self.assertEqual(self.results, [{'a':3, 'b':2, 'c':2}])
+
+
+class Partitioner_Test(unittest.TestCase):
+
+    def test_hash_partitioner(self):
+        """
+        Verifies:
+            * keys are partitioned consistently between reducers
+            * keys of other types are partitioned by their str()
+        """
+        partitioner = HashPartitioner()
+        self.assertEqual(partitioner.partition('a', 4), hash('a') % 4)
+        self.assertEqual(partitioner.partition(7, 4), 7 % 4)
+        self.assertEqual(partitioner.partition(('a', 1), 4),
+                         hash(str(('a', 1))) % 4)
+
+    def test_range_partitioner(self):
+        """
+        Verifies:
+            * boundaries split the sample into equal shares of values
+            * partitions hold contiguous ranges of keys
+        """
+        partitioner = RangePartitioner()
+        partitioner.build([(k, 1) for k in 'abcdefghijkl'], 3)
+        self.assertEqual(partitioner.boundaries, ['d', 'h'])
+        self.assertEqual([partitioner.partition(k, 3) for k in 'acdeijz'],
+                         [0, 0, 0, 1, 2, 2, 2])
+        self.assertEqual(partitioner.heavy_hitters, [])
+
+    def test_range_partitioner_heavy_hitter(self):
+        """
+        Verifies:
+            * a key with more than a reducer's share of the values is given
+              its own partition
+        """
+        partitioner = RangePartitioner()
+        sample = [('a', 1), ('b', 1), ('h', 6), ('x', 1), ('y', 1)]
+        partitioner.build(sample, 3)
+        self.assertEqual(partitioner.heavy_hitters, ['h'])
+        self.assertEqual(partitioner.boundaries, ['b', 'h'])
+        self.assertEqual([partitioner.partition(k, 3) for k in 'abhxy'],
+                         [0, 0, 1, 2, 2])
+
+    def test_range_partitioner_tuple_keys(self):
+        """
+        Verifies:
+            * tuple boundaries sent to maps as JSON are loaded as tuples
+            * tuple keys are partitioned by range after loading
+        """
+        partitioner = RangePartitioner()
+        partitioner.build([(('a', i), 1) for i in range(12)], 3)
+        state = simplejson.loads(simplejson.dumps(partitioner.state()))
+
+        loaded = RangePartitioner()
+        loaded.load(state)
+        self.assertEqual(loaded.boundaries, partitioner.boundaries)
+        self.assertEqual([loaded.partition(('a', i), 3) for i in (0, 5, 11)],
+                         [0, 1, 2])
+
+    def test_range_partitioner_sample(self):
+        """
+        Verifies:
+            * the sample of a large output is limited to sample_size keys
+              weighted to the size of the output
+        """
+        partitioner = RangePartitioner()
+        partitioner.sample_size = 10
+        output = AppendableDict()
+        for i in range(100):
+            output[i] = 1
+        sample = partitioner.sample(output)
+        self.assertEqual(len(sample), 10)
+        self.assertEqual(sum(weight for k, weight in sample), 100)
+
+
+class RangePartition_Test(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+
+        class RangeMapReduce(MapReduceTask):
+            input = ListInput([['a', 'b', 'c'], ['d', 'e'], ['a', 'f'],
+                               ['e', 'f']])
+            output = {}
+            map = WordMapTask
+            reduce = SumReduceTask
+            intermediate = IntermediateResultsFiles(self.tempdir)
+            partitioner = RangePartitioner
+            reducers = 2
+            memory_shuffle = False
+
+        self.task = RangeMapReduce('range')
+        self.task.im.partitioner.sample_maps = 2
+        self.worker = QueueWorker()
+        self.task.parent = self.worker
+        self.results = []
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_range_partition(self):
+        """
+        Verifies:
+            * sample maps run before the map stage
+            * every input is mapped after sampling
+            * partitions hold ranges of keys
+            * partition stats are recorded after the map stage
+        """
+        worker = self.worker
+        self.task._start({}, lambda results: self.results.append(results))
+        self.assertEqual(worker.requested('sample'), ['sample0', 'sample1'])
+        self.assertEqual(worker.requested('map'), [])
+
+        worker.run(self.task, 'sample0')
+        self.assertEqual(worker.requested('map'), [])
+        worker.run(self.task, 'sample1')
+        self.assertEqual(self.task.im.partitioner.boundaries, ['c'])
+        self.assertEqual(worker.requested('map'),
+                         ['map0', 'map1', 'map2', 'map3'])
+
+        for i in range(4):
+            worker.run(self.task, 'map%d' % i)
+
+        stats = self.task.partition_stats
+        self.assertEqual(stats['partitions'][0]['values'], 4)
+        self.assertEqual(stats['partitions'][1]['values'], 5)
+        self.assertEqual(stats['partitions'][0]['dumps'], 2)
+
+        keys = {}
+        for p, keys_ in enumerate(self.task.im):
+            for k, vs in self.task.im.load(keys_):
+                keys[k] = p
+        self.assertEqual(keys, {'a':0, 'b':0, 'c':0, 'd':1, 'e':1, 'f':1})
+
+        worker.run(self.task, 'reduce0')
+        worker.run(self.task, 'reduce1')
+        self.assertEqual(self.results,
+            [{'a':2, 'b':1, 'c':1, 'd':1, 'e':2, 'f':2}])
+
+
+class Sink_Test(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.i9e = os.path.join(self.tempdir, 'i9e')
+        self.out = os.path.join(self.tempdir, 'out')
+        os.mkdir(self.i9e)
+        os.mkdir(self.out)
+
+        class SinkMapReduce(MapReduceTask):
+            input = ListInput([['a', 'b', 'c'], ['d', 'e'], ['a', 'f']])
+            output = FileSink(self.out)
+            map = WordMapTask
+            reduce = SumReduceTask
+            intermediate = IntermediateResultsFiles(self.i9e)
+            reducers = 2
+
+        self.task = SinkMapReduce('sink')
+        self.worker = QueueWorker()
+        self.task.parent = self.worker
+        self.results = []
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_sink(self):
+        """
+        Verifies:
+            * reducers write their results to the sink
+            * the task returns the manifest of the written partitions
+        """
+        worker = self.worker
+        self.task._start({}, lambda results: self.results.append(results))
+        for i in range(3):
+            worker.run(self.task, 'map%d' % i)
+        for workunit in worker.requested('reduce'):
+            worker.run(self.task, workunit)
+
+        manifest = self.results[0]
+        self.assertEqual([e['partition'] for e in manifest],
+                         sorted(self.task.partition_stats['partitions']))
+        self.assertEqual(sum(e['records'] for e in manifest), 6)
+
+        counts = {}
+        for entry in manifest:
+            for line in open(entry['path']):
+                word, count = line.split()
+                counts[word] = int(count)
+        self.assertEqual(counts, {'a':2, 'b':1, 'c':1, 'd':1, 'e':1, 'f':1})
+
+    def test_sink_failed(self):
+        """
+        Verifies:
+            * the writer of a failed reducer is aborted, leaving no file
+        """
+        def fail(input, output, **kwargs):
+            output['a'] = 1
+            raise Exception('reduce failed')
+
+        worker = self.worker
+        self.task._start({}, lambda results: self.results.append(results))
+        for i in range(3):
+            worker.run(self.task, 'map%d' % i)
+        self.task.reducetask.task._work = fail
+        self.assertRaises(Exception, worker.run, self.task,
+                          worker.requested('reduce')[0])
+        self.assertEqual(os.listdir(self.out), [])
+
+
+class MemoryShuffle_Test(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+
+        class MemoryMapReduce(MapReduceTask):
+            input = ListInput([['a', 'b', 'c'], ['d', 'e'], ['a', 'f'],
+                               ['e', 'f']])
+            output = {}
+            map = WordMapTask
+            reduce = SumReduceTask
+            intermediate = IntermediateResultsFiles(self.tempdir)
+            reducers = 2
+            memory_shuffle = True
+
+        self.task_class = MemoryMapReduce
+        self.results = []
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def run_task(self, task):
+        worker = QueueWorker()
+        task.parent = worker
+        task._start({}, lambda results: self.results.append(results))
+        maps = [dict(r[1]) for r in worker.requests]
+        for i in range(4):
+            worker.run(task, 'map%d' % i)
+        reduces = [dict(r[1]) for r in worker.requests \
+                   if r[2].startswith('reduce')]
+        for workunit in worker.requested('reduce'):
+            worker.run(task, workunit)
+        self.assertEqual(self.results,
+            [{'a':2, 'b':1, 'c':1, 'd':1, 'e':2, 'f':2}])
+        return maps, reduces
+
+    def test_default(self):
+        """
+        Verifies:
+            * in memory shuffle must be enabled
+        """
+        self.assertFalse(MapReduceTask.memory_shuffle)
+
+    def test_memory_shuffle(self):
+        """
+        Verifies:
+            * map output below the limits is held in memory, nothing is
+              dumped
+            * held partitions are reduced by the main worker, no reduce
+              workunit is requested
+        """
+        task = self.task_class('memory')
+        maps, reduces = self.run_task(task)
+        for args in maps:
+            self.assertEqual(args['memory'], task.memory_map_limit)
+        self.assertEqual(reduces, [])
+        self.assertEqual(os.listdir(self.tempdir), [])
+        self.assertEqual(task.im.held_bytes, 0)
+
+    def test_counters(self):
+        """
+        Verifies:
+            * maps count their output, in total and for each partition
+            * reducers count their output
+        """
+        task = self.task_class('counters')
+        self.run_task(task)
+        counters = task.maptask.task.counters
+        self.assertEqual(counters['mapreduce.map_output_values'], 9)
+        self.assertEqual(counters['mapreduce.partition.0.values'] +
+                         counters['mapreduce.partition.1.values'], 9)
+        self.assert_(counters['mapreduce.map_output_held_bytes'])
+        self.assertEqual(
+            task.reducetask.task.counters['mapreduce.reduce_output_records'],
+            6)
+
+    def test_spill(self):
+        """
+        Verifies:
+            * held runs are spilled to the backend once they exceed the limit
+            * maps completing after the spill are dumped
+        """
+        task = self.task_class('spill')
+        task.memory_shuffle_limit = 0
+
+        worker = QueueWorker()
+        task.parent = worker
+        task._start({}, lambda results: self.results.append(results))
+        worker.run(task, 'map0')
+        self.assertEqual(task.im.held_bytes, 0)
+        spilled = os.listdir(self.tempdir)
+        self.assert_(spilled)
+        worker.run(task, 'map1')
+        self.assertEqual(task.im.held_bytes, 0)
+        self.assert_(len(os.listdir(self.tempdir)) > len(spilled))
+
+        worker.run(task, 'map2')
+        worker.run(task, 'map3')
+        for subtask_key, args, workunit in worker.requests:
+            self.failIf('runs' in args)
+        for workunit in worker.requested('reduce'):
+            worker.run(task, workunit)
+        self.assertEqual(self.results,
+            [{'a':2, 'b':1, 'c':1, 'd':1, 'e':2, 'f':2}])
+        self.assertEqual(os.listdir(self.tempdir), [])
+
+    def test_map_limit(self):
+        """
+        Verifies:
+            * a map with more output than memory_map_limit dumps it
+            * runs held before are spilled and the remaining maps dump
+        """
+        task = self.task_class('map_limit')
+        task.memory_map_limit = 0
+        maps, reduces = self.run_task(task)
+        self.assertEqual(len(reduces), 2)
+        for args in reduces:
+            self.failIf('runs' in args)
+        self.assertEqual(task.im.held_bytes, 0)
+
+    def test_disabled(self):
+        """
+        Verifies:
+            * maps dump their output when in memory shuffle is disabled
+        """
+        self.task_class.memory_shuffle = False
+        maps, reduces = self.run_task(self.task_class('disabled'))
+        for args in maps:
+            self.failIf('memory' in args)
+        self.assertEqual(len(reduces), 2)
+
+
+class InvertMapTask(Task):
+    """maps (word, count) tuples to count: word"""
+
+    def _work(self, input, output, **kwargs):
+        for word, count in input:
+            output[count] = word
+
+
+class ListReduceTask(Task):
+
+    def _work(self, input, output, **kwargs):
+        for k, vs in input:
+            output[k] = sorted(vs)
+
+
+class Chain_Test(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.chaindir = tempfile.mkdtemp()
+        chain = ChainOutput(IntermediateResultsFiles(self.chaindir))
+
+        class CountStage(MapReduceTask):
+            input = ListInput([['a', 'b', 'c'], ['a', 'b'], ['a']])
+            output = chain
+            map = WordMapTask
+            reduce = SumReduceTask
+            intermediate = IntermediateResultsFiles(self.tempdir)
+            reducers = 2
+
+        class InvertStage(MapReduceTask):
+            input = chain
+            output = {}
+            map = InvertMapTask
+            reduce = ListReduceTask
+            intermediate = IntermediateResultsFiles(self.tempdir)
+
+        self.chain = chain
+        self.stages = [CountStage('count'), InvertStage('invert')]
+        self.results = []
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+        shutil.rmtree(self.chaindir)
+
+    def run_stage(self, task, args):
+        worker = QueueWorker()
+        task.parent = worker
+        task._start(args, lambda results: self.results.append(results))
+        while worker.requests:
+            worker.run(task, worker.requests[0][2])
+
+    def test_chain(self):
+        """
+        Verifies:
+            * reducer output stays in the backend of the chain
+            * each partition of the output is the input of a map of the next
+              stage
+            * the output of the previous stage is removed once the next stage
+              is complete
+        """
+        count, invert = self.stages
+        self.run_stage(count, {})
+        manifest = self.results[0]
+        self.assertEqual(sorted(e['partition'] for e in manifest),
+                         sorted(count.partition_stats['partitions']))
+        self.assertEqual(sum(e['records'] for e in manifest), 3)
+        self.assertEqual(len(os.listdir(self.chaindir)), len(manifest))
+        self.assertEqual(os.listdir(self.tempdir), [])
+
+        self.assertEqual(sorted(pair for entry in self.chain \
+                                for pair in self.chain.load(entry)),
+                         [('a', 3), ('b', 2), ('c', 1)])
+
+        self.run_stage(invert, manifest)
+        self.assertEqual(self.results[1], {1:['c'], 2:['b'], 3:['a']})
+        self.assertEqual(os.listdir(self.chaindir), [])
+        self.assertEqual(list(self.chain), [])
+
+    def test_chain_reduce_failed(self):
+        """
+        Verifies:
+            * the exception of a failed reducer is raised
+            * the writer of a failed reducer is aborted, leaving no dump
+        """
+        def fail(input, output, **kwargs):
+            output['a'] = 1
+            raise Exception('reduce failed')
+
+        count = self.stages[0]
+        count.reducetask.task._work = fail
+        try:
+            self.run_stage(count, {})
+            self.fail('reduce did not fail')
+        except Exception, e:
+            self.assertEqual(str(e), 'reduce failed')
+        self.assertEqual(os.listdir(self.chaindir), [])
+
+    def test_chain_dump_failed(self):
+        """
+        Verifies:
+            * a dump that fails while the writer is closed is removed
+        """
+        def unpicklable(input, output, **kwargs):
+            for k, vs in input:
+                output[k] = lambda: None
+
+        count = self.stages[0]
+        count.reducetask.task._work = unpicklable
+        self.assertRaises(Exception, self.run_stage, count, {})
+        self.assertEqual(os.listdir(self.chaindir), [])
@@ -25,6 +25,8 @@ from twisted.internet import threads
 from pydra.cluster.tasks import TaskNotFoundException, STATUS_STOPPED, \
     STATUS_COMPLETE, STATUS_RUNNING
 from pydra.cluster.tasks.parallel_task import ParallelTask
+from pydra.cluster.tasks.datasource import DataSource
+from pydra.cluster.tasks.datasource.selector import FileUnit
 from pydra.cluster.tasks.datasource.slicer import IterSlicer
 
 from pydra.tests.proxies import CallProxy
@@ -52,6 +54,51 @@ class TestParallelTask(ParallelTask):
         self.complete = True
 
 
+class CombiningParallelTask(TestParallelTask):
+    """
+    ParallelTask that combines results of workunits by summing them
+    """
+    def combine(self, results, other):
+        return results + other
+
+
+class CombinedHookParallelTask(CombiningParallelTask):
+    """
+    ParallelTask that records the data of merged workunits separately
+    """
+    def __init__(self):
+        CombiningParallelTask.__init__(self)
+        self._combined = []
+
+    def work_units_complete(self, data, results):
+        self._combined.append((data, results))
+
+
+class SetupTask(StandaloneTask):
+    """
+    Task that records calls to setup() and teardown()
+    """
+    def __init__(self, msg=None):
+        StandaloneTask.__init__(self, msg)
+        self.setups = 0
+        self.teardowns = 0
+
+    def setup(self):
+        self.setups += 1
+
+    def teardown(self):
+        self.teardowns += 1
+
+
+class SetupParallelTask(TestParallelTask):
+    """
+    ParallelTask with a subtask that is set up once per worker
+    """
+    def __init__(self):
+        TestParallelTask.__init__(self)
+        self.set_subtask(SetupTask, 'subtask')
+
+
 class ParallelTaskTwistedTest(twisted_unittest.TestCase):
     """
     Test ParllelTask functionality that requires twisted to run
@@ -218,6 +265,21 @@ class ParallelTaskStandaloneTest(twisted_unittest.TestCase):
         self.assertEqual(self.pt._workunit_count, 10, "Workunit count is not correct")
         self.assertEqual(len(self.pt._data_in_progress), 10, "in progress count is not correct")
 
+    def test_request_workers_data_size(self):
+        """
+        Verifies:
+            * the size of workunits planned from files is sent with requests
+            * workunits are sent as plain lists of ranges
+        """
+        unit = FileUnit([('a', 0, 10), ('b', 0, 5)])
+        self.pt.datasource = DataSource(IterSlicer, [unit, 3])
+        self.pt.parent = WorkerProxy()
+        self.pt.request_workers()
+        calls = [args for args, kwargs in self.pt.parent.request_worker.calls]
+        self.assertEqual(calls[0][1:], ({'data':[['a', 0, 10], ['b', 0, 5]]},
+                                        0, 15))
+        self.assertEqual(calls[1][1:], ({'data':3}, 1, None))
+
     def test_set_subtask(self):
         """
         Tests setting the subtask of parallelTask
@@ -277,6 +339,133 @@ class ParallelTaskStandaloneTest(twisted_unittest.TestCase):
             self.assertNotEqual(subtask0, subtask1, 'Subtask is not a different instance, status=%s' % status)
 
 
+class ParallelTaskSetupTest(unittest.TestCase):
+    """
+    Tests for reusing subtasks that have been set up
+    """
+
+    def setUp(self):
+        self.pt = SetupParallelTask()
+        self.pt.parent = WorkerProxy()
+        self.key = ['SetupParallelTask', 'SetupTask']
+
+    def test_setup_reused(self):
+        """
+        Runs several workunits with a subtask that defines setup()
+
+        Verifies:
+            * setup() is called once
+            * the same instance is used for every workunit
+        """
+        subtask = self.pt.get_subtask(self.key, clean=True)
+        for i in range(3):
+            self.assert_(self.pt.get_subtask(self.key, clean=True) is subtask)
+            subtask._start({}, CallProxy(None, False))
+            self.assertEqual(subtask.status(), STATUS_COMPLETE)
+        self.assertEqual(subtask.setups, 1)
+        self.assertEqual(subtask.teardowns, 0)
+
+    def test_not_reused_without_setup(self):
+        """
+        Runs several workunits with a subtask that doesn't define setup()
+
+        Verifies:
+            * a new instance is used for every workunit
+        """
+        pt = TestParallelTask()
+        pt.parent = WorkerProxy()
+        key = ['TestParallelTask', 'StandaloneTask']
+        subtask = pt.get_subtask(key, clean=True)
+        subtask._start({'data':1}, CallProxy(None, False))
+        self.assertEqual(subtask.status(), STATUS_COMPLETE)
+        self.assertFalse(pt.get_subtask(key, clean=True) is subtask)
+
+    def test_teardown(self):
+        """
+        Tears down the task after its subtask was set up
+
+        Verifies:
+            * teardown() is called on the subtask
+            * subtask is reinstantiated by the next clean request
+        """
+        subtask = self.pt.get_subtask(self.key, clean=True)
+        subtask._start({}, CallProxy(None, False))
+        self.pt._teardown()
+        self.assertEqual(subtask.teardowns, 1)
+        self.pt._teardown()
+        self.assertEqual(subtask.teardowns, 1)
+        self.assertFalse(self.pt.get_subtask(self.key, clean=True) is subtask)
+
+
+class ParallelTaskCombineTest(unittest.TestCase):
+    """
+    Tests for combining results of workunits
+    """
+
+    def setUp(self):
+        self.pt = CombiningParallelTask()
+        self.worker = WorkerProxy()
+        self.pt.parent = self.worker
+
+    def test_combine_results_not_combinable(self):
+        """
+        Verifies results are unchanged if the task does not define combine()
+        """
+        results = [(0, 1, False), (1, 2, False)]
+        self.assertEqual(TestParallelTask().combine_results(results), results)
+
+    def test_combine_results(self):
+        """
+        Verifies:
+            * successful results are merged into a single result
+            * failed results are not merged
+            * previously merged workunit keys are flattened
+        """
+        results = [(0, 1, False), (1, 'error', True), ([2, 3], 5, False),
+                   (4, 4, False)]
+        combined = self.pt.combine_results(results)
+        self.assertEqual(combined, [([0, 2, 3, 4], 10, False),
+                                    (1, 'error', True)])
+
+    def test_work_unit_complete_combined(self):
+        """
+        Completes workunits with a combined result
+
+        Verifies:
+            * work_unit_complete is called once with data for all workunits
+            * all combined workunits are removed from in progress
+            * task completes when all workunits are complete
+        """
+        pt = self.pt
+        pt.request_workers()
+        pt._work_unit_complete(45, range(9))
+        self.assertEqual(pt._finished, [45])
+        self.assertEqual(pt._data_in_progress.keys(), [9])
+        self.assertEqual(pt._workunit_completed, 9)
+        self.assertEqual(pt.progress(), 90)
+        self.assertFalse(pt.complete)
+
+        pt._work_unit_complete(9, 9)
+        self.assert_(pt.complete)
+
+    def test_work_units_complete(self):
+        """
+        Completes workunits with a combined result on a task overriding
+        work_units_complete()
+
+        Verifies:
+            * work_units_complete is called with the data of every workunit
+            * work_unit_complete is only called for workunits not combined
+        """
+        pt = CombinedHookParallelTask()
+        pt.parent = self.worker
+        pt.request_workers()
+        pt._work_unit_complete(3, [1, 2])
+        pt._work_unit_complete(0, 0)
+        self.assertEqual(pt._combined, [([1, 2], 3)])
+        self.assertEqual(pt._finished, [0])
+
+
 class ParallelTask_Test(unittest.TestCase):
     """
     Tests to verify functionality of ParallelTask class
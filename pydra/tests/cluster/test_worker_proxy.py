@@ -0,0 +1,303 @@
+"""
+    Copyright 2009 Oregon State University
+
+    This file is part of Pydra.
+
+    Pydra is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    Pydra is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with Pydra.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import shutil
+import tempfile
+
+from twisted.trial import unittest as twisted_unittest
+
+from pydra.cluster.tasks import Task, ParallelTask, TaskContainer, \
+    STATUS_COMPLETE
+from pydra.cluster.tasks.datasource.slicer import IterSlicer
+from pydra.cluster.tasks.mapreduce import MapReduceTask, \
+    IntermediateResultsFiles
+from pydra.cluster.worker_proxy import LocalWorker, WorkUnitFailed, \
+    run_counted_work_unit, run_work_unit
+
+
+class DoubleTask(Task):
+    def work(self, data):
+        if data == 'fail':
+            raise Exception('bad data')
+        self.increment('doubled')
+        return data * 2
+
+
+class SumParallelTask(ParallelTask):
+    """
+    ParallelTask that sums its subtask's results
+    """
+    datasource = IterSlicer, range(10)
+
+    def __init__(self):
+        ParallelTask.__init__(self)
+        self.set_subtask(DoubleTask)
+        self.total = 0
+
+    def work_unit_complete(self, data, results):
+        self.total += results
+
+    def work_complete(self):
+        return self.total
+
+
+class FailingParallelTask(SumParallelTask):
+    datasource = IterSlicer, [1, 'fail', 3]
+
+
+class UnpicklableParallelTask(SumParallelTask):
+    datasource = IterSlicer, [1, lambda: 2, 3]
+
+
+class RecordingParallelTask(SumParallelTask):
+    """
+    ParallelTask that records the data and results of every workunit
+    """
+    datasource = IterSlicer, range(500)
+
+    def __init__(self):
+        SumParallelTask.__init__(self)
+        self.completed = {}
+
+    def work_unit_complete(self, data, results):
+        self.completed[data] = results
+
+    def work_complete(self):
+        return self.completed
+
+
+class SumContainerTask(TaskContainer):
+    def __init__(self, msg=None):
+        TaskContainer.__init__(self, msg)
+        self.add_task(SumParallelTask())
+
+
+class WordMapTask(Task):
+    def _work(self, input, output, **kwargs):
+        for word in input:
+            output[word] = 1
+
+
+class CountReduceTask(Task):
+    def _work(self, input, output, **kwargs):
+        for word, counts in input:
+            output[word] = sum(counts)
+
+
+class WordInput():
+    """
+    map input from a list of lists of words
+    """
+    def __init__(self, data):
+        self.data = data
+
+    def __iter__(self):
+        return iter(range(len(self.data)))
+
+    def load(self, i):
+        return self.data[i]
+
+
+class CountWordsTask(MapReduceTask):
+    """
+    MapReduceTask counting words.  intermediate is set by the test.
+    """
+    input = WordInput([['a', 'b', 'c'], ['d', 'e'], ['a', 'f'], ['e', 'f']])
+    output = {}
+    map = WordMapTask
+    reduce = CountReduceTask
+    reducers = 2
+
+
+class CountWordsContainerTask(TaskContainer):
+    def __init__(self, msg=None):
+        TaskContainer.__init__(self, msg)
+        self.add_task(CountWordsTask())
+
+
+WORD_COUNTS = {'a':2, 'b':1, 'c':1, 'd':1, 'e':2, 'f':2}
+
+
+class LocalWorkerTestCase(twisted_unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        CountWordsTask.intermediate = IntermediateResultsFiles(self.dir)
+        CountWordsTask.output = {}
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_run_work_unit(self):
+        """
+        Runs a workunit in this process
+
+        Verifies:
+            * results are returned in the worker results format
+        """
+        result = run_work_unit(SumParallelTask, 'SumParallelTask.DoubleTask',
+                               {'data':4}, 7)
+        self.assertEqual(result, (7, 8, False))
+
+    def test_run_counted_work_unit(self):
+        """
+        Runs a workunit in this process, returning its counters
+
+        Verifies:
+            * counters incremented by the workunit are returned
+        """
+        result, counters = run_counted_work_unit(SumParallelTask,
+                            'SumParallelTask.DoubleTask', {'data':4}, 7)
+        self.assertEqual(result, (7, 8, False))
+        self.assertEqual(counters, {'doubled':1})
+
+    def test_run_work_unit_failed(self):
+        """
+        Runs a workunit that throws an exception
+
+        Verifies:
+            * workunit is marked failed
+            * traceback is returned
+        """
+        workunit, results, failed = run_work_unit(SumParallelTask,
+                            'SumParallelTask.DoubleTask', {'data':'fail'}, 1)
+        self.assert_(failed)
+        self.assert_('bad data' in results)
+
+    def verify_parallel_task(self, results, task, worker):
+        self.assertEqual(results, 90)
+        self.assertEqual(task.status(), STATUS_COMPLETE)
+        self.assertEqual(worker.stats['requested'], 10)
+        self.assertEqual(worker.stats['completed'], 10)
+        self.assert_(worker.stats['elapsed'] is not None)
+        self.assertEqual(worker.counters['doubled'], 10)
+
+    def test_parallel_task(self):
+        """
+        Runs a ParallelTask with workunits in a process pool
+
+        Verifies:
+            * all workunits are run and returned to the task
+            * results of the task are returned
+        """
+        task = SumParallelTask()
+        worker = LocalWorker(2)
+        deferred = worker.run(task)
+        deferred.addCallback(self.verify_parallel_task, task, worker)
+        return deferred
+
+    def test_parallel_task_threads(self):
+        """
+        Runs a ParallelTask with workunits in threads
+        """
+        task = SumParallelTask()
+        worker = LocalWorker(0)
+        deferred = worker.run(task)
+        deferred.addCallback(self.verify_parallel_task, task, worker)
+        return deferred
+
+    def test_task_container(self):
+        """
+        Runs a TaskContainer containing a ParallelTask
+        """
+        task = SumContainerTask()
+        worker = LocalWorker(2)
+        deferred = worker.run(task)
+        deferred.addCallback(self.assertEqual, 90)
+        return deferred
+
+    def verify_mapreduce_task(self, results, worker):
+        self.assertEqual(results, WORD_COUNTS)
+        # 4 maps and 2 reduces
+        self.assertEqual(worker.stats['completed'], 6)
+
+    def test_mapreduce_task(self):
+        """
+        Runs a MapReduceTask with workunits in a process pool
+
+        Verifies:
+            * maps and reduces are found and run as subtasks of the task
+            * results of the reducers are returned
+        """
+        worker = LocalWorker(2)
+        deferred = worker.run(CountWordsTask())
+        deferred.addCallback(self.verify_mapreduce_task, worker)
+        return deferred
+
+    def test_mapreduce_task_threads(self):
+        worker = LocalWorker(0)
+        deferred = worker.run(CountWordsTask())
+        deferred.addCallback(self.verify_mapreduce_task, worker)
+        return deferred
+
+    def test_mapreduce_container(self):
+        """
+        Runs a TaskContainer containing a MapReduceTask
+        """
+        worker = LocalWorker(2)
+        deferred = worker.run(CountWordsContainerTask())
+        deferred.addCallback(self.verify_mapreduce_task, worker)
+        return deferred
+
+    def verify_all_workunits(self, results, worker):
+        self.assertEqual(sorted(results.items()),
+                         [(i, i * 2) for i in range(500)])
+        self.assertEqual(worker.stats['completed'], 500)
+
+    def test_all_workunits(self):
+        """
+        Runs many workunits in a process pool
+
+        Verifies:
+            * the task completes only after the results of every workunit
+              are returned, even when results return while workunits are
+              still being requested
+        """
+        worker = LocalWorker(2)
+        deferred = worker.run(RecordingParallelTask())
+        deferred.addCallback(self.verify_all_workunits, worker)
+        return deferred
+
+    def test_all_workunits_threads(self):
+        worker = LocalWorker(0)
+        deferred = worker.run(RecordingParallelTask())
+        deferred.addCallback(self.verify_all_workunits, worker)
+        return deferred
+
+    def test_unpicklable_workunit(self):
+        """
+        Runs a workunit whose args can't be sent to the process pool
+
+        Verifies:
+            * the run fails with WorkUnitFailed instead of hanging
+        """
+        worker = LocalWorker(2)
+        deferred = worker.run(UnpicklableParallelTask())
+        return self.assertFailure(deferred, WorkUnitFailed)
+
+    def test_failed_workunit(self):
+        """
+        Runs a ParallelTask where a workunit fails
+
+        Verifies:
+            * the run fails with WorkUnitFailed
+        """
+        worker = LocalWorker(0)
+        deferred = worker.run(FailingParallelTask())
+        return self.assertFailure(deferred, WorkUnitFailed)
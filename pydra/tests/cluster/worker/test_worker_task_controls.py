@@ -18,7 +18,16 @@
 """
 
 from twisted.trial import unittest as twisted_unittest
-from twisted.internet import threads
+import shutil
+import tempfile
+from threading import Thread
+from logging import FileHandler
+
+import simplejson
+
+from twisted.internet import reactor, threads
+from twisted.internet.defer import Deferred
+from twisted.python.threadable import isInIOThread
 
 from pydra.tests import setup_test_environment
 setup_test_environment()
@@ -30,9 +39,145 @@ from pydra.cluster.worker import WorkerTaskControls
 
 from pydra.tests import clean_reactor
 from pydra.tests.cluster.tasks.test_task_manager import TaskManagerTestCaseMixIn
+from pydra.tests.cluster.tasks.test_parallel_task import SetupParallelTask
+from pydra.cluster.tasks import Task, ParallelTask
+from pydra.cluster.tasks.datasource.slicer import IterSlicer
+from pydra.cluster.tasks.mapreduce import MapReduceTask, \
+    IntermediateResultsFiles
 from pydra.tests.cluster.module.test_module_manager import TestAPI
 from pydra.tests.proxies import CallProxy, RemoteProxy
 
+class ResultsParentStub(object):
+    """ records results passed to _work_unit_complete """
+    def __init__(self):
+        self.calls = []
+    
+    def _work_unit_complete(self, results, index):
+        self.calls.append((results, index))
+
+
+class CombiningResultsParentStub(ResultsParentStub):
+    """ records results passed to _work_unit_complete, summing results """
+    def combine(self, results, other):
+        return results + other
+    
+    combine_results = ParallelTask.combine_results.im_func
+
+
+class ResultsTaskStub(object):
+    """ task instance with a single subtask, used for receiving results """
+    STOP_FLAG = False
+    
+    def __init__(self, parent_class=ResultsParentStub):
+        self.subtask = ResultsTaskStub.__new__(ResultsTaskStub)
+        self.subtask.parent = parent_class()
+    
+    def get_subtask(self, task_path):
+        return self.subtask
+
+
+class UnstartedParallelTask(SetupParallelTask):
+    """ task that records being started instead of running """
+    def start(self, *args, **kwargs):
+        self.started = True
+
+
+class VectorTask(Task):
+    """ task that doubles data, one workunit or a batch at a time """
+    batches = []
+    loggers = []
+    
+    def work(self, data):
+        return data * 2
+    
+    def work_batch(self, items):
+        VectorTask.batches.append(items)
+        VectorTask.loggers.append(self.logger)
+        if 'fail' in items:
+            raise Exception('bad data')
+        return [item * 2 for item in items]
+
+
+class VectorParallelTask(ParallelTask):
+    datasource = IterSlicer, range(10)
+    
+    def __init__(self):
+        ParallelTask.__init__(self)
+        self.set_subtask(VectorTask)
+
+
+class DoubleTask(Task):
+    """ task that doubles data and records the instances that ran it """
+    instances = []
+    
+    def work(self, data):
+        DoubleTask.instances.append(self)
+        if data == 'fail':
+            raise Exception('bad data')
+        return data * 2
+
+
+class DoubleParallelTask(ParallelTask):
+    datasource = IterSlicer, range(10)
+    
+    def __init__(self):
+        ParallelTask.__init__(self)
+        self.set_subtask(DoubleTask)
+
+
+class AsyncDoubleTask(Task):
+    """
+    task that completes after _start() returns, from the reactor, and
+    records the loggers it was run with
+    """
+    loggers = []
+    
+    def _work(self, data):
+        AsyncDoubleTask.loggers.append(self.logger)
+        reactor.callFromThread(self._complete, data * 2)
+
+
+class AsyncDoubleParallelTask(ParallelTask):
+    datasource = IterSlicer, range(10)
+    
+    def __init__(self):
+        ParallelTask.__init__(self)
+        self.set_subtask(AsyncDoubleTask)
+
+
+class WordMapTask(Task):
+    def _work(self, input, output, **kwargs):
+        for word in input:
+            output[word] = 1
+
+
+class CountReduceTask(Task):
+    def _work(self, input, output, **kwargs):
+        for word, counts in input:
+            output[word] = sum(counts)
+
+
+class WordInput():
+    """ map input from a list of lists of words """
+    def __init__(self, data):
+        self.data = data
+    
+    def __iter__(self):
+        return iter(range(len(self.data)))
+    
+    def load(self, i):
+        return self.data[i]
+
+
+class CountWordsTask(MapReduceTask):
+    """ MapReduceTask counting words.  intermediate is set by the test. """
+    input = WordInput([['a', 'b', 'c'], ['d', 'e'], ['a', 'f']])
+    output = {}
+    map = WordMapTask
+    reduce = CountReduceTask
+    reducers = 2
+
+
 class WorkerTaskControlsTestCase(twisted_unittest.TestCase, TaskManagerTestCaseMixIn):
     
     def setUp(self):
@@ -105,8 +250,191 @@ class WorkerTaskControlsTestCase(twisted_unittest.TestCase, TaskManagerTestCaseM
     def test_batch_complete(self):
         raise NotImplementedError
     
+    def run_test_batch(self, task_class, subtask_class, items,
+                       unit_args=None):
+        """
+        Runs a batch of workunits, one per item, and returns a deferred that
+        fires with the results when the batch is complete.  If unit_args is
+        given it is the list of args of each workunit instead.
+        """
+        wtc = self.worker_task_controls
+        completed = Deferred()
+        wtc.batch_complete = lambda: completed.callback(wtc._results)
+        
+        if unit_args is None:
+            unit_args = [{'data':i} for i in items]
+        subtask_key = '%s.%s' % (task_class.__name__, subtask_class.__name__)
+        workunit_args = {subtask_key:[simplejson.dumps(a) for a in unit_args]}
+        task_tuple = ('key', 'v1', task_class, None)
+        wtc.run_batch(task_tuple, {}, {subtask_key:range(len(items))},
+                      'main', 1, workunit_args)
+        return completed
+    
+    def run_vector_batch(self, items):
+        VectorTask.batches = []
+        VectorTask.loggers = []
+        return self.run_test_batch(VectorParallelTask, VectorTask, items)
+
+    def test_combine_results_mixed_subtasks(self):
+        """
+        Combines the results of a batch with workunits of two subtasks
+        
+        Verifies:
+            * results are returned without being combined
+        """
+        wtc = self.worker_task_controls
+        wtc._batch_subtasks = set(['Task.SubtaskA', 'Task.SubtaskB'])
+        results = [(0, 1, False), (1, 2, False)]
+        self.assertEqual(wtc.combine_results(results), results)
+
+    def test_run_batch_vectorized(self):
+        """
+        Runs a batch for a subtask that implements work_batch()
+        
+        Verifies:
+            * work_batch is called once with the data of every workunit
+            * results are split into results for each workunit
+        """
+        def verify(results):
+            self.assertEqual(VectorTask.batches, [[3, 4, 5]])
+            self.assertEqual(results, [(0, 6, False), (1, 8, False),
+                                       (2, 10, False)])
+        deferred = self.run_vector_batch([3, 4, 5])
+        deferred.addCallback(verify)
+        return deferred
+
+    def test_run_batch_vectorized_failed(self):
+        """
+        Runs a batch for a subtask where work_batch() throws an exception
+        
+        Verifies:
+            * all workunits in the batch fail with the traceback
+        """
+        def verify(results):
+            self.assertEqual([r[0] for r in results], [0, 1])
+            for workunit, result, failed in results:
+                self.assert_(failed)
+                self.assert_('bad data' in result, result)
+        deferred = self.run_vector_batch([3, 'fail'])
+        deferred.addCallback(verify)
+        return deferred
+
+    def test_run_batch_vectorized_closes_logger(self):
+        """
+        Runs batches for a subtask that implements work_batch()
+        
+        Verifies:
+            * the file handlers of the task logger are closed after each
+              call, whether work_batch() succeeds or fails
+        """
+        def verify(results, batches):
+            self.assertEqual(len(VectorTask.loggers), batches)
+            for task_logger in VectorTask.loggers:
+                self.failIf([h for h in task_logger.handlers \
+                                if isinstance(h, FileHandler)])
+        deferred = self.run_vector_batch([3, 4])
+        deferred.addCallback(verify, 1)
+        deferred.addCallback(lambda r: self.run_vector_batch([3, 'fail']))
+        deferred.addCallback(verify, 1)
+        return deferred
+
     def test_run_batch(self):
-        raise NotImplementedError
+        """
+        Runs a batch of workunits in a single thread
+        
+        Verifies:
+            * every workunit is run with its own args
+            * every workunit is run by a clean subtask instance
+        """
+        def verify(results):
+            self.assertEqual(results, [(0, 6, False), (1, 8, False),
+                                       (2, 10, False)])
+            self.assertEqual(len(set(map(id, DoubleTask.instances))), 3)
+        DoubleTask.instances = []
+        deferred = self.run_test_batch(DoubleParallelTask, DoubleTask,
+                                       [3, 4, 5])
+        deferred.addCallback(verify)
+        return deferred
+    
+    def test_run_batch_failed(self):
+        """
+        Runs a batch in a single thread where one workunit fails
+        
+        Verifies:
+            * the failed workunit is marked failed with its traceback
+            * the remaining workunits are run
+        """
+        def verify(results):
+            self.assertEqual(results[0], (0, 6, False))
+            self.assertEqual(results[2], (2, 10, False))
+            workunit, result, failed = results[1]
+            self.assert_(failed)
+            self.assert_('bad data' in result, result)
+        deferred = self.run_test_batch(DoubleParallelTask, DoubleTask,
+                                       [3, 'fail', 5])
+        deferred.addCallback(verify)
+        return deferred
+    
+    def test_run_batch_async(self):
+        """
+        Runs a batch in a single thread for a subtask that completes after
+        _start() returns
+        
+        Verifies:
+            * the results passed to the callback are recorded
+            * one task logger is used for the batch
+        """
+        def verify(results):
+            self.assertEqual(results, [(0, 6, False), (1, 8, False),
+                                       (2, 10, False)])
+            self.assertEqual(len(set(map(id, AsyncDoubleTask.loggers))), 1)
+        AsyncDoubleTask.loggers = []
+        deferred = self.run_test_batch(AsyncDoubleParallelTask,
+                                       AsyncDoubleTask, [3, 4, 5])
+        deferred.addCallback(verify)
+        return deferred
+    
+    def test_run_batch_per_workunit(self):
+        """
+        Runs a batch with each workunit run by its own run_task call
+        
+        Verifies:
+            * every workunit is run with its own args
+        """
+        def verify(results):
+            self.assertEqual(sorted(results), [(0, 6, False), (1, 8, False),
+                                               (2, 10, False)])
+        self.worker_task_controls.batch_in_thread = False
+        deferred = self.run_test_batch(DoubleParallelTask, DoubleTask,
+                                       [3, 4, 5])
+        deferred.addCallback(verify)
+        return deferred
+    
+    
+    def test_run_batch_mapreduce_wrapper(self):
+        """
+        Runs a batch of map workunits of a MapReduceTask.  The subtask found
+        for the workunits is the map wrapper, which is not a Task.
+        
+        Verifies:
+            * every map workunit is run and dumps its output
+        """
+        def verify(results):
+            self.assertEqual([r[0] for r in results], [0, 1, 2])
+            records = 0
+            for workunit, result, failed in results:
+                self.failIf(failed, result)
+                records += sum(r for k, r, v in result.values())
+            self.assertEqual(records, 7)
+        
+        dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, dir)
+        CountWordsTask.intermediate = IntermediateResultsFiles(dir)
+        unit_args = [{'id':'map%d' % i, 'input_key':i} for i in range(3)]
+        deferred = self.run_test_batch(CountWordsTask, WordMapTask, range(3),
+                                       unit_args)
+        deferred.addCallback(verify)
+        return deferred
     
     
     def verify_running_task(self, key):
@@ -334,6 +662,147 @@ class WorkerTaskControlsTestCase(twisted_unittest.TestCase, TaskManagerTestCaseM
         wtc.receive_results('worker_key_not_needed', results, subtask_key)
         self.assertEqual(task._work_unit_complete.calls, 0)
     
+    def setup_results_task(self, parent_class=ResultsParentStub):
+        """
+        replaces the task instance with a stub that records the results passed
+        to it by the results consumer
+        """
+        wtc = self.worker_task_controls
+        wtc._task_instance = ResultsTaskStub(parent_class)
+        return wtc._task_instance.subtask.parent
+
+    def stop_results_consumer(self):
+        wtc = self.worker_task_controls
+        wtc._results_queue.put(None)
+        wtc._results_consumer.join(5)
+        self.assertFalse(wtc._results_consumer.isAlive())
+
+    def test_receive_results_queued(self):
+        """
+        Results are queued and processed by the consumer thread
+        
+        Verifies:
+            * successful results are passed to task
+            * failed results are not
+            * receive_results responds with the ingestion stats, not
+              throttling while the queue is not full
+            * ingestion stats are recorded
+        """
+        wtc = self.worker_task_controls
+        parent = self.setup_results_task()
+        results = ((0, 0, False), (1, 1, True), (2, 2, False))
+        
+        response = wtc.receive_results('worker_key', results, 'Root.Sub')
+        self.assertEqual(response['received'], 3)
+        self.assertFalse(response['throttling'])
+        response = wtc.receive_results('worker_key', results, 'Root.Sub')
+        self.stop_results_consumer()
+        
+        self.assertEqual(parent.calls, [(0,0),(2,2),(0,0),(2,2)])
+        stats = wtc.ingestion_stats()
+        self.assertEqual(stats['received'], 6)
+        self.assertEqual(stats['processed'], 6)
+        self.assertEqual(stats['queued'], 0)
+        self.assertEqual(stats['throttled'], 0)
+        self.assert_(stats['batches'] > 0)
+        self.assert_(stats['lag_max'] >= stats['lag_avg'] >= 0)
+
+    def test_receive_results_combined(self):
+        """
+        Results of several batches are received in one call for a task that
+        defines combine()
+        
+        Verifies:
+            * successful results are merged before they are passed to task
+            * failed results are not
+        """
+        wtc = self.worker_task_controls
+        parent = self.setup_results_task(CombiningResultsParentStub)
+        results = [([0, 1], 1, False), (2, 2, True), (3, 3, False)]
+        
+        wtc.receive_results('worker_key', results, 'Root.Sub')
+        self.stop_results_consumer()
+        self.assertEqual(parent.calls, [(4, [0, 1, 3])])
+    
+    def test_receive_results_throttled(self):
+        """
+        Results are received while the queue is over its limit
+        
+        Verifies:
+            * the response tells the master the worker is throttling
+            * the master is informed once the consumer drains the queue
+        """
+        wtc = self.worker_task_controls
+        parent = self.setup_results_task()
+        wtc.results_queue_limit = 1
+        wtc.results_queue_resume = 0
+        
+        # hold the consumer so results back up in the queue
+        wtc._results_consumer = True
+        results = ((0, 0, False),)
+        response = wtc.receive_results('w', results, 'Root.Sub')
+        self.assertFalse(response['throttling'])
+        response = wtc.receive_results('w', results, 'Root.Sub')
+        self.assert_(response['throttling'])
+        self.assertEqual(response['throttled'], 1)
+        
+        deferred = Deferred()
+        resume_results = wtc._resume_results
+        def resume():
+            resume_results()
+            deferred.callback(None)
+        wtc._resume_results = resume
+        wtc._results_consumer = Thread(target=wtc._consume_results)
+        wtc._results_consumer.start()
+        
+        def resumed(result):
+            self.stop_results_consumer()
+            self.assertEqual(len(parent.calls), 2)
+            args, kwargs, deferred = wtc.master.assertCalled(self,
+                                                        'results_resumed')
+            self.assertFalse(args[1]['throttling'])
+            self.assertEqual(args[1]['processed'], 2)
+        deferred.addCallback(resumed)
+        return deferred
+
+    def test_receive_results_stopped_queued(self):
+        """
+        Results are received by a stopped task
+        
+        Verifies:
+            * results are not queued
+        """
+        wtc = self.worker_task_controls
+        parent = self.setup_results_task()
+        wtc._task_instance.STOP_FLAG = True
+        wtc.receive_results('w', ((0, 0, False),), 'Root.Sub')
+        self.assertEqual(wtc.ingestion_stats()['received'], 0)
+        self.assertEqual(wtc._results_consumer, None)
+
+    def test_run_task_new_version(self):
+        """
+        A held worker is sent work for a different version of its task
+        
+        Verifies:
+            * old task instance is torn down
+            * a new task instance is created
+        """
+        wtc = self.worker_task_controls
+        old = UnstartedParallelTask()
+        old._setup_complete = True
+        CallProxy.patch(old, 'teardown')
+        wtc._task_instance = old
+        wtc._task_version = ('key', 'v1')
+        
+        wtc._run_task('key', 'v1', UnstartedParallelTask, None)
+        self.assert_(wtc._task_instance is old)
+        self.assertEqual(len(old.teardown.calls), 0)
+        
+        wtc._run_task('key', 'v2', UnstartedParallelTask, None)
+        self.assertEqual(len(old.teardown.calls), 1)
+        self.assertFalse(wtc._task_instance is old)
+        self.assertEqual(wtc._task_version, ('key', 'v2'))
+
     def test_release_worker(self):
         raise NotImplementedError
     
@@ -355,6 +824,29 @@ class WorkerTaskControlsTestCase(twisted_unittest.TestCase, TaskManagerTestCaseM
         wtc.request_worker(subtask_key, args, workunit_key)
         wtc.master.assertCalled(self, 'request_worker', subtask_key, args, workunit_key)
     
+    def test_request_worker_thread(self):
+        """
+        Task requests a worker from a thread other than the reactor thread,
+        such as the results consumer
+        
+        Verifies:
+            * request is passed to master from the reactor thread
+        """
+        wtc = self.worker_task_controls
+        master = wtc.master
+        threads_ = []
+        def callRemote(*args, **kwargs):
+            threads_.append(isInIOThread())
+            return RemoteProxy.callRemote(master, *args, **kwargs)
+        master.callRemote = callRemote
+        
+        def verify(result):
+            master.assertCalled(self, 'request_worker')
+            self.assertEqual(threads_, [True])
+        deferred = threads.deferToThread(wtc.request_worker, 'Root.Sub', {}, 1)
+        deferred.addCallback(verify)
+        return deferred
+    
     def test_request_worker_release(self):
         """
         Task requests a waiting worker be released